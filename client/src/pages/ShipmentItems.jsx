@@ -45,7 +45,8 @@ export default function ShipmentItems() {
 
   const fetchShipments = async () => {
     try {
-      const response = await api.get('/shipments');
+      // Choices for the item form: the most recent shipments
+      const response = await api.get('/shipments', { params: { limit: 1000 } });
       setShipments(response.data || []);
     } catch (error) {
       console.error('Error fetching shipments:', error);
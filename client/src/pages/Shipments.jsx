@@ -12,7 +12,9 @@ export default function Shipments() {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState('');
   const [currentPage, setCurrentPage] = useState(1);
-  const [totalPages, setTotalPages] = useState(0);
+  const [hasMore, setHasMore] = useState(false);
+  const [statusFilter, setStatusFilter] = useState('');
+  const [sort, setSort] = useState('-created_at');
   const itemsPerPage = 10;
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [editingShipment, setEditingShipment] = useState(null);
@@ -36,6 +38,9 @@ export default function Shipments() {
 
   useEffect(() => {
     fetchShipments();
+  }, [currentPage, statusFilter, sort]);
+
+  useEffect(() => {
     fetchCustomers();
     fetchLocations();
     fetchVehicles();
@@ -46,11 +51,19 @@ export default function Shipments() {
   const fetchShipments = async () => {
     try {
       setLoading(true);
-      const response = await api.get('/shipments');
+      // The server filters, sorts and pages; X-Has-More says whether a next page exists
+      const response = await api.get('/shipments', {
+        params: {
+          limit: itemsPerPage,
+          offset: (currentPage - 1) * itemsPerPage,
+          sort,
+          status: statusFilter || undefined
+        }
+      });
       
       if (response.data) {
         setShipments(response.data);
-        setTotalPages(Math.ceil(response.data.length / itemsPerPage));
+        setHasMore(response.headers['x-has-more'] === 'true');
         setError('');
       } else {
         throw new Error('Invalid response format');
@@ -174,7 +187,7 @@ export default function Shipments() {
     if (window.confirm('Are you sure you want to delete this shipment? This will also delete all related shipment items and tracking events.')) {
       try {
         await api.delete(`/shipments/${shipmentId}`);
-        setShipments(shipments.filter(shipment => shipment.shipment_id !== shipmentId));
+        fetchShipments();
       } catch (err) {
         console.error('Error deleting shipment:', err);
         setError(err.response?.data?.error || 'Failed to delete shipment');
@@ -248,10 +261,13 @@ export default function Shipments() {
   if (loading) return <div className="p-6">Loading...</div>;
   if (error) return <div className="p-6 text-red-500">{error}</div>;
 
-  // Calculate current page items
-  const startIndex = (currentPage - 1) * itemsPerPage;
-  const endIndex = startIndex + itemsPerPage;
-  const currentShipments = shipments.slice(startIndex, endIndex);
+  // Rows before this page, this page, and one more when the server has another page
+  const knownItems = (currentPage - 1) * itemsPerPage + shipments.length + (hasMore ? 1 : 0);
+
+  const handleFilterChange = (setter) => (e) => {
+    setter(e.target.value);
+    setCurrentPage(1);
+  };
 
   return (
     <div className="p-6">
@@ -264,6 +280,31 @@ export default function Shipments() {
           <i className="fas fa-plus mr-2"></i> Add Shipment
         </button>
       </div>
+
+      <div className="flex flex-wrap gap-4 mb-4">
+        <select
+          value={statusFilter}
+          onChange={handleFilterChange(setStatusFilter)}
+          className="rounded-md border-gray-300 shadow-sm focus:border-purple-500 focus:ring-purple-500"
+        >
+          <option value="">All statuses</option>
+          <option value="pending">Pending</option>
+          <option value="picked_up">Picked up</option>
+          <option value="in_transit">In transit</option>
+          <option value="delivered">Delivered</option>
+          <option value="returned">Returned</option>
+        </select>
+        <select
+          value={sort}
+          onChange={handleFilterChange(setSort)}
+          className="rounded-md border-gray-300 shadow-sm focus:border-purple-500 focus:ring-purple-500"
+        >
+          <option value="-created_at">Newest first</option>
+          <option value="created_at">Oldest first</option>
+          <option value="estimated_delivery">Estimated delivery</option>
+          <option value="-shipment_value">Highest value</option>
+        </select>
+      </div>
       
       <div className="bg-white rounded-lg shadow-md overflow-hidden">
         <div className="overflow-x-auto">
@@ -280,7 +321,7 @@ export default function Shipments() {
               </tr>
             </thead>
             <tbody className="bg-white divide-y divide-gray-200">
-              {currentShipments.map((shipment) => (
+              {shipments.map((shipment) => (
                 <tr key={shipment.shipment_id} className="hover:bg-purple-50">
                   <td className="px-6 py-4 whitespace-nowrap text-sm font-medium text-purple-600">
                     {shipment.tracking_number}
@@ -321,7 +362,7 @@ export default function Shipments() {
       
       <Pagination
         currentPage={currentPage}
-        totalItems={shipments.length}
+        totalItems={knownItems}
         itemsPerPage={itemsPerPage}
         onPageChange={setCurrentPage}
       />
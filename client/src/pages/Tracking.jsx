@@ -16,6 +16,9 @@ const Tracking = () => {
   const [searchMode, setSearchMode] = useState('id'); // 'id' or 'tracking'
   const [events, setEvents] = useState([]);
   const [currentPage, setCurrentPage] = useState(1);
+  const [hasMore, setHasMore] = useState(false);
+  const [eventTypeFilter, setEventTypeFilter] = useState('');
+  const [sort, setSort] = useState('-event_timestamp');
   const itemsPerPage = 10;
   const [isModalOpen, setIsModalOpen] = useState(false);
   const [editingEvent, setEditingEvent] = useState(null);
@@ -47,6 +50,9 @@ const Tracking = () => {
 
   useEffect(() => {
     fetchEvents();
+  }, [currentPage, eventTypeFilter, sort]);
+
+  useEffect(() => {
     fetchShipments();
     fetchLocations();
   }, []);
@@ -54,8 +60,17 @@ const Tracking = () => {
   const fetchEvents = async () => {
     try {
       setLoading(true);
-      const response = await api.get('/tracking-events');
+      // The server filters, sorts and pages; X-Has-More says whether a next page exists
+      const response = await api.get('/tracking-events', {
+        params: {
+          limit: itemsPerPage,
+          offset: (currentPage - 1) * itemsPerPage,
+          sort,
+          event_type: eventTypeFilter || undefined
+        }
+      });
       setEvents(response.data || []);
+      setHasMore(response.headers['x-has-more'] === 'true');
       setError('');
     } catch (error) {
       console.error('Error fetching tracking events:', error);
@@ -68,7 +83,8 @@ const Tracking = () => {
 
   const fetchShipments = async () => {
     try {
-      const response = await api.get('/shipments');
+      // Choices for the event form: the most recent shipments
+      const response = await api.get('/shipments', { params: { limit: 1000 } });
       setShipments(response.data || []);
     } catch (error) {
       console.error('Error fetching shipments:', error);
@@ -168,10 +184,13 @@ const Tracking = () => {
     }
   };
 
-  // Calculate pagination
-  const indexOfLastEvent = currentPage * itemsPerPage;
-  const indexOfFirstEvent = indexOfLastEvent - itemsPerPage;
-  const currentEvents = events.slice(indexOfFirstEvent, indexOfLastEvent);
+  // Rows before this page, this page, and one more when the server has another page
+  const knownItems = (currentPage - 1) * itemsPerPage + events.length + (hasMore ? 1 : 0);
+
+  const handleFilterChange = (setter) => (e) => {
+    setter(e.target.value);
+    setCurrentPage(1);
+  };
 
   const handleCreate = () => {
     setEditingEvent(null);
@@ -199,7 +218,7 @@ const Tracking = () => {
     if (window.confirm('Are you sure you want to delete this tracking event?')) {
       try {
         await api.delete(`/tracking-events/${eventId}`);
-        setEvents(events.filter(event => event.event_id !== eventId));
+        fetchEvents();
       } catch (err) {
         console.error('Error deleting tracking event:', err);
         setError(err.response?.data?.error || 'Failed to delete tracking event');
@@ -427,6 +446,31 @@ const Tracking = () => {
           <i className="fas fa-plus mr-2"></i> Add Event
         </button>
       </div>
+
+      <div className="flex flex-wrap gap-4 my-4">
+        <select
+          value={eventTypeFilter}
+          onChange={handleFilterChange(setEventTypeFilter)}
+          className="rounded-md border-gray-300 shadow-sm focus:border-purple-500 focus:ring-purple-500"
+        >
+          <option value="">All event types</option>
+          <option value="pickup">Pickup</option>
+          <option value="departure">Departure</option>
+          <option value="arrival">Arrival</option>
+          <option value="delivery">Delivery</option>
+          <option value="delay">Delay</option>
+          <option value="issue">Issue</option>
+        </select>
+        <select
+          value={sort}
+          onChange={handleFilterChange(setSort)}
+          className="rounded-md border-gray-300 shadow-sm focus:border-purple-500 focus:ring-purple-500"
+        >
+          <option value="-event_timestamp">Newest first</option>
+          <option value="event_timestamp">Oldest first</option>
+          <option value="shipment_id,-event_timestamp">By shipment</option>
+        </select>
+      </div>
       
       <div className="bg-white rounded-lg shadow-md overflow-hidden">
         <div className="overflow-x-auto">
@@ -443,7 +487,7 @@ const Tracking = () => {
               </tr>
             </thead>
             <tbody className="bg-white divide-y divide-gray-200">
-              {currentEvents.map((event) => (
+              {events.map((event) => (
                 <tr key={event.event_id} className="hover:bg-purple-50">
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-900">{event.event_id}</td>
                   <td className="px-6 py-4 whitespace-nowrap text-sm text-gray-900">{event.shipment_id}</td>
@@ -514,7 +558,7 @@ const Tracking = () => {
       
       <Pagination
         currentPage={currentPage}
-        totalItems={events.length}
+        totalItems={knownItems}
         itemsPerPage={itemsPerPage}
         onPageChange={setCurrentPage}
       />
@@ -0,0 +1,243 @@
+"""
+Admission control in front of the API routes.
+
+Each request first takes a token from its client's bucket and, for routes
+listed in RATE_LIMIT_ROUTES, from the client's bucket for that route; an empty
+bucket is a 429 with Retry-After. It then takes one of DB_MAX_CONCURRENCY
+slots for the database work it is about to do. Reads may only use the slots
+outside DB_WRITE_RESERVE, so a burst of dashboard polling cannot crowd out
+dispatch writes; a request that finds no slot within DB_ADMISSION_WAIT_SECONDS
+gets a 503 with Retry-After instead of queueing on MySQL.
+
+Sub-requests of POST /api/batch never pass through before_request, so batch
+checks each one with admit_subrequest: it is charged to its own route's
+bucket, and a parallel GET, which opens a connection of its own, takes a
+slot of its own.
+
+The client is the remote address. Behind a load balancer every request comes
+from the balancer, so set PROXY_FIX_X_FOR to the number of proxies in front of
+the app and the address is read from X-Forwarded-For instead (a header the
+proxies themselves append, unlike anything the caller sends). Buckets and
+slots are per worker process.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, request
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# Endpoints that never touch the database or hold a request open for a long time
+_EXEMPT_ENDPOINTS = {'static', 'home', 'stream_events', 'healthz', 'readyz'}
+
+_stats = {'rate_limited': 0, 'shed': 0}
+_stats_lock = threading.Lock()
+_state = {'buckets': None, 'slots': None}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """
+        Takes a token and returns 0, or returns the seconds until one is available
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BucketTable:
+    """
+    Token buckets by key, forgetting the least recently used keys past max_keys
+    """
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate, burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(now)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class DatabaseSlots:
+    """
+    Counts requests doing database work; reads stop short of the write reserve
+    """
+
+    def __init__(self, limit, write_reserve):
+        self.limit = limit
+        self.read_limit = max(limit - write_reserve, 1)
+        self.in_use = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, write, timeout):
+        limit = self.limit if write else self.read_limit
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.in_use >= limit:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_use += 1
+            self.peak = max(self.peak, self.in_use)
+            return True
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+
+def client_key():
+    return f'ip:{request.remote_addr}'
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _reject(status, message, retry_after):
+    response = jsonify({'success': False, 'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def stats():
+    slots = _state['slots']
+    with _stats_lock:
+        counts = dict(_stats)
+    if slots is None:
+        return counts
+    return dict(
+        counts,
+        db_in_use=slots.in_use,
+        db_limit=slots.limit,
+        db_read_limit=slots.read_limit,
+        db_peak=slots.peak,
+        db_saturation=round(slots.in_use / slots.limit, 3),
+        tracked_clients=len(_state['buckets']),
+    )
+
+
+def init_app(app):
+    app.config.setdefault('ADMISSION_ENABLED', True)
+    # (tokens per second, burst) for all of one client's requests
+    app.config.setdefault('RATE_LIMIT_DEFAULT', (20, 60))
+    # endpoint name -> (tokens per second, burst) for one client's calls to that endpoint
+    app.config.setdefault('RATE_LIMIT_ROUTES', {
+        'get_admin_stats': (0.5, 5),
+        'get_stats': (1, 10),
+        'get_shipments': (5, 20),
+        'get_tracking_events': (5, 20),
+        'get_shipments_series': (0.5, 5),
+        'search_route': (5, 20),
+        'graphql_route': (5, 20),
+        'batch_route': (2, 10),
+    })
+    app.config.setdefault('RATE_LIMIT_MAX_CLIENTS', 10000)
+    # Concurrent database requests per worker, and how many of them only writes may use
+    app.config.setdefault('DB_MAX_CONCURRENCY', 16)
+    app.config.setdefault('DB_WRITE_RESERVE', 4)
+    app.config.setdefault('DB_ADMISSION_WAIT_SECONDS', 0.05)
+
+    _state['buckets'] = BucketTable(app.config['RATE_LIMIT_MAX_CLIENTS'])
+    _state['slots'] = DatabaseSlots(app.config['DB_MAX_CONCURRENCY'], app.config['DB_WRITE_RESERVE'])
+
+    @app.before_request
+    def _admit():
+        if not app.config['ADMISSION_ENABLED'] or request.method == 'OPTIONS':
+            return None
+        if request.endpoint is None or request.endpoint in _EXEMPT_ENDPOINTS:
+            return None
+
+        key = client_key()
+        rate, burst = app.config['RATE_LIMIT_DEFAULT']
+        wait = _state['buckets'].take(key, rate, burst) or take_route_token(app.config, key, request.endpoint)
+        if wait:
+            _count('rate_limited')
+            return _reject(429, 'Too many requests', wait)
+
+        if not acquire_slot(app.config, request.method in WRITE_METHODS):
+            return _reject(503, 'Server is busy, retry shortly', 1)
+        g.admission_slot = True
+        return None
+
+    @app.teardown_request
+    def _release(exc):
+        if g.pop('admission_slot', False):
+            release_slot()
+
+
+def take_route_token(config, key, endpoint):
+    """
+    Charges one call to endpoint against the client's bucket for that route, if it has one;
+    returns 0 or the seconds until a token is available
+    """
+    route_limit = config['RATE_LIMIT_ROUTES'].get(endpoint)
+    if not route_limit:
+        return 0
+    return _state['buckets'].take((key, endpoint), *route_limit)
+
+
+def acquire_slot(config, write):
+    if _state['slots'].acquire(write, config['DB_ADMISSION_WAIT_SECONDS']):
+        return True
+    _count('shed')
+    return False
+
+
+def release_slot():
+    _state['slots'].release()
+
+
+def admit_subrequest(config, key, own_connection):
+    """
+    Admission for one batch sub-request, called in its request context. The batch itself
+    already paid the client's overall token and holds a slot, so a sub-request is charged to
+    its route's bucket (when key is given) and, if it runs on a connection of its own, takes
+    a slot of its own. Returns (rejection, holds_slot): rejection is None or (status, error,
+    retry_after), and a caller holding a slot gives it back with release_slot()
+    """
+    if not config['ADMISSION_ENABLED'] or _state['slots'] is None:
+        return None, False
+    if request.endpoint is None or request.endpoint in _EXEMPT_ENDPOINTS:
+        return None, False
+
+    if key is not None:
+        wait = take_route_token(config, key, request.endpoint)
+        if wait:
+            _count('rate_limited')
+            return (429, 'Too many requests', max(1, math.ceil(wait))), False
+
+    if not own_connection:
+        return None, False
+    if not acquire_slot(config, request.method in WRITE_METHODS):
+        return (503, 'Server is busy, retry shortly', 1), False
+    return None, True
@@ -1,12 +1,47 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from flask_mysqldb import MySQL
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
+import json
 import os
 from datetime import datetime
 from datetime import datetime, timedelta
+import admission
+import archive
+import batch
+import compliance
+import compression
+import delays
+import distance_matrix
+import eta_model
+import fieldsets
+import filters
+import graphql_schema
+import health
+import idempotency
+import outbox
+import profiling
+import response_cache
+import rollups
+import scheduler
+import scorecards
+import search
+import slow_queries
+import structured_log
+import time_budgets
+import tracking_numbers
+import warmup
+from db_cursor import InstrumentedDictCursor
+from db_errors import is_duplicate_key
+from idempotency import idempotent
+from response_cache import cached_response
+from schema_utils import create_schema_version_table, ensure_index, record_schema_version
+from time_budgets import time_budget
 
 app = Flask(__name__)
-CORS(app)
+# Let the browser read paging and tracing headers
+CORS(app, expose_headers=['X-Has-More', 'X-Request-ID', 'Idempotent-Replayed', 'Retry-After', 'X-Profile-Id'])
 
 # MySQL Configuration
 app.config['MYSQL_HOST'] = 'localhost'  # or your host
@@ -14,9 +49,133 @@ app.config['MYSQL_USER'] = 'logistics_admin'  # your username
 app.config['MYSQL_PASSWORD'] = 'Admin@Secure123'  # your password
 app.config['MYSQL_DB'] = 'transport_logistics'  # your database name
 app.config['MYSQL_CURSORCLASS'] = 'DictCursor'  # Important for getting dictionaries
+# Same dictionary rows, plus per-statement timing tied to the request id
+app.config['MYSQL_CUSTOM_OPTIONS'] = {'cursorclass': InstrumentedDictCursor}
+
+# Memory-mapped distance matrix files, one per locations version
+app.config['DISTANCE_MATRIX_DIR'] = os.environ.get(
+    'DISTANCE_MATRIX_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'distance_matrix')
+)
+
+# Load balancers or proxies in front of the app that append to X-Forwarded-For; the client
+# address (and so its rate limit bucket) is taken from that many hops back. 0 trusts no header.
+app.config['PROXY_FIX_X_FOR'] = int(os.environ.get('PROXY_FIX_X_FOR', 0))
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+# Limits checked before a GraphQL query runs
+app.config['GRAPHQL_MAX_DEPTH'] = 8
+app.config['GRAPHQL_MAX_COMPLEXITY'] = 5000
+
+# POST /api/batch: sub-requests per call, and threads used for parallel GETs
+app.config['BATCH_MAX_REQUESTS'] = 20
+app.config['BATCH_MAX_WORKERS'] = 4
 
 mysql = MySQL(app)
 
+# JSON-lines logging written by a background thread; request threads never block on it
+structured_log.init_app(app)
+log = structured_log.get_logger()
+
+# Per-client rate limits and a cap on concurrent database work, checked before any view runs
+admission.init_app(app)
+
+# SQL time budgets for report-style endpoints (MAX_EXECUTION_TIME hints, KILL QUERY otherwise)
+time_budgets.init_app(app, mysql)
+
+# Thresholds behind /readyz
+health.init_app(app)
+
+# Statements over SLOW_QUERY_MS, grouped by normalized SQL with an EXPLAIN of each
+slow_queries.init_app(app)
+
+# cProfile/tracemalloc for requests with a valid X-Profile header, or a sampled share of them
+profiling.init_app(app)
+
+# Negotiated gzip/deflate/br for large JSON, plus a versioned cache of rendered responses
+compression.init_app(app)
+response_cache.init_app(app, mysql)
+
+# Idempotency-Key handling for create endpoints
+idempotency.init_app(app, mysql)
+
+# Transit time model fitted on delivered shipments, refreshed incrementally per worker
+eta_model.init_app(app)
+
+# Change events written with each mutation, relayed to caches, SSE clients and webhooks
+outbox.init_app(app, mysql)
+
+# Periodic 'delay' tracking events for shipments past their ETA without recent updates
+delays.init_app(app)
+
+# Licence and inspection expiry windows
+compliance.init_app(app)
+
+# Recurring maintenance jobs, each run by one worker at a time (registered below)
+scheduler.init_app(app, mysql)
+
+def invalidate_caches(events):
+    # Another worker's reference data change: stop trusting this process's cached versions
+    aggregate_types = {event['aggregate_type'] for event in events}
+    if aggregate_types & {'location', 'route'}:
+        response_cache.invalidate_local()
+    if 'location' in aggregate_types:
+        distance_matrix.invalidate_version()
+
+outbox.subscribe('cache', invalidate_caches)
+
+def refresh_scorecards(events):
+    # Runs on the relay thread; a short-lived connection keeps each refresh on a fresh snapshot
+    connection = mysql.connect
+    try:
+        cur = connection.cursor()
+        drivers = scorecards.affected_drivers(cur, events)
+        if drivers:
+            scorecards.refresh_drivers(cur, connection, drivers)
+        cur.close()
+    finally:
+        connection.close()
+
+outbox.subscribe('scorecards', refresh_scorecards, durable=True)
+
+scheduler.register(
+    'delay-sweep', lambda cur, connection: delays.sweep(cur, connection, app.config),
+    every=app.config['DELAY_SWEEP_INTERVAL_SECONDS'], jitter_seconds=30, timeout_seconds=120
+)
+scheduler.register(
+    'check-expiries', lambda cur, connection: compliance.check_expiries(cur, connection, app.config),
+    cron='0 6 * * *', jitter_seconds=300
+)
+# Rollups are kept by triggers; rebuilding the last week repairs anything they missed
+scheduler.register(
+    'rollups-backfill',
+    lambda cur, connection: rollups.backfill(cur, connection, datetime.now().date() - timedelta(days=7)),
+    cron='30 2 * * *', jitter_seconds=300, timeout_seconds=1800
+)
+# Off until enabled with SCHEDULER_JOB_OVERRIDES = {'archive-shipments': {'enabled': True}}
+scheduler.register(
+    'archive-shipments', lambda cur, connection: archive.archive_closed_shipments(cur, connection, months=12),
+    cron='0 3 * * *', jitter_seconds=300, timeout_seconds=3600, enabled=False
+)
+# Moves every driver's windows forward, including drivers without new activity
+scheduler.register(
+    'refresh-scorecards', lambda cur, connection: {'drivers': scorecards.refresh_all(cur, connection)},
+    cron='15 4 * * *', jitter_seconds=300, timeout_seconds=1800
+)
+scheduler.register(
+    'purge-idempotency-keys', lambda cur, connection: {'removed': idempotency.purge_expired(cur, connection)},
+    cron='5 * * * *', jitter_seconds=120
+)
+scheduler.register(
+    'purge-outbox-events',
+    lambda cur, connection: {'removed': outbox.purge_events(cur, connection, app.config['OUTBOX_RETENTION_DAYS'])},
+    cron='50 3 * * *', jitter_seconds=300, timeout_seconds=1800
+)
+
+# Reference data, stats and the busiest dashboards requested once per process before /readyz passes
+warmup.init_app(app, mysql)
+
 # Initialize stored procedures and complex queries
 def initialize_stored_procedures():
     try:
@@ -146,12 +305,68 @@ def initialize_stored_procedures():
         )
         """)
 
+        # Monthly partitioned archive tables for closed shipments
+        archive.create_archive_tables(cur)
+
+        # Daily rollup table and the triggers that keep it current; a new table is filled from all history
+        if rollups.create_rollup_objects(cur):
+            result = rollups.backfill(cur, mysql.connection)
+            log.info("Rollups backfilled", extra=result)
+
+        # Versions of reference tables behind the response cache
+        response_cache.create_version_table(cur)
+        
+        # Stored responses for retried create requests
+        idempotency.create_idempotency_table(cur)
+        
+        # Block-allocated sequence behind generated tracking numbers
+        tracking_numbers.create_sequence_table(cur)
+        
+        # Change events and relay checkpoints
+        outbox.create_outbox_tables(cur)
+        
+        # Rolling-window driver scorecards
+        scorecards.create_scorecard_table(cur)
+        
+        # Deliveries read by incremental ETA refits
+        eta_model.create_eta_indexes(cur)
+        
+        # Shipments already flagged as delayed, the sweep position and the overdue scan index
+        delays.create_delay_tables(cur)
+        
+        # Licence/inspection alerts already sent
+        compliance.create_compliance_table(cur)
+        
+        # Scheduled job state and run history
+        scheduler.create_scheduler_tables(cur)
+
+        # Date range filters on the live tables
+        ensure_index(cur, 'shipments', 'idx_shipments_created_at', 'created_at')
+        ensure_index(cur, 'tracking_events', 'idx_tracking_events_timestamp', 'event_timestamp')
+        
+        # Server-side list filters: equality column first, then the default sort column
+        ensure_index(cur, 'shipments', 'idx_shipments_status_created', 'status, created_at')
+        ensure_index(cur, 'shipments', 'idx_shipments_customer_created', 'customer_id, created_at')
+        ensure_index(cur, 'shipments', 'idx_shipments_driver_created', 'driver_id, created_at')
+        ensure_index(cur, 'shipments', 'idx_shipments_pickup_date', 'pickup_date')
+        ensure_index(cur, 'shipments', 'idx_shipments_estimated_delivery', 'estimated_delivery')
+        ensure_index(cur, 'tracking_events', 'idx_tracking_events_shipment_time', 'shipment_id, event_timestamp')
+        ensure_index(cur, 'tracking_events', 'idx_tracking_events_type_time', 'event_type, event_timestamp')
+        ensure_index(cur, 'tracking_events', 'idx_tracking_events_location_time', 'location_id, event_timestamp')
+        
+        # FULLTEXT indexes behind /api/search
+        search.create_search_indexes(cur)
+        
+        # Last: record that this code's schema changes are in place (checked by /readyz)
+        create_schema_version_table(cur)
+        record_schema_version(cur)
+
         mysql.connection.commit()
         cur.close()
-        print("Stored procedures initialized successfully.")
+        log.info("Stored procedures initialized successfully.")
         return True
-    except Exception as e:
-        print(f"Error initializing stored procedures: {e}")
+    except Exception:
+        log.exception("Error initializing stored procedures")
         return False
 
 # Replace deprecated before_first_request with a proper setup pattern
@@ -168,17 +383,25 @@ with app.app_context():
 def home():
     return "Flask server is running!"
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify(health.liveness())
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    payload, ready = health.readiness(lambda: mysql.connection, app.config)
+    response = jsonify(payload)
+    response.status_code = 200 if ready else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/api/login', methods=['POST'])
 def login():
-    print("Received login request")  # Debug print
     data = request.get_json()
-    print(f"Request data: {data}")  # Debug print
     
     username = data.get('username')
     password = data.get('password')
     
-    print(f"Login attempt for username: {username}")  # Debug print
-    
     try:
         cur = mysql.connection.cursor()
         # First get the user with their password
@@ -191,7 +414,7 @@ def login():
         cur.close()
         
         if user:
-            print(f"Login successful for user: {username}")  # Debug print
+            log.info("Login successful", extra={'user_id': user['user_id']})
             return jsonify({
                 'success': True,
                 'user': {
@@ -202,18 +425,20 @@ def login():
                 }
             })
         else:
-            print(f"Login failed for user: {username}")  # Debug print
+            log.info("Login failed")
             return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
-    except Exception as e:
-        print(f"Error during login: {str(e)}")  # Debug print
+    except Exception:
+        log.exception("Error during login")
         return jsonify({'success': False, 'message': 'Server error'}), 500
 
 @app.route('/api/stats', methods=['GET'])
+@cached_response(ttl=15)
+@time_budget(2000)
 def get_stats():
     cur = mysql.connection.cursor()
     
-    # Get shipment count (fixing status filter to match enum values)
-    cur.execute("SELECT COUNT(*) as count FROM shipments WHERE status != 'delivered'")
+    # Get shipment count (fixing status filter to match enum values); returned shipments may be archived
+    cur.execute(f"SELECT COUNT(*) as count FROM {archive.SHIPMENTS_WITH_ARCHIVE} s WHERE s.status != 'delivered'")
     shipments = cur.fetchone()['count']
     
     # Get available vehicles (fixing status filter to match enum values)
@@ -238,7 +463,16 @@ def get_stats():
     })
 
 @app.route('/api/shipments', methods=['GET'])
+@time_budget(5000)
 def get_shipments():
+    try:
+        fields = fieldsets.SHIPMENT_LIST.parse(request.args.get('fields'))
+        where_clauses, params = filters.shipment_filters(request.args)
+        order_by = filters.order_by(request.args, filters.SHIPMENT_SORT_KEYS, '-created_at', 's.shipment_id')
+        limit, offset = filters.pagination(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         cur = mysql.connection.cursor()
         
@@ -246,27 +480,16 @@ def get_shipments():
         user_id = request.args.get('user_id')
         user_type = request.args.get('user_type')
         
-        # Base query with proper joins
-        query = """
-            SELECT s.*, 
-                   c.company_name,
-                   CONCAT(o.city, ', ', o.state) as origin,
-                   CONCAT(d.city, ', ', d.state) as destination,
-                   u.full_name as driver_name,
-                   v.license_plate,
-                   dr.driver_id,
-                   c.customer_id
-            FROM shipments s
-            LEFT JOIN customers c ON s.customer_id = c.customer_id
-            LEFT JOIN locations o ON s.origin_id = o.location_id
-            LEFT JOIN locations d ON s.destination_id = d.location_id
-            LEFT JOIN drivers dr ON s.driver_id = dr.driver_id
-            LEFT JOIN users u ON dr.user_id = u.user_id
-            LEFT JOIN vehicles v ON s.vehicle_id = v.vehicle_id
-        """
+        # Older closed shipments live in the archive and are only read when asked for
+        shipments_table = archive.SHIPMENTS_WITH_ARCHIVE if archive.wants_archive(request.args) else 'shipments'
         
-        params = []
-        where_clauses = []
+        # Only the joins the requested fields need
+        columns, joins = fieldsets.SHIPMENT_LIST.select(fields)
+        query = f"""
+            SELECT {columns}
+            FROM {shipments_table} s
+            {joins}
+        """
         
         # Filter by user_id and user_type if provided
         if user_id and user_type:
@@ -289,12 +512,15 @@ def get_shipments():
         if where_clauses:
             query += " WHERE " + " AND ".join(where_clauses)
         
-        # Add order by
-        query += " ORDER BY s.created_at DESC"
+        # Add order by and the requested page
+        query += order_by
+        query, params = filters.apply_pagination(query, params, limit, offset)
         
         # Execute query with parameters
         cur.execute(query, params)
-        shipments = cur.fetchall()
+        shipments = list(cur.fetchall())
+        has_more = limit is not None and len(shipments) > limit
+        shipments = shipments[:limit]
         
         # Process results
         for shipment in shipments:
@@ -309,9 +535,12 @@ def get_shipments():
                 shipment['actual_delivery'] = shipment['actual_delivery'].isoformat() if shipment['actual_delivery'] else None
         
         cur.close()
-        return jsonify(shipments)
+        response = jsonify(shipments)
+        if limit is not None:
+            response.headers['X-Has-More'] = 'true' if has_more else 'false'
+        return response
     except Exception as e:
-        print(f"Error in get_shipments: {e}")
+        log.exception("Error in get_shipments")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/shipments/<int:id>', methods=['DELETE'])
@@ -319,6 +548,8 @@ def delete_shipment(id):
     cur = mysql.connection.cursor()
     try:
         cur.execute("DELETE FROM shipments WHERE shipment_id = %s", (id,))
+        if cur.rowcount:
+            outbox.record(cur, 'shipment', id, 'shipment.deleted')
         mysql.connection.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -328,11 +559,16 @@ def delete_shipment(id):
         cur.close()
 
 @app.route('/api/shipments', methods=['POST'])
+@idempotent
 def create_shipment():
     cur = mysql.connection.cursor()
     try:
         data = request.get_json()
         
+        # Generate a tracking number when the caller doesn't bring one
+        if not data.get('tracking_number'):
+            data['tracking_number'] = tracking_numbers.next_number(mysql)
+        
         # Insert the shipment
         cur.execute("""
             INSERT INTO shipments (
@@ -358,8 +594,6 @@ def create_shipment():
             data.get('pickup_date'),
             data.get('estimated_delivery')
         ))
-        
-        mysql.connection.commit()
         shipment_id = cur.lastrowid
         
         # If a vehicle is assigned, update its status
@@ -369,36 +603,39 @@ def create_shipment():
         # If a driver is assigned, update their status
         if data.get('driver_id'):
             cur.execute("UPDATE drivers SET status = 'assigned' WHERE driver_id = %s", (data.get('driver_id'),))
-            
+        
+        outbox.record(cur, 'shipment', shipment_id, 'shipment.created', shipment_payload(data))
         mysql.connection.commit()
         
-        return jsonify({'success': True, 'shipment_id': shipment_id})
+        return jsonify({'success': True, 'shipment_id': shipment_id, 'tracking_number': data['tracking_number']})
         
     except Exception as e:
         mysql.connection.rollback()
+        if is_duplicate_key(e, 'tracking_number'):
+            return jsonify({'success': False, 'error': 'Tracking number already exists'}), 400
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         cur.close()
 
 @app.route('/api/shipments/create', methods=['POST'])
+@idempotent
 def create_shipment_endpoint():
     cur = mysql.connection.cursor()
     try:
         data = request.json
         
         # Validate required fields
-        required_fields = ['tracking_number', 'customer_id', 'origin_id', 'destination_id', 
+        required_fields = ['customer_id', 'origin_id', 'destination_id', 
                           'total_weight', 'total_volume', 'shipment_value']
         for field in required_fields:
             if field not in data or not data[field]:
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        # Check if tracking number already exists
-        cur.execute("SELECT * FROM shipments WHERE tracking_number = %s", (data['tracking_number'],))
-        if cur.fetchone():
-            return jsonify({'success': False, 'error': 'Tracking number already exists'}), 400
+        # Generate a tracking number when the caller doesn't bring one
+        if not data.get('tracking_number'):
+            data['tracking_number'] = tracking_numbers.next_number(mysql)
         
-        # Insert shipment
+        # Insert shipment; the unique key on tracking_number rejects duplicates
         query = """
             INSERT INTO shipments (
                 tracking_number, customer_id, origin_id, destination_id, route_id, vehicle_id, driver_id,
@@ -424,12 +661,11 @@ def create_shipment_endpoint():
             data.get('pickup_date'),
             data.get('estimated_delivery')
         ))
-        
-        mysql.connection.commit()
         shipment_id = cur.lastrowid
         
         # Create initial tracking event if shipment is not pending
         status = data.get('status', 'pending')
+        outbox.record(cur, 'shipment', shipment_id, 'shipment.created', dict(shipment_payload(data), status=status))
         if status != 'pending':
             event_type = 'pickup' if status == 'picked_up' else 'departure'
             cur.execute("""
@@ -442,16 +678,38 @@ def create_shipment_endpoint():
                 f'Initial {event_type} event for shipment {data["tracking_number"]}',
                 1  # Admin user
             ))
-            mysql.connection.commit()
+            outbox.record(cur, 'shipment', shipment_id, 'tracking_event.created', {
+                'event_id': cur.lastrowid, 'event_type': event_type, 'location_id': data['origin_id']
+            })
+            apply_warehouse_occupancy(cur, shipment_id, event_type, data['origin_id'])
+        mysql.connection.commit()
         
-        return jsonify({'success': True, 'shipment_id': shipment_id})
+        return jsonify({'success': True, 'shipment_id': shipment_id, 'tracking_number': data['tracking_number']})
     
     except Exception as e:
         mysql.connection.rollback()
+        if is_duplicate_key(e, 'tracking_number'):
+            return jsonify({'success': False, 'error': 'Tracking number already exists'}), 400
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         cur.close()
 
+@app.route('/api/tracking-numbers', methods=['POST'])
+def allocate_tracking_numbers():
+    data = request.get_json(silent=True) or {}
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'count must be an integer'}), 400
+    if not 1 <= count <= tracking_numbers.MAX_BULK:
+        return jsonify({'success': False, 'error': f'count must be between 1 and {tracking_numbers.MAX_BULK}'}), 400
+    
+    try:
+        return jsonify({'success': True, 'tracking_numbers': tracking_numbers.allocate(mysql, count)})
+    except Exception as e:
+        log.exception("Error in allocate_tracking_numbers")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/shipments/<int:id>', methods=['PUT'])
 def update_shipment(id):
     cur = mysql.connection.cursor()
@@ -525,6 +783,10 @@ def update_shipment(id):
             if data.get('driver_id'):
                 cur.execute("UPDATE drivers SET status = 'assigned' WHERE driver_id = %s", (data.get('driver_id'),))
         
+        payload = shipment_payload(data)
+        if old_driver_id and old_driver_id != data.get('driver_id'):
+            payload['previous_driver_id'] = old_driver_id
+        outbox.record(cur, 'shipment', id, 'shipment.updated', payload)
         mysql.connection.commit()
         
         # Get the updated shipment details
@@ -549,6 +811,11 @@ def update_shipment(id):
 
 @app.route('/api/shipments/<int:id>', methods=['GET'])
 def get_shipment(id):
+    try:
+        fields = fieldsets.SHIPMENT_DETAIL.parse(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         cur = mysql.connection.cursor()
         
@@ -556,14 +823,20 @@ def get_shipment(id):
         user_id = request.args.get('user_id')
         user_type = request.args.get('user_type')
         
+        # Closed shipments may have been moved to the archive
+        tables = archive.shipment_tables(cur, id)
+        if not tables:
+            return jsonify({"error": "Shipment not found"}), 404
+        shipments_table = tables[0]
+        
         # Check if user has permission to view this shipment
         if user_id and user_type and user_type != 'admin':
             shipment_accessible = False
             
             if user_type == 'customer':
                 # Check if shipment belongs to this customer
-                cur.execute("""
-                    SELECT 1 FROM shipments s
+                cur.execute(f"""
+                    SELECT 1 FROM {shipments_table} s
                     JOIN customers c ON s.customer_id = c.customer_id
                     WHERE s.shipment_id = %s AND c.user_id = %s
                 """, [id, user_id])
@@ -571,8 +844,8 @@ def get_shipment(id):
                     shipment_accessible = True
             elif user_type == 'driver':
                 # Check if shipment is assigned to this driver
-                cur.execute("""
-                    SELECT 1 FROM shipments s
+                cur.execute(f"""
+                    SELECT 1 FROM {shipments_table} s
                     JOIN drivers d ON s.driver_id = d.driver_id
                     WHERE s.shipment_id = %s AND d.user_id = %s
                 """, [id, user_id])
@@ -583,21 +856,11 @@ def get_shipment(id):
                 return jsonify({"error": "You don't have permission to view this shipment"}), 403
         
         # Get the shipment details
-        cur.execute("""
-            SELECT s.*, 
-                   c.company_name,
-                   CONCAT(o.address, ', ', o.city, ', ', o.state, ' ', o.postal_code) as origin_address,
-                   CONCAT(d.address, ', ', d.city, ', ', d.state, ' ', d.postal_code) as destination_address,
-                   u.full_name as driver_name,
-                   v.license_plate,
-                   v.make, v.model, v.year
-            FROM shipments s
-            LEFT JOIN customers c ON s.customer_id = c.customer_id
-            LEFT JOIN locations o ON s.origin_id = o.location_id
-            LEFT JOIN locations d ON s.destination_id = d.location_id
-            LEFT JOIN drivers dr ON s.driver_id = dr.driver_id
-            LEFT JOIN users u ON dr.user_id = u.user_id
-            LEFT JOIN vehicles v ON s.vehicle_id = v.vehicle_id
+        columns, joins = fieldsets.SHIPMENT_DETAIL.select(fields)
+        cur.execute(f"""
+            SELECT {columns}
+            FROM {shipments_table} s
+            {joins}
             WHERE s.shipment_id = %s
         """, [id])
         
@@ -608,14 +871,16 @@ def get_shipment(id):
         cur.close()
         return jsonify(shipment)
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error in get_shipment")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/shipments/<int:id>/items', methods=['GET'])
 def get_shipment_items(id):
     cur = mysql.connection.cursor()
     try:
-        cur.execute("SELECT * FROM shipment_items WHERE shipment_id = %s", (id,))
+        tables = archive.shipment_tables(cur, id)
+        items_table = tables[2] if tables else 'shipment_items'
+        cur.execute(f"SELECT * FROM {items_table} WHERE shipment_id = %s", (id,))
         items = cur.fetchall()
         return jsonify(items)
     except Exception as e:
@@ -632,6 +897,10 @@ def get_shipment_events(id):
         user_id = request.args.get('user_id')
         user_type = request.args.get('user_type')
         
+        # Closed shipments may have been moved to the archive
+        tables = archive.shipment_tables(cur, id) or ('shipments', 'tracking_events', 'shipment_items')
+        shipments_table, events_table = tables[0], tables[1]
+        
         # Check if user has permission to view this shipment
         if user_id and user_type:
             shipment_accessible = False
@@ -641,8 +910,8 @@ def get_shipment_events(id):
                 shipment_accessible = True
             elif user_type == 'customer':
                 # Check if shipment belongs to this customer
-                cur.execute("""
-                    SELECT 1 FROM shipments s
+                cur.execute(f"""
+                    SELECT 1 FROM {shipments_table} s
                     JOIN customers c ON s.customer_id = c.customer_id
                     WHERE s.shipment_id = %s AND c.user_id = %s
                 """, [id, user_id])
@@ -650,8 +919,8 @@ def get_shipment_events(id):
                     shipment_accessible = True
             elif user_type == 'driver':
                 # Check if shipment is assigned to this driver
-                cur.execute("""
-                    SELECT 1 FROM shipments s
+                cur.execute(f"""
+                    SELECT 1 FROM {shipments_table} s
                     JOIN drivers d ON s.driver_id = d.driver_id
                     WHERE s.shipment_id = %s AND d.user_id = %s
                 """, [id, user_id])
@@ -662,11 +931,11 @@ def get_shipment_events(id):
                 return jsonify({"error": "You don't have permission to view this shipment"}), 403
         
         # Query the events
-        cur.execute("""
+        cur.execute(f"""
             SELECT e.*, 
                    l.city, l.state, l.address,
                    u.full_name as recorded_by_name
-            FROM tracking_events e
+            FROM {events_table} e
             LEFT JOIN locations l ON e.location_id = l.location_id
             LEFT JOIN users u ON e.recorded_by = u.user_id
             WHERE e.shipment_id = %s
@@ -677,7 +946,7 @@ def get_shipment_events(id):
         cur.close()
         return jsonify(events)
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error in get_shipment_events")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/vehicles', methods=['GET'])
@@ -713,6 +982,8 @@ def delete_vehicle(id):
     cur = mysql.connection.cursor()
     try:
         cur.execute("DELETE FROM vehicles WHERE vehicle_id = %s", (id,))
+        if cur.rowcount:
+            outbox.record(cur, 'vehicle', id, 'vehicle.deleted')
         mysql.connection.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -753,6 +1024,9 @@ def update_vehicle(id):
             id
         ))
         
+        outbox.record(cur, 'vehicle', id, 'vehicle.updated', {
+            'status': data['status'], 'current_location_id': data.get('current_location_id')
+        })
         mysql.connection.commit()
         
         # Fetch the updated vehicle
@@ -789,6 +1063,7 @@ def get_customers():
     return jsonify(customers)
 
 @app.route('/api/customers', methods=['POST'])
+@idempotent
 def create_customer():
     cur = mysql.connection.cursor()
     try:
@@ -956,21 +1231,18 @@ def get_drivers():
             })
 
         except Exception as mysql_error:
-            print("MySQL Error Details:")
-            print(f"Error Type: {type(mysql_error).__name__}")
-            print(f"Error Message: {str(mysql_error)}")
+            log.exception("MySQL error in get_drivers")
             return jsonify({'error': f'Database error: {str(mysql_error)}'}), 500
             
         finally:
             cur.close()
 
     except Exception as e:
-        print("General Error Details:")
-        print(f"Error Type: {type(e).__name__}")
-        print(f"Error Message: {str(e)}")
+        log.exception("Error in get_drivers")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 @app.route('/api/drivers', methods=['POST'])
+@idempotent
 def create_driver():
     cur = mysql.connection.cursor()
     try:
@@ -1001,9 +1273,10 @@ def create_driver():
             data['training_certification'],
             data['status']
         ))
+        driver_id = cur.lastrowid
         
+        outbox.record(cur, 'driver', driver_id, 'driver.created', {'user_id': user_id, 'status': data['status']})
         mysql.connection.commit()
-        driver_id = cur.lastrowid
         
         # Fetch and return the newly created driver
         cur.execute("""
@@ -1075,6 +1348,7 @@ def update_driver(id):
             id
         ))
         
+        outbox.record(cur, 'driver', id, 'driver.updated', {'user_id': user_id, 'status': data['status']})
         mysql.connection.commit()
         
         # Fix: Escape the % character by doubling it (%%) to prevent Python from treating it as a format specifier
@@ -1130,6 +1404,7 @@ def delete_driver(id):
         # Delete from users table
         cur.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
         
+        outbox.record(cur, 'driver', id, 'driver.deleted', {'user_id': user_id})
         mysql.connection.commit()
         return jsonify({'success': True})
     except Exception as e:
@@ -1139,6 +1414,7 @@ def delete_driver(id):
         cur.close()
 
 @app.route('/api/locations', methods=['GET'])
+@cached_response(versions=('locations',))
 def get_locations():
     cur = mysql.connection.cursor()
     try:
@@ -1182,9 +1458,14 @@ def update_location(id):
             data['location_type'],
             id
         ))
+        outbox.record(cur, 'location', id, 'location.updated')
+        response_cache.bump(cur, 'locations')
         
         mysql.connection.commit()
         
+        # Coordinates may have changed, so the next lookup re-checks the matrix version
+        distance_matrix.invalidate_version()
+        
         # Fetch the updated location
         cur.execute("SELECT * FROM locations WHERE location_id = %s", (id,))
         updated_location = cur.fetchone()
@@ -1196,12 +1477,214 @@ def update_location(id):
     finally:
         cur.close()
 
+@app.route('/api/events/stream', methods=['GET'])
+def stream_events():
+    aggregate_type = request.args.get('aggregate_type')
+    try:
+        aggregate_id = request.args.get('aggregate_id', type=int)
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID must be an integer'}), 400
+    
+    def matches(event):
+        return ((not aggregate_type or event['aggregate_type'] == aggregate_type)
+                and (aggregate_id is None or event['aggregate_id'] == aggregate_id))
+    
+    # Subscribe before reading the backlog so nothing committed in between is missed
+    client = outbox.broadcaster.connect(app.config['SSE_QUEUE_SIZE'], app.config['SSE_MAX_CLIENTS'])
+    if client is None:
+        response = jsonify({'error': 'Too many open event streams, retry shortly'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    backlog = []
+    backlog_size = app.config['SSE_BACKLOG_SIZE']
+    if last_event_id:
+        cur = mysql.connection.cursor()
+        try:
+            backlog = outbox.fetch_events(cur, last_event_id, backlog_size + 1, aggregate_type, aggregate_id)
+        except Exception as e:
+            outbox.broadcaster.disconnect(client)
+            log.exception("Error in stream_events")
+            return jsonify({'error': str(e)}), 500
+        finally:
+            cur.close()
+    
+    return Response(
+        outbox.stream(
+            backlog[:backlog_size], client, app.config['SSE_HEARTBEAT_SECONDS'], matches,
+            app.config['SSE_MAX_STREAM_SECONDS'], more=len(backlog) > backlog_size
+        ),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/outbox/events', methods=['GET'])
+def get_outbox_events():
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = min(max(int(request.args.get('limit', 100)), 1), filters.MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'after_id and limit must be integers'}), 400
+    
+    cur = mysql.connection.cursor()
+    try:
+        events = outbox.fetch_events(
+            cur, after_id, limit,
+            request.args.get('aggregate_type'), request.args.get('aggregate_id', type=int)
+        )
+        return jsonify({'events': events, 'last_event_id': events[-1]['event_id'] if events else after_id})
+    except Exception as e:
+        log.exception("Error in get_outbox_events")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/batch', methods=['POST'])
+def batch_route():
+    data = request.get_json(silent=True)
+    try:
+        items = batch.parse_requests(data, app.config['BATCH_MAX_REQUESTS'])
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    results = batch.run(
+        app,
+        items,
+        request.headers,
+        parallel=bool(data.get('parallel')),
+        max_workers=app.config['BATCH_MAX_WORKERS'],
+        client=admission.client_key()
+    )
+    return jsonify({'responses': results})
+
+@app.route('/graphql', methods=['GET', 'POST'])
+@time_budget(5000)
+def graphql_route():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        query = data.get('query')
+        variables = data.get('variables')
+        operation_name = data.get('operationName')
+    else:
+        query = request.args.get('query')
+        variables = None
+        operation_name = request.args.get('operationName')
+        if request.args.get('variables'):
+            try:
+                variables = json.loads(request.args['variables'])
+            except ValueError:
+                return jsonify({'errors': [{'message': 'variables must be a JSON object'}]}), 400
+    
+    try:
+        payload, status = graphql_schema.execute(
+            query,
+            lambda: mysql.connection.cursor(),
+            variables=variables,
+            operation_name=operation_name,
+            max_depth=app.config['GRAPHQL_MAX_DEPTH'],
+            max_complexity=app.config['GRAPHQL_MAX_COMPLEXITY']
+        )
+        return jsonify(payload), status
+    except Exception as e:
+        log.exception("Error in graphql_route")
+        return jsonify({'errors': [{'message': str(e)}]}), 500
+
+@app.route('/api/search', methods=['GET'])
+@time_budget(2000)
+def search_route():
+    q = request.args.get('q', '').strip()
+    if len(q) < 2:
+        return jsonify({'error': 'q must be at least 2 characters'}), 400
+    
+    types = [t.strip() for t in request.args.get('types', ','.join(search.SEARCH_TYPES)).split(',') if t.strip()]
+    unknown = [t for t in types if t not in search.SEARCH_TYPES]
+    if unknown:
+        return jsonify({'error': f"Unknown type '{unknown[0]}'. Allowed types: {', '.join(search.SEARCH_TYPES)}"}), 400
+    
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 50)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    cur = mysql.connection.cursor()
+    try:
+        hits = search.search(cur, q, types, limit)
+        return jsonify({'query': q, 'hits': hits})
+    except Exception as e:
+        log.exception("Error in search_route")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+# Helper function to parse comma separated id lists from query parameters
+def parse_id_list(value):
+    if not value:
+        return []
+    return [int(v) for v in value.split(',') if v.strip()]
+
+@app.route('/api/distance-matrix', methods=['GET'])
+def get_distance_matrix():
+    cur = mysql.connection.cursor()
+    try:
+        try:
+            origin_ids = parse_id_list(request.args.get('from'))
+            dest_ids = parse_id_list(request.args.get('to')) or origin_ids
+        except ValueError:
+            return jsonify({'success': False, 'error': 'from and to must be comma separated location ids'}), 400
+        
+        if not origin_ids:
+            return jsonify({'success': False, 'error': 'Missing required parameter: from'}), 400
+        if len(origin_ids) * len(dest_ids) > 250000:
+            return jsonify({'success': False, 'error': 'Requested block is too large'}), 400
+        
+        distances, source = distance_matrix.get_distances(
+            cur, app.config['DISTANCE_MATRIX_DIR'], origin_ids, dest_ids
+        )
+        return jsonify({
+            'from': origin_ids,
+            'to': dest_ids,
+            'distances_km': distance_matrix.to_json_rows(distances),
+            'source': source
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/distance-matrix/build', methods=['POST'])
+def build_distance_matrix_route():
+    cur = mysql.connection.cursor()
+    try:
+        result = distance_matrix.build_matrix(cur, app.config['DISTANCE_MATRIX_DIR'])
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.cli.command('build-distance-matrix')
+def build_distance_matrix_command():
+    cur = mysql.connection.cursor()
+    try:
+        result = distance_matrix.build_matrix(cur, app.config['DISTANCE_MATRIX_DIR'])
+        click.echo(f"Distance matrix {result['version']}: {result['locations']} locations in {result['elapsed_ms']} ms")
+    finally:
+        cur.close()
+
+# current_occupancy holds the net of every arrival and departure, which can dip below zero
+# while events arrive out of order; reads clamp it
+OCCUPANCY = "GREATEST(COALESCE(w.current_occupancy, 0), 0)"
+WAREHOUSE_COLUMNS = (
+    "w.warehouse_id, w.location_id, w.warehouse_name, w.capacity, "
+    f"{OCCUPANCY} as current_occupancy, w.manager_id, w.operating_hours"
+)
+
 @app.route('/api/warehouses', methods=['GET'])
 def get_warehouses():
     cur = mysql.connection.cursor()
     try:
-        cur.execute("""
-            SELECT w.*, 
+        cur.execute(f"""
+            SELECT {WAREHOUSE_COLUMNS},
                    CONCAT(l.city, ', ', l.state) as location,
                    u.full_name as manager_name
             FROM warehouses w
@@ -1216,12 +1699,58 @@ def get_warehouses():
     finally:
         cur.close()
 
+@app.route('/api/warehouses/near-capacity', methods=['GET'])
+def get_warehouses_near_capacity():
+    cur = mysql.connection.cursor()
+    try:
+        threshold = float(request.args.get('threshold', 0.9))
+        cur.execute(f"""
+            SELECT {WAREHOUSE_COLUMNS},
+                   CONCAT(l.city, ', ', l.state) as location,
+                   ROUND({OCCUPANCY} / w.capacity, 4) as utilization
+            FROM warehouses w
+            LEFT JOIN locations l ON w.location_id = l.location_id
+            WHERE w.capacity > 0 AND {OCCUPANCY} >= w.capacity * %s
+            ORDER BY utilization DESC
+        """, (threshold,))
+        warehouses = cur.fetchall()
+        return jsonify(warehouses)
+    except ValueError:
+        return jsonify({'error': 'threshold must be a number'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/warehouses/rebuild-occupancy', methods=['POST'])
+def rebuild_warehouse_occupancy_route():
+    cur = mysql.connection.cursor()
+    try:
+        updated = rebuild_warehouse_occupancy(cur)
+        mysql.connection.commit()
+        return jsonify({'success': True, 'updated': updated})
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.cli.command('rebuild-occupancy')
+def rebuild_occupancy_command():
+    cur = mysql.connection.cursor()
+    try:
+        updated = rebuild_warehouse_occupancy(cur)
+        mysql.connection.commit()
+        click.echo(f"Recomputed occupancy for {updated} warehouse(s)")
+    finally:
+        cur.close()
+
 @app.route('/api/warehouses/<int:id>', methods=['GET'])
 def get_warehouse(id):
     cur = mysql.connection.cursor()
     try:
-        cur.execute("""
-            SELECT w.*, 
+        cur.execute(f"""
+            SELECT {WAREHOUSE_COLUMNS},
                    CONCAT(l.city, ', ', l.state) as location,
                    u.full_name as manager_name
             FROM warehouses w
@@ -1239,6 +1768,7 @@ def get_warehouse(id):
         cur.close()
 
 @app.route('/api/warehouses', methods=['POST'])
+@idempotent
 def create_warehouse():
     cur = mysql.connection.cursor()
     try:
@@ -1250,12 +1780,7 @@ def create_warehouse():
             if field not in data or not data[field]:
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400
         
-        # Check if location is already used by another warehouse
-        cur.execute("SELECT 1 FROM warehouses WHERE location_id = %s", (data['location_id'],))
-        if cur.fetchone():
-            return jsonify({'success': False, 'error': 'Location already has a warehouse'}), 400
-        
-        # Insert warehouse
+        # Insert warehouse; the unique key on location_id allows one warehouse per location
         query = """
             INSERT INTO warehouses 
             (location_id, warehouse_name, capacity, current_occupancy, manager_id, operating_hours)
@@ -1276,6 +1801,8 @@ def create_warehouse():
     
     except Exception as e:
         mysql.connection.rollback()
+        if is_duplicate_key(e, 'location_id'):
+            return jsonify({'success': False, 'error': 'Location already has a warehouse'}), 400
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         cur.close()
@@ -1353,6 +1880,7 @@ def delete_warehouse(id):
         cur.close()
 
 @app.route('/api/routes', methods=['GET'])
+@cached_response(versions=('routes', 'locations'))
 def get_routes():
     cur = mysql.connection.cursor()
     try:
@@ -1375,6 +1903,7 @@ def get_routes():
         cur.close()
 
 @app.route('/api/routes', methods=['POST'])
+@idempotent
 def create_route():
     cur = mysql.connection.cursor()
     try:
@@ -1401,9 +1930,11 @@ def create_route():
             data.get('status', 'active'),
             data.get('hazard_level', 'low')
         ))
+        route_id = cur.lastrowid
+        outbox.record(cur, 'route', route_id, 'route.created')
+        response_cache.bump(cur, 'routes')
         
         mysql.connection.commit()
-        route_id = cur.lastrowid
         return jsonify({'success': True, 'route_id': route_id})
     
     except Exception as e:
@@ -1450,6 +1981,8 @@ def update_route(id):
         
         query = "UPDATE routes SET " + ", ".join(update_fields) + " WHERE route_id = %s"
         cur.execute(query, params)
+        outbox.record(cur, 'route', id, 'route.updated')
+        response_cache.bump(cur, 'routes')
         
         mysql.connection.commit()
         return jsonify({'success': True})
@@ -1482,6 +2015,8 @@ def delete_route(id):
             
         # Delete route
         cur.execute("DELETE FROM routes WHERE route_id = %s", (id,))
+        outbox.record(cur, 'route', id, 'route.deleted')
+        response_cache.bump(cur, 'routes')
         mysql.connection.commit()
         return jsonify({'success': True})
     
@@ -1492,10 +2027,19 @@ def delete_route(id):
         cur.close()
 
 @app.route('/api/tracking-events', methods=['GET'])
+@time_budget(5000)
 def get_tracking_events():
+    try:
+        where_clauses, params = filters.event_filters(request.args)
+        order_by = filters.order_by(request.args, filters.EVENT_SORT_KEYS, '-event_timestamp', 'e.event_id')
+        limit, offset = filters.pagination(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     cur = mysql.connection.cursor()
+    events_table = archive.EVENTS_WITH_ARCHIVE if archive.wants_archive(request.args) else 'tracking_events'
     # Updated query with proper endpoint name and fields
-    cur.execute("""
+    query = f"""
         SELECT 
             e.event_id, 
             e.shipment_id, 
@@ -1505,15 +2049,25 @@ def get_tracking_events():
             e.event_timestamp,
             e.recorded_by,
             COALESCE(e.notes, '') as notes
-        FROM tracking_events e
+        FROM {events_table} e
         JOIN locations l ON e.location_id = l.location_id
-        ORDER BY e.event_timestamp DESC
-    """)
-    events = cur.fetchall()
+    """
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    query += order_by
+    query, params = filters.apply_pagination(query, params, limit, offset)
+    
+    cur.execute(query, params)
+    events = list(cur.fetchall())
     cur.close()
-    return jsonify(events)
+    
+    response = jsonify(events[:limit])
+    if limit is not None:
+        response.headers['X-Has-More'] = 'true' if len(events) > limit else 'false'
+    return response
 
 @app.route('/api/tracking-events', methods=['POST'])
+@idempotent
 def create_tracking_event():
     cur = mysql.connection.cursor()
     try:
@@ -1540,11 +2094,14 @@ def create_tracking_event():
             data.get('recorded_by', 1)  # Default to admin user if not specified
         ))
         
-        mysql.connection.commit()
         event_id = cur.lastrowid
         
-        # Update shipment status based on event type
+        # Update shipment status and warehouse occupancy in the same transaction as the event
         update_shipment_status(cur, data['shipment_id'], data['event_type'])
+        apply_warehouse_occupancy(cur, data['shipment_id'], data['event_type'], data['location_id'])
+        outbox.record(cur, 'shipment', data['shipment_id'], 'tracking_event.created', {
+            'event_id': event_id, 'event_type': data['event_type'], 'location_id': data['location_id']
+        })
         mysql.connection.commit()
         
         return jsonify({'success': True, 'event_id': event_id})
@@ -1560,21 +2117,21 @@ def get_shipment_tracking_events(shipment_id):
     try:
         cur = mysql.connection.cursor()
         
-        # First check if the shipment exists
-        cur.execute("SELECT * FROM shipments WHERE shipment_id = %s", (shipment_id,))
-        shipment = cur.fetchone()
+        # First check if the shipment exists, live or archived
+        tables = archive.shipment_tables(cur, shipment_id)
         
-        if not shipment:
+        if not tables:
             return jsonify({'error': 'Shipment not found'}), 404
+        shipments_table, events_table = tables[0], tables[1]
         
         # Get tracking events for the shipment with additional info
-        cur.execute("""
+        cur.execute(f"""
             SELECT te.*, 
                    s.tracking_number,
                    CONCAT(l.city, ', ', l.state) as location,
                    u.full_name as recorded_by_name
-            FROM tracking_events te
-            JOIN shipments s ON te.shipment_id = s.shipment_id
+            FROM {events_table} te
+            JOIN {shipments_table} s ON te.shipment_id = s.shipment_id
             LEFT JOIN locations l ON te.location_id = l.location_id
             LEFT JOIN users u ON te.recorded_by = u.user_id
             WHERE te.shipment_id = %s
@@ -1591,7 +2148,7 @@ def get_shipment_tracking_events(shipment_id):
         cur.close()
         return jsonify(events)
     except Exception as e:
-        print(f"Error in get_shipment_tracking_events: {e}")
+        log.exception("Error in get_shipment_tracking_events")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/shipments/<int:id>/items', methods=['DELETE'])
@@ -1612,6 +2169,7 @@ def delete_shipment_item(id):
         # Update shipment totals
         update_shipment_totals(cur, shipment_id)
         
+        outbox.record(cur, 'shipment', shipment_id, 'shipment_item.deleted', {'item_id': id})
         mysql.connection.commit()
         return jsonify({'success': True})
     
@@ -1622,6 +2180,7 @@ def delete_shipment_item(id):
         cur.close()
 
 @app.route('/api/shipment-items', methods=['GET'])
+@time_budget(3000)
 def get_all_shipment_items():
     cur = mysql.connection.cursor()
     try:
@@ -1639,6 +2198,7 @@ def get_all_shipment_items():
         cur.close()
 
 @app.route('/api/shipment-items', methods=['POST'])
+@idempotent
 def create_shipment_item():
     cur = mysql.connection.cursor()
     try:
@@ -1666,12 +2226,11 @@ def create_shipment_item():
             data.get('is_hazardous', 0),
             data.get('is_fragile', 0)
         ))
-        
-        mysql.connection.commit()
         item_id = cur.lastrowid
         
-        # Update shipment totals after adding item
+        # Update shipment totals after adding item, in the same transaction
         update_shipment_totals(cur, data['shipment_id'])
+        outbox.record(cur, 'shipment', data['shipment_id'], 'shipment_item.created', {'item_id': item_id})
         mysql.connection.commit()
         
         return jsonify({'success': True, 'item_id': item_id})
@@ -1722,12 +2281,14 @@ def update_shipment_item(id):
             id
         ))
         
-        mysql.connection.commit()
-        
-        # Update totals for affected shipments
+        # Update totals for affected shipments, in the same transaction
         update_shipment_totals(cur, old_shipment_id)
         if new_shipment_id != old_shipment_id:
             update_shipment_totals(cur, new_shipment_id)
+            outbox.record(cur, 'shipment', old_shipment_id, 'shipment_item.deleted', {'item_id': id})
+            outbox.record(cur, 'shipment', new_shipment_id, 'shipment_item.created', {'item_id': id})
+        else:
+            outbox.record(cur, 'shipment', old_shipment_id, 'shipment_item.updated', {'item_id': id})
         
         mysql.connection.commit()
         return jsonify({'success': True})
@@ -1738,6 +2299,17 @@ def update_shipment_item(id):
     finally:
         cur.close()
 
+# Helper function to pick the fields of a shipment write that go into its outbox event
+def shipment_payload(data):
+    return {
+        'tracking_number': data.get('tracking_number'),
+        'customer_id': data.get('customer_id'),
+        'status': data.get('status'),
+        'vehicle_id': data.get('vehicle_id'),
+        'driver_id': data.get('driver_id'),
+        'estimated_delivery': data.get('estimated_delivery'),
+    }
+
 # Helper function to update shipment totals (weight, volume, value)
 def update_shipment_totals(cur, shipment_id):
     try:
@@ -1765,8 +2337,8 @@ def update_shipment_totals(cur, shipment_id):
             WHERE shipment_id = %s
         """, (total_weight, total_volume, total_value, shipment_id))
         
-    except Exception as e:
-        print(f"Error updating shipment totals: {str(e)}")
+    except Exception:
+        log.exception("Error updating shipment totals")
         raise
 
 # Helper function to update shipment status based on event type
@@ -1788,13 +2360,55 @@ def update_shipment_status(cursor, shipment_id, event_type):
         new_status = 'delivered'
     
     # Only update if we have a valid status mapping
-    if new_status:
+    if new_status == 'delivered':
+        # The first delivery event fixes the delivery time used for lateness
+        cursor.execute("""
+            UPDATE shipments 
+            SET status = %s, actual_delivery = COALESCE(actual_delivery, NOW())
+            WHERE shipment_id = %s
+        """, (new_status, shipment_id))
+    elif new_status:
         cursor.execute("""
             UPDATE shipments 
             SET status = %s 
             WHERE shipment_id = %s
         """, (new_status, shipment_id))
 
+# Helper function to keep warehouse occupancy in step with tracking events
+def apply_warehouse_occupancy(cur, shipment_id, event_type, location_id):
+    """
+    An arrival at a warehouse location adds the shipment's volume, a departure removes it.
+    Not clamped, so the stored value always equals what rebuild_warehouse_occupancy computes
+    """
+    if event_type not in ('arrival', 'departure'):
+        return
+    
+    sign = 1 if event_type == 'arrival' else -1
+    cur.execute("""
+        UPDATE warehouses w
+        JOIN shipments s ON s.shipment_id = %s
+        SET w.current_occupancy = COALESCE(w.current_occupancy, 0) + %s * s.total_volume
+        WHERE w.location_id = %s
+    """, (shipment_id, sign, location_id))
+
+# Helper function to recompute every warehouse's occupancy from its tracking events in one pass
+def rebuild_warehouse_occupancy(cur):
+    cur.execute(f"""
+        UPDATE warehouses w
+        LEFT JOIN (
+            SELECT te.location_id,
+                   SUM(CASE WHEN te.event_type = 'arrival' THEN s.total_volume
+                            ELSE -s.total_volume END) as occupancy
+            FROM {archive.EVENTS_WITH_ARCHIVE} te
+            JOIN {archive.SHIPMENTS_WITH_ARCHIVE} s ON te.shipment_id = s.shipment_id
+            WHERE te.event_type IN ('arrival', 'departure')
+              AND te.location_id IN (SELECT location_id FROM warehouses)
+            GROUP BY te.location_id
+        ) totals ON totals.location_id = w.location_id
+        SET w.current_occupancy = COALESCE(totals.occupancy, 0)
+    """)
+    return cur.rowcount
+
 # Helper function to recalculate shipment status based on most recent event
 def recalculate_shipment_status(cur, shipment_id):
     # Get the most recent event for the shipment
@@ -1815,21 +2429,76 @@ def recalculate_shipment_status(cur, shipment_id):
         # If no events left, set status back to pending
         cur.execute("UPDATE shipments SET status = 'pending' WHERE shipment_id = %s", (shipment_id,))
 
+@app.route('/api/admin/archive', methods=['POST'])
+def archive_shipments_route():
+    data = request.get_json(silent=True) or {}
+    try:
+        months = int(data.get('months', 12))
+        chunk_size = int(data.get('chunk_size', 500))
+        max_chunks = int(data['max_chunks']) if data.get('max_chunks') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'months, chunk_size and max_chunks must be integers'}), 400
+
+    cur = mysql.connection.cursor()
+    try:
+        result = archive.archive_closed_shipments(
+            cur, mysql.connection,
+            months=months,
+            chunk_size=chunk_size,
+            max_chunks=max_chunks
+        )
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.cli.command('archive-shipments')
+@click.option('--months', default=12, show_default=True, help='Archive closed shipments older than this many months')
+@click.option('--chunk-size', default=500, show_default=True, help='Shipments moved per transaction')
+@click.option('--max-chunks', default=None, type=int, help='Stop after this many chunks')
+def archive_shipments_command(months, chunk_size, max_chunks):
+    cur = mysql.connection.cursor()
+    try:
+        result = archive.archive_closed_shipments(cur, mysql.connection, months, chunk_size, max_chunks)
+        click.echo(f"Archived {result['shipments']} shipment(s) in {result['chunks']} chunk(s), cutoff {result['cutoff']}")
+    finally:
+        cur.close()
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    cur = mysql.connection.cursor()
+    try:
+        removed = idempotency.purge_expired(cur, mysql.connection)
+        click.echo(f"Removed {removed} expired idempotency key(s)")
+    finally:
+        cur.close()
+
+@app.cli.command('purge-outbox-events')
+@click.option('--days', default=None, type=int, help='Keep this many days of events (default OUTBOX_RETENTION_DAYS)')
+def purge_outbox_events_command(days):
+    cur = mysql.connection.cursor()
+    try:
+        removed = outbox.purge_events(cur, mysql.connection, days or app.config['OUTBOX_RETENTION_DAYS'])
+        click.echo(f"Removed {removed} outbox event(s)")
+    finally:
+        cur.close()
+
 @app.route('/api/driver/<int:id>/performance', methods=['GET'])
+@time_budget(3000)
 def get_driver_performance(id):
     cur = mysql.connection.cursor()
     try:
-        # Call the stored procedure for driver performance
-        cur.execute("CALL get_driver_performance(%s)", (id,))
-        performance_data = cur.fetchall()
+        cur.execute("SELECT driver_id FROM drivers WHERE driver_id = %s", (id,))
+        if not cur.fetchone():
+            return jsonify({'success': False, 'error': 'Driver not found'}), 404
         
-        # If there are multiple result sets, we need to close this cursor and get a new one
-        if cur.nextset():
-            more_results = cur.fetchall()
-            performance_data = {
-                'main_stats': performance_data,
-                'details': more_results
-            }
+        performance_data = scorecards.driver_scorecards(cur, id)
+        if not performance_data:
+            # Not scored yet (e.g. no changes since the table was created): score now
+            scorecards.refresh_drivers(cur, mysql.connection, [id])
+            performance_data = scorecards.driver_scorecards(cur, id)
         
         return jsonify({
             'success': True,
@@ -1838,51 +2507,221 @@ def get_driver_performance(id):
         })
         
     except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/drivers/leaderboard', methods=['GET'])
+@cached_response(ttl=60)
+def get_driver_leaderboard():
+    sort = request.args.get('sort', 'on_time_rate')
+    if sort not in scorecards.LEADERBOARD_SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(scorecards.LEADERBOARD_SORTS)}"}), 400
+    try:
+        window = int(request.args.get('window', 30))
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        min_delivered = max(int(request.args.get('min_delivered', 1)), 0)
+    except ValueError:
+        return jsonify({'error': 'window, limit and min_delivered must be integers'}), 400
+    if window not in scorecards.WINDOWS:
+        return jsonify({'error': f"window must be one of {', '.join(map(str, scorecards.WINDOWS))}"}), 400
+    
+    cur = mysql.connection.cursor()
+    try:
+        return jsonify({
+            'window_days': window,
+            'sort': sort,
+            'drivers': scorecards.leaderboard(cur, window, sort, limit, min_delivered)
+        })
+    except Exception as e:
+        log.exception("Error in get_driver_leaderboard")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.cli.command('refresh-scorecards')
+def refresh_scorecards_command():
+    cur = mysql.connection.cursor()
+    try:
+        refreshed = scorecards.refresh_all(cur, mysql.connection)
+        click.echo(f"Refreshed scorecards for {refreshed} driver(s)")
+    finally:
+        cur.close()
+
+@app.route('/api/admin/jobs', methods=['GET'])
+def get_scheduled_jobs():
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    cur = mysql.connection.cursor()
+    try:
+        return jsonify({
+            'jobs': scheduler.job_states(cur, app.config),
+            'runs': scheduler.recent_runs(cur, request.args.get('job'), limit)
+        })
+    except Exception as e:
+        log.exception("Error in get_scheduled_jobs")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/admin/jobs/<name>/run', methods=['POST'])
+def run_scheduled_job(name):
+    cur = mysql.connection.cursor()
+    try:
+        if not scheduler.trigger(cur, mysql.connection, name):
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        return jsonify({'success': True, 'job_name': name, 'message': 'Job will start on the next scheduler poll'})
+    except Exception as e:
+        mysql.connection.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/compliance/expiring', methods=['GET'])
+def get_expiring_compliance():
+    cur = mysql.connection.cursor()
+    try:
+        return jsonify(compliance.upcoming(cur, app.config))
+    except Exception as e:
+        log.exception("Error in get_expiring_compliance")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.cli.command('check-expiries')
+def check_expiries_command():
+    cur = mysql.connection.cursor()
+    try:
+        result = compliance.check_expiries(cur, mysql.connection, app.config)
+        click.echo(f"{result['licences']} licence(s) and {result['inspections']} inspection(s) in their warning "
+                   f"window, {result['alerted']} newly alerted")
+    finally:
+        cur.close()
+
+@app.cli.command('sweep-delays')
+def sweep_delays_command():
+    cur = mysql.connection.cursor()
+    try:
+        result = delays.sweep(cur, mysql.connection, app.config)
+        if result['skipped']:
+            click.echo("Another process is sweeping")
+        else:
+            click.echo(f"Scanned {result['scanned']} shipment(s), flagged {result['delayed']} as delayed "
+                       f"in {result['elapsed_ms']} ms")
+    finally:
+        cur.close()
+
+@app.route('/api/eta/predict', methods=['POST'])
+def predict_eta():
+    data = request.get_json(silent=True) or {}
+    shipment_ids = data.get('shipment_ids') or []
+    specs = data.get('shipments') or []
+    if not isinstance(shipment_ids, list) or not isinstance(specs, list):
+        return jsonify({'success': False, 'error': 'shipment_ids and shipments must be lists'}), 400
+    if not shipment_ids and not specs:
+        return jsonify({'success': False, 'error': 'Provide shipment_ids or shipments'}), 400
+    if len(shipment_ids) + len(specs) > app.config['ETA_MAX_BATCH']:
+        return jsonify({'success': False, 'error': f"At most {app.config['ETA_MAX_BATCH']} predictions per call"}), 400
+    try:
+        shipment_ids = [int(shipment_id) for shipment_id in shipment_ids]
+        specs = [
+            {
+                'origin_id': int(spec['origin_id']),
+                'destination_id': int(spec['destination_id']),
+                'route_id': int(spec['route_id']) if spec.get('route_id') else None,
+                'total_weight': float(spec.get('total_weight') or 0),
+            }
+            for spec in specs
+        ]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'error': 'shipment_ids must be integers; each shipment needs integer origin_id and destination_id'
+        }), 400
+    
+    cur = mysql.connection.cursor()
+    try:
+        model = eta_model.current_model(cur, app.config)
+        if model is None:
+            return jsonify({'success': False, 'error': 'No delivered shipments to learn from yet'}), 503
+        
+        min_samples = app.config['ETA_MIN_SAMPLES']
+        return jsonify({
+            'success': True,
+            'model': eta_model.model_summary(),
+            'shipments': eta_model.predict_shipments(cur, model, shipment_ids, min_samples),
+            'lanes': eta_model.predict_lanes(cur, model, specs, min_samples)
+        })
+    except Exception as e:
+        log.exception("Error in predict_eta")
         return jsonify({'success': False, 'error': str(e)}), 500
     finally:
         cur.close()
 
+@app.route('/api/eta/model', methods=['GET'])
+def get_eta_model():
+    summary = eta_model.model_summary()
+    if summary is None:
+        return jsonify({'fitted': False})
+    return jsonify({'fitted': True, **summary})
+
+@app.cli.command('refit-eta')
+@click.option('--full', is_flag=True, help='Read all delivered history instead of only new deliveries')
+def refit_eta_command(full):
+    cur = mysql.connection.cursor()
+    try:
+        result = eta_model.refresh(cur, app.config['ETA_SETTLE_SECONDS'], full=full)
+        click.echo(f"Fitted ETA model on {result['samples']} delivered shipment(s) "
+                   f"({result['added']} new) in {result['elapsed_ms']} ms")
+        summary = eta_model.model_summary()
+        if summary:
+            click.echo(json.dumps(summary['coefficients']))
+    finally:
+        cur.close()
+
 @app.route('/api/admin/stats', methods=['GET'])
+@cached_response(ttl=30)
+@time_budget(5000)
 def get_admin_stats():
     cur = mysql.connection.cursor()
     try:
-        # Get overall statistics
-        cur.execute("""
+        # Get overall statistics; archived shipments still count, so the totals don't drop after archival
+        cur.execute(f"""
             SELECT 
-                (SELECT COUNT(*) FROM shipments) as totalShipments,
-                (SELECT COUNT(*) FROM shipments WHERE status = 'pending') as pending,
-                (SELECT COUNT(*) FROM shipments WHERE status = 'in_transit') as inTransit,
-                (SELECT COUNT(*) FROM shipments WHERE status = 'delivered') as delivered,
+                shipment_totals.*,
                 (SELECT COUNT(*) FROM customers) as customers,
                 (SELECT COUNT(*) FROM drivers) as drivers,
                 (SELECT COUNT(*) FROM vehicles) as vehicles,
                 (SELECT COUNT(*) FROM vehicles WHERE status = 'available') as availableVehicles
+            FROM (
+                SELECT COUNT(*) as totalShipments,
+                       COALESCE(SUM(s.status = 'pending'), 0) as pending,
+                       COALESCE(SUM(s.status = 'in_transit'), 0) as inTransit,
+                       COALESCE(SUM(s.status = 'delivered'), 0) as delivered
+                FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
+            ) shipment_totals
         """)
         
         stats = cur.fetchone()
         
-        # Get monthly shipment data for charts
-        cur.execute("""
-            SELECT 
-                DATE_FORMAT(created_at, '%b %Y') as month,
-                COUNT(*) as shipment_count,
-                SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) as delivered,
-                SUM(shipment_value) as total_value
-            FROM shipments
-            WHERE created_at >= DATE_SUB(CURRENT_DATE(), INTERVAL 6 MONTH)
-            GROUP BY DATE_FORMAT(created_at, '%b %Y')
-            ORDER BY MIN(created_at) ASC
-        """)
-        
-        monthly_data = cur.fetchall()
+        # Get shipment data for charts from the daily rollups (last 6 months by default)
+        start, end, granularity = rollups.parse_range(request.args)
+        monthly_data = [
+            {'month': row['label'], **row}
+            for row in rollups.shipment_series(cur, start, end, granularity)
+        ]
         
         # Get status distribution for chart
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
-                status,
+                s.status,
                 COUNT(*) as count
-            FROM shipments
-            GROUP BY status
+            FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
+            GROUP BY s.status
         """)
         
         status_distribution = cur.fetchall()
@@ -1900,13 +2739,79 @@ def get_admin_stats():
             'statusDistribution': status_distribution
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        log.exception("Error in admin stats")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cur.close()
+
+@app.route('/api/admin/time-budgets', methods=['GET'])
+def get_time_budgets():
+    return jsonify({'budgets': time_budgets.stats()})
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def get_profiles():
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), app.config['PROFILE_MAX_FILES'])
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    profiles = profiling.recent_profiles(app.config['PROFILE_DIR'], request.args.get('endpoint'), limit)
+    return jsonify({'routes': profiling.route_hotspots(profiles), 'profiles': profiles})
+
+@app.route('/api/admin/slow-queries', methods=['GET'])
+def get_slow_queries():
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in ('total_ms', 'max_ms', 'count'):
+        return jsonify({'error': 'sort must be one of total_ms, max_ms, count'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    
+    return jsonify({
+        'threshold_ms': app.config['SLOW_QUERY_MS'],
+        'statements': slow_queries.slow_log.top(limit, sort)
+    })
+
+@app.route('/api/stats/shipments-series', methods=['GET'])
+@cached_response(ttl=60)
+@time_budget(3000)
+def get_shipments_series():
+    cur = mysql.connection.cursor()
+    try:
+        start, end, granularity = rollups.parse_range(request.args)
+        customer_id = request.args.get('customer_id', type=int)
+        series = rollups.shipment_series(cur, start, end, granularity, customer_id)
+        return jsonify({
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'granularity': granularity,
+            'series': series
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"Error in admin stats: {e}")
         return jsonify({'error': str(e)}), 500
     finally:
         cur.close()
 
+@app.cli.command('backfill-rollups')
+@click.option('--since', default=None, help='First day to rebuild (YYYY-MM-DD); defaults to the oldest shipment')
+def backfill_rollups_command(since):
+    cur = mysql.connection.cursor()
+    try:
+        since_date = datetime.strptime(since, '%Y-%m-%d').date() if since else None
+        result = rollups.backfill(cur, mysql.connection, since_date)
+        click.echo(f"Rebuilt {result['months']} month(s) of rollups ({result['rows']} rows)")
+    finally:
+        cur.close()
+
 @app.route('/api/customer/stats/<int:customer_id>', methods=['GET'])
+@cached_response(ttl=30)
+@time_budget(3000)
 def get_customer_stats(customer_id):
     try:
         cur = mysql.connection.cursor()
@@ -1919,7 +2824,7 @@ def get_customer_stats(customer_id):
             return jsonify({'error': 'Customer not found'}), 404
         
         # Get basic stats for the customer
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
                 COUNT(*) as total_shipments,
                 SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
@@ -1927,24 +2832,17 @@ def get_customer_stats(customer_id):
                 SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) as delivered,
                 SUM(CASE WHEN status = 'returned' THEN 1 ELSE 0 END) as returned,
                 SUM(shipment_value) as total_value
-            FROM shipments
+            FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
             WHERE customer_id = %s
         """, [customer_id])
         stats = cur.fetchone()
         
-        # Get monthly data (last 6 months)
-        cur.execute("""
-            SELECT 
-                DATE_FORMAT(created_at, '%b %Y') as month,
-                COUNT(*) as shipment_count,
-                SUM(shipment_value) as total_value
-            FROM shipments
-            WHERE customer_id = %s
-                AND created_at >= DATE_SUB(CURRENT_DATE(), INTERVAL 6 MONTH)
-            GROUP BY DATE_FORMAT(created_at, '%b %Y')
-            ORDER BY MIN(created_at) ASC
-        """, [customer_id])
-        monthly_data = cur.fetchall()
+        # Get chart data from the daily rollups (last 6 months by default)
+        start, end, granularity = rollups.parse_range(request.args)
+        monthly_data = [
+            {'month': row['label'], **row}
+            for row in rollups.shipment_series(cur, start, end, granularity, customer_id)
+        ]
         
         # Get recent shipments
         cur.execute("""
@@ -1966,11 +2864,14 @@ def get_customer_stats(customer_id):
             'recentShipments': recent_shipments
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error in get_customer_stats")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/driver/stats/<int:driver_id>', methods=['GET'])
+@time_budget(3000)
 def get_driver_stats(driver_id):
     try:
         cur = mysql.connection.cursor()
@@ -1983,20 +2884,20 @@ def get_driver_stats(driver_id):
             return jsonify({'error': 'Driver not found'}), 404
         
         # Get basic stats for the driver
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
                 COUNT(*) as total_assigned,
                 SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
                 SUM(CASE WHEN status = 'in_transit' THEN 1 ELSE 0 END) as in_transit,
                 SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) as delivered,
                 SUM(CASE WHEN status = 'returned' THEN 1 ELSE 0 END) as returned
-            FROM shipments
+            FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
             WHERE driver_id = %s
         """, [driver_id])
         basic_stats = cur.fetchone() or {}
         
         # Get completion rate
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
                 COUNT(*) as total_deliveries,
                 SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) as completed_deliveries,
@@ -2005,16 +2906,16 @@ def get_driver_stats(driver_id):
                     THEN ROUND((SUM(CASE WHEN status = 'delivered' THEN 1 ELSE 0 END) / COUNT(*)) * 100, 1)
                     ELSE 0 
                 END as completion_rate
-            FROM shipments
+            FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
             WHERE driver_id = %s AND status IN ('delivered', 'returned')
         """, [driver_id])
         completion_data = cur.fetchone() or {}
         
         # Get average delivery time difference from estimated (in hours)
-        cur.execute("""
+        cur.execute(f"""
             SELECT 
                 AVG(TIMESTAMPDIFF(HOUR, estimated_delivery, actual_delivery)) as avg_delivery_time_diff
-            FROM shipments
+            FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
             WHERE 
                 driver_id = %s AND 
                 status = 'delivered' AND 
@@ -2069,7 +2970,7 @@ def get_driver_stats(driver_id):
         })
         
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error in get_driver_stats")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/driver/<int:driver_id>/schedule', methods=['GET'])
@@ -2131,7 +3032,7 @@ def get_driver_schedule(driver_id):
         })
         
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Error in get_driver_schedule")
         return jsonify({'error': str(e)}), 500
 
 # Fixed route handler for duplicate /api/ prefixes
@@ -2151,6 +3052,7 @@ def handle_duplicate_api(subpath):
     return redirect(target_url)
 
 @app.route('/api/register', methods=['POST'])
+@idempotent
 def register():
     try:
         # Extract data from request
@@ -2185,15 +3087,7 @@ def register():
         
         cur = mysql.connection.cursor()
         
-        # Check if username or email already exists
-        cur.execute("SELECT * FROM users WHERE username = %s OR email = %s", [username, email])
-        existing_user = cur.fetchone()
-        
-        if existing_user:
-            cur.close()
-            return jsonify({'error': 'Username or email already exists'}), 409
-        
-        # Insert the new user
+        # Insert the new user; unique keys on username and email reject duplicates
         cur.execute("""
             INSERT INTO users (username, password, full_name, email, phone, user_type) 
             VALUES (%s, %s, %s, %s, %s, %s)
@@ -2224,11 +3118,19 @@ def register():
         }), 201
         
     except Exception as e:
-        print(f"Registration error: {e}")
+        if is_duplicate_key(e, 'username') or is_duplicate_key(e, 'email'):
+            mysql.connection.rollback()
+            return jsonify({'error': 'Username or email already exists'}), 409
+        log.exception("Registration error")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/customer-dashboard/<int:user_id>', methods=['GET'])
 def get_customer_dashboard(user_id):
+    try:
+        fields = fieldsets.CUSTOMER_DASHBOARD_SHIPMENTS.parse(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         cur = mysql.connection.cursor()
         
@@ -2244,14 +3146,12 @@ def get_customer_dashboard(user_id):
         if not customer_info:
             return jsonify({'error': 'Customer not found'}), 404
         
-        # Get customer's shipments with additional info
-        cur.execute("""
-            SELECT s.*, 
-                   CONCAT(o.city, ', ', o.state) as origin,
-                   CONCAT(d.city, ', ', d.state) as destination
+        # Get customer's shipments with additional info (?fields= narrows the columns)
+        columns, joins = fieldsets.CUSTOMER_DASHBOARD_SHIPMENTS.select(fields)
+        cur.execute(f"""
+            SELECT {columns}
             FROM shipments s
-            LEFT JOIN locations o ON s.origin_id = o.location_id
-            LEFT JOIN locations d ON s.destination_id = d.location_id
+            {joins}
             WHERE s.customer_id = %s
             ORDER BY s.created_at DESC
         """, [customer_info['customer_id']])
@@ -2293,13 +3193,18 @@ def get_customer_dashboard(user_id):
         })
         
     except Exception as e:
-        print(f"Error in get_customer_dashboard: {e}")
+        log.exception("Error in get_customer_dashboard")
         return jsonify({'error': str(e)}), 500
 
 
 
 @app.route('/api/driver-dashboard/<int:user_id>', methods=['GET'])
 def get_driver_dashboard(user_id):
+    try:
+        fields = fieldsets.DRIVER_DASHBOARD_SHIPMENTS.parse(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         cur = mysql.connection.cursor()
         
@@ -2330,18 +3235,12 @@ def get_driver_dashboard(user_id):
             if 'last_inspection_date' in vehicle:
                 vehicle['last_inspection_date'] = vehicle['last_inspection_date'].isoformat() if vehicle['last_inspection_date'] else None
         
-        # Get driver's shipments with additional info
-        cur.execute("""
-            SELECT s.*, 
-                   c.company_name,
-                   CONCAT(o.city, ', ', o.state) AS origin,
-                   CONCAT(d.city, ', ', d.state) AS destination,
-                   v.license_plate
+        # Get driver's shipments with additional info (?fields= narrows the columns)
+        columns, joins = fieldsets.DRIVER_DASHBOARD_SHIPMENTS.select(fields)
+        cur.execute(f"""
+            SELECT {columns}
             FROM shipments s
-            LEFT JOIN customers c ON s.customer_id = c.customer_id
-            LEFT JOIN locations o ON s.origin_id = o.location_id
-            LEFT JOIN locations d ON s.destination_id = d.location_id
-            LEFT JOIN vehicles v ON s.vehicle_id = v.vehicle_id
+            {joins}
             WHERE s.driver_id = %s
             ORDER BY 
                 CASE 
@@ -2399,7 +3298,7 @@ def get_driver_dashboard(user_id):
         })
         
     except Exception as e:
-        print(f"Error in get_driver_dashboard: {e}")
+        log.exception("Error in get_driver_dashboard")
         return jsonify({'error': str(e)}), 500
     
     
@@ -2424,7 +3323,7 @@ def new_customer_dashboard(user_id):
         })
 
     except Exception as e:
-        print(f"Error in new_customer_dashboard: {e}")
+        log.exception("Error in new_customer_dashboard")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/new/driver-dashboard/<int:user_id>', methods=['GET'])
@@ -2448,7 +3347,7 @@ def new_driver_dashboard(user_id):
         })
 
     except Exception as e:
-        print(f"Error in new_driver_dashboard: {e}")
+        log.exception("Error in new_driver_dashboard")
         return jsonify({'error': str(e)}), 500
 
 
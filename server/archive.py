@@ -0,0 +1,266 @@
+"""
+Monthly partitioned archive for closed shipments and their tracking events.
+
+Delivered and returned shipments older than N months are moved, in small
+chunks, out of the live tables into *_archive tables that are range
+partitioned by month. Endpoints read the archive when asked for older history.
+"""
+import time
+from datetime import date
+
+CLOSED_STATUSES = ('delivered', 'returned')
+
+SHIPMENT_COLUMNS = """shipment_id, tracking_number, customer_id, origin_id, destination_id, route_id,
+    vehicle_id, driver_id, status, total_weight, total_volume, shipment_value, insurance_required,
+    special_instructions, created_at, pickup_date, estimated_delivery, actual_delivery"""
+
+EVENT_COLUMNS = "event_id, shipment_id, event_type, location_id, event_timestamp, recorded_by, notes"
+
+ITEM_COLUMNS = """item_id, shipment_id, description, quantity, weight, volume, item_value,
+    is_hazardous, is_fragile"""
+
+# Live and archived rows behind one derived table, for "include archived" reads
+SHIPMENTS_WITH_ARCHIVE = f"""(
+    SELECT {SHIPMENT_COLUMNS} FROM shipments
+    UNION ALL
+    SELECT {SHIPMENT_COLUMNS} FROM shipments_archive
+)"""
+
+EVENTS_WITH_ARCHIVE = f"""(
+    SELECT {EVENT_COLUMNS} FROM tracking_events
+    UNION ALL
+    SELECT {EVENT_COLUMNS} FROM tracking_events_archive
+)"""
+
+
+def create_archive_tables(cur):
+    # TIMESTAMP columns can't be partitioned with TO_DAYS, so the archive keeps DATETIME
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shipments_archive (
+            shipment_id INT NOT NULL,
+            tracking_number VARCHAR(20) NOT NULL,
+            customer_id INT NOT NULL,
+            origin_id INT NOT NULL,
+            destination_id INT NOT NULL,
+            route_id INT NULL,
+            vehicle_id INT NULL,
+            driver_id INT NULL,
+            status ENUM('pending','picked_up','in_transit','delivered','returned'),
+            total_weight DECIMAL(10,2) NOT NULL,
+            total_volume DECIMAL(10,2) NOT NULL,
+            shipment_value DECIMAL(12,2) NOT NULL,
+            insurance_required TINYINT(1) DEFAULT 0,
+            special_instructions TEXT,
+            created_at DATETIME NOT NULL,
+            pickup_date DATETIME NULL,
+            estimated_delivery DATETIME NULL,
+            actual_delivery DATETIME NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (shipment_id, created_at),
+            KEY idx_shipments_archive_tracking (tracking_number),
+            KEY idx_shipments_archive_customer (customer_id, created_at),
+            KEY idx_shipments_archive_driver (driver_id, created_at)
+        )
+        PARTITION BY RANGE (TO_DAYS(created_at)) (
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tracking_events_archive (
+            event_id INT NOT NULL,
+            shipment_id INT NOT NULL,
+            event_type ENUM('pickup','departure','arrival','delivery','delay','issue') NOT NULL,
+            location_id INT NULL,
+            event_timestamp DATETIME NOT NULL,
+            recorded_by INT NULL,
+            notes TEXT,
+            PRIMARY KEY (event_id, event_timestamp),
+            KEY idx_events_archive_shipment (shipment_id, event_timestamp),
+            KEY idx_events_archive_location (location_id, event_timestamp)
+        )
+        PARTITION BY RANGE (TO_DAYS(event_timestamp)) (
+            PARTITION pmax VALUES LESS THAN MAXVALUE
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shipment_items_archive (
+            item_id INT NOT NULL PRIMARY KEY,
+            shipment_id INT NOT NULL,
+            description VARCHAR(255) NOT NULL,
+            quantity INT NOT NULL,
+            weight DECIMAL(10,2) NOT NULL,
+            volume DECIMAL(10,2) NOT NULL,
+            item_value DECIMAL(10,2) NOT NULL,
+            is_hazardous TINYINT(1) DEFAULT 0,
+            is_fragile TINYINT(1) DEFAULT 0,
+            KEY idx_items_archive_shipment (shipment_id)
+        )
+    """)
+
+
+def month_start(d):
+    return date(d.year, d.month, 1)
+
+
+def add_months(d, months):
+    index = d.year * 12 + (d.month - 1) + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _to_days(d):
+    # Same day number MySQL's TO_DAYS() returns
+    return d.toordinal() + 365
+
+
+def ensure_month_partitions(cur, table, first_month, last_month):
+    """
+    Splits the catch-all pmax partition so every month up to last_month has its own partition
+    """
+    cur.execute("""
+        SELECT partition_description
+        FROM information_schema.partitions
+        WHERE table_schema = DATABASE() AND table_name = %s AND partition_name IS NOT NULL
+    """, (table,))
+    bounds = [int(r['partition_description']) for r in cur.fetchall()
+              if r['partition_description'] not in (None, 'MAXVALUE')]
+
+    month = month_start(first_month)
+    if bounds:
+        # Partitions can only be added above the highest existing bound
+        month = max(month, date.fromordinal(max(bounds) - 365))
+
+    new_partitions = []
+    while month <= month_start(last_month):
+        upper = add_months(month, 1)
+        new_partitions.append(
+            f"PARTITION p{month.strftime('%Y%m')} VALUES LESS THAN ({_to_days(upper)})"
+        )
+        month = upper
+
+    if not new_partitions:
+        return 0
+
+    # Note: ALTER TABLE commits implicitly, so this never runs inside a chunk's transaction
+    cur.execute(
+        f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ("
+        + ", ".join(new_partitions)
+        + ", PARTITION pmax VALUES LESS THAN MAXVALUE)"
+    )
+    return len(new_partitions)
+
+
+def archive_cutoff(months):
+    return add_months(month_start(date.today()), -months)
+
+
+def archive_closed_shipments(cur, connection, months=12, chunk_size=500, max_chunks=None, pause_seconds=0.05):
+    cutoff = archive_cutoff(months)
+    status_list = ', '.join(['%s'] * len(CLOSED_STATUSES))
+    cur.execute(f"""
+        SELECT MIN(created_at) as oldest FROM shipments
+        WHERE status IN ({status_list}) AND created_at < %s
+    """, list(CLOSED_STATUSES) + [cutoff])
+    oldest = cur.fetchone()['oldest']
+    if not oldest:
+        return {'cutoff': cutoff.isoformat(), 'shipments': 0, 'chunks': 0}
+
+    # Partitions first: DDL would otherwise commit a half-moved chunk
+    this_month = date.today()
+    ensure_month_partitions(cur, 'shipments_archive', oldest.date(), this_month)
+    ensure_month_partitions(cur, 'tracking_events_archive', oldest.date(), this_month)
+
+    moved = 0
+    chunks = 0
+    while max_chunks is None or chunks < max_chunks:
+        ids = _candidates(cur, cutoff, chunk_size)
+        if not ids:
+            connection.commit()
+            break
+
+        try:
+            _move_chunk(cur, ids)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+        moved += len(ids)
+        chunks += 1
+        if pause_seconds:
+            # Give dispatch writes a chance at the locks between chunks
+            time.sleep(pause_seconds)
+
+    return {'cutoff': cutoff.isoformat(), 'shipments': moved, 'chunks': chunks}
+
+
+def _candidates(cur, cutoff, limit):
+    """
+    Locks and returns up to limit closed shipments to archive, oldest first. One status at a
+    time, so each SELECT walks idx_shipments_status_created in order and stops after limit rows
+    instead of scanning (and locking) every closed shipment.
+    """
+    ids = []
+    for status in CLOSED_STATUSES:
+        # created_at < cutoff bounds the index range; delivery after the cutoff keeps a shipment live
+        cur.execute("""
+            SELECT shipment_id FROM shipments
+            WHERE status = %s AND created_at < %s AND COALESCE(actual_delivery, created_at) < %s
+            ORDER BY created_at, shipment_id
+            LIMIT %s
+            FOR UPDATE
+        """, (status, cutoff, cutoff, limit - len(ids)))
+        ids.extend(r['shipment_id'] for r in cur.fetchall())
+        if len(ids) >= limit:
+            break
+    return ids
+
+
+def _move_chunk(cur, ids):
+    placeholders = ', '.join(['%s'] * len(ids))
+
+    cur.execute(f"""
+        INSERT INTO shipments_archive ({SHIPMENT_COLUMNS})
+        SELECT shipment_id, tracking_number, customer_id, origin_id, destination_id, route_id,
+               vehicle_id, driver_id, status, total_weight, total_volume, shipment_value, insurance_required,
+               special_instructions, COALESCE(created_at, NOW()), pickup_date, estimated_delivery, actual_delivery
+        FROM shipments WHERE shipment_id IN ({placeholders})
+    """, ids)
+    cur.execute(f"""
+        INSERT INTO tracking_events_archive ({EVENT_COLUMNS})
+        SELECT event_id, shipment_id, event_type, location_id, COALESCE(event_timestamp, NOW()), recorded_by, notes
+        FROM tracking_events WHERE shipment_id IN ({placeholders})
+    """, ids)
+    cur.execute(f"""
+        INSERT INTO shipment_items_archive ({ITEM_COLUMNS})
+        SELECT {ITEM_COLUMNS} FROM shipment_items WHERE shipment_id IN ({placeholders})
+    """, ids)
+
+    # @archiving tells the rollup trigger these rows are moving, not disappearing
+    cur.execute("SET @archiving = 1")
+    try:
+        cur.execute(f"DELETE FROM tracking_events WHERE shipment_id IN ({placeholders})", ids)
+        cur.execute(f"DELETE FROM shipment_items WHERE shipment_id IN ({placeholders})", ids)
+        cur.execute(f"DELETE FROM shipments WHERE shipment_id IN ({placeholders})", ids)
+    finally:
+        cur.execute("SET @archiving = 0")
+
+
+def shipment_tables(cur, shipment_id):
+    """
+    Returns the (shipments, tracking_events, shipment_items) tables holding a shipment, or None
+    """
+    cur.execute("SELECT 1 FROM shipments WHERE shipment_id = %s", (shipment_id,))
+    if cur.fetchone():
+        return 'shipments', 'tracking_events', 'shipment_items'
+
+    cur.execute("SELECT 1 FROM shipments_archive WHERE shipment_id = %s LIMIT 1", (shipment_id,))
+    if cur.fetchone():
+        return 'shipments_archive', 'tracking_events_archive', 'shipment_items_archive'
+
+    return None
+
+
+def wants_archive(args):
+    return str(args.get('include_archived', '')).lower() in ('1', 'true', 'yes')
@@ -0,0 +1,147 @@
+"""
+Runs several API calls from one HTTP request through the existing view functions.
+
+Sub-requests run in order inside the caller's app context, so they share its
+database connection. When every sub-request is a GET and the caller asks for
+it, they run on a small thread pool instead, each thread with its own app
+context and connection. Each sub-request is admitted on its own (see
+admission.admit_subrequest); a rejected one gets a 429 or 503 entry.
+
+An in-order sub-request also shares the caller's g, and its teardown_request
+hooks would release the caller's admission slot and profile, so those are
+set aside while it runs.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import g
+from werkzeug.exceptions import HTTPException
+
+import admission
+import structured_log
+
+ALLOWED_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+# Headers that describe the outer request's body or transport, not the sub-request
+_DROPPED_HEADERS = {
+    'content-type', 'content-length', 'accept-encoding', 'if-none-match', 'host',
+    # Per-request controls: one key or profile must not apply to every sub-request
+    'idempotency-key', 'x-profile',
+}
+
+# What the caller's request keeps in g for its own teardown_request hooks
+_OUTER_STATE = ('admission_slot', 'profile')
+
+log = structured_log.get_logger()
+
+
+def parse_requests(data, max_requests):
+    """
+    Validates the request list; raises ValueError with a message for the caller
+    """
+    items = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError("Body must be an object with a non-empty 'requests' list")
+    if len(items) > max_requests:
+        raise ValueError(f"At most {max_requests} sub-requests are allowed per batch")
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not isinstance(item.get('path'), str):
+            raise ValueError(f"Sub-request {index} needs a 'path'")
+        method = str(item.get('method', 'GET')).upper()
+        if method not in ALLOWED_METHODS:
+            raise ValueError(f"Sub-request {index} has unsupported method {method}")
+        path = item['path']
+        if not path.startswith('/api/') or path.split('?', 1)[0].rstrip('/') == '/api/batch':
+            raise ValueError(f"Sub-request {index} must target an /api/ endpoint other than /api/batch")
+        headers = item.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise ValueError(f"Sub-request {index} headers must be an object")
+        parsed.append({
+            'id': item.get('id', index),
+            'method': method,
+            'path': path,
+            'body': item.get('body'),
+            'headers': headers,
+        })
+    return parsed
+
+
+def _headers(outer_headers, own_headers):
+    headers = {k: v for k, v in outer_headers.items() if k.lower() not in _DROPPED_HEADERS}
+    headers.update({str(k): str(v) for k, v in own_headers.items()})
+    return headers
+
+
+@contextmanager
+def _outer_state_set_aside():
+    saved = {name: g.pop(name) for name in _OUTER_STATE if name in g}
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(g, name, value)
+
+
+def _dispatch(app, item, outer_headers, client=None, own_connection=False):
+    """
+    Runs one sub-request's view (no before/after_request hooks) and returns its result entry
+    """
+    with _outer_state_set_aside(), app.test_request_context(
+        item['path'],
+        method=item['method'],
+        headers=_headers(outer_headers, item['headers']),
+        json=item['body'] if item['body'] is not None else None,
+    ):
+        rejection, holds_slot = admission.admit_subrequest(app.config, client, own_connection)
+        if rejection is not None:
+            status, error, retry_after = rejection
+            return {'id': item['id'], 'status': status, 'body': {'error': error, 'retry_after': retry_after}}
+        try:
+            return _respond(app, item)
+        finally:
+            if holds_slot:
+                admission.release_slot()
+
+
+def _respond(app, item):
+    try:
+        response = app.make_response(app.dispatch_request())
+    except HTTPException as e:
+        return {'id': item['id'], 'status': e.code, 'body': {'error': e.description}}
+    except Exception:
+        log.exception("Error in batch sub-request", extra={'sub_path': item['path']})
+        return {'id': item['id'], 'status': 500, 'body': {'error': 'Internal server error'}}
+
+    if response.is_streamed:
+        response.close()
+        return {'id': item['id'], 'status': 400, 'body': {'error': 'Streaming endpoints cannot be batched'}}
+
+    data = response.get_data()
+    if response.mimetype == 'application/json':
+        body = json.loads(data) if data else None
+    else:
+        body = data.decode('utf-8', 'replace')
+    return {'id': item['id'], 'status': response.status_code, 'body': body}
+
+
+def _dispatch_in_thread(app, item, outer_headers, client):
+    # A fresh app context gives this thread its own database connection
+    with app.app_context():
+        return _dispatch(app, item, outer_headers, client, own_connection=True)
+
+
+def run(app, items, outer_headers, parallel=False, max_workers=4, client=None):
+    """
+    Runs the sub-requests; client is the admission key their route buckets are charged to
+    (None for the server's own calls, which only take database slots)
+    """
+    if parallel and len(items) > 1 and all(item['method'] == 'GET' for item in items):
+        workers = min(max_workers, len(items))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(lambda item: _dispatch_in_thread(app, item, outer_headers, client), items))
+
+    # Writes, and anything not explicitly parallel, run in order on the caller's connection
+    return [_dispatch(app, item, outer_headers, client) for item in items]
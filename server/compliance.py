@@ -0,0 +1,93 @@
+"""
+Driver licence and vehicle inspection expiry checks.
+
+A licence is expiring from LICENCE_EXPIRY_WARN_DAYS before license_expiry; a
+vehicle's inspection is due INSPECTION_INTERVAL_DAYS after its
+last_inspection_date and reported from INSPECTION_WARN_DAYS before that.
+check_expiries, run daily by the scheduler, writes one outbox event per
+licence or inspection as it enters its warning window (remembered in
+compliance_alerts by due date), so SSE clients and webhooks hear about each
+once.
+"""
+import outbox
+
+
+def init_app(app):
+    app.config.setdefault('LICENCE_EXPIRY_WARN_DAYS', 30)
+    app.config.setdefault('INSPECTION_INTERVAL_DAYS', 365)
+    app.config.setdefault('INSPECTION_WARN_DAYS', 30)
+
+
+def create_compliance_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS compliance_alerts (
+            kind ENUM('licence_expiry','inspection_due') NOT NULL,
+            subject_id INT NOT NULL,
+            due_date DATE NOT NULL,
+            alerted_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, subject_id, due_date)
+        )
+    """)
+
+
+def upcoming(cur, config):
+    """
+    Licences and inspections inside their warning window (or already overdue), soonest first
+    """
+    cur.execute("""
+        SELECT d.driver_id, u.full_name, d.license_number, d.license_expiry as due_date,
+               DATEDIFF(d.license_expiry, CURDATE()) as days_left
+        FROM drivers d
+        JOIN users u ON d.user_id = u.user_id
+        WHERE d.license_expiry <= CURDATE() + INTERVAL %s DAY
+        ORDER BY d.license_expiry, d.driver_id
+    """, (config['LICENCE_EXPIRY_WARN_DAYS'],))
+    licences = cur.fetchall()
+
+    cur.execute("""
+        SELECT v.vehicle_id, v.license_plate, v.status, v.last_inspection_date,
+               v.last_inspection_date + INTERVAL %s DAY as due_date,
+               DATEDIFF(v.last_inspection_date + INTERVAL %s DAY, CURDATE()) as days_left
+        FROM vehicles v
+        WHERE v.last_inspection_date IS NULL
+           OR v.last_inspection_date + INTERVAL %s DAY <= CURDATE() + INTERVAL %s DAY
+        ORDER BY v.last_inspection_date IS NOT NULL, v.last_inspection_date, v.vehicle_id
+    """, (config['INSPECTION_INTERVAL_DAYS'],) * 3 + (config['INSPECTION_WARN_DAYS'],))
+    inspections = cur.fetchall()
+
+    return {'licences': licences, 'inspections': inspections}
+
+
+def check_expiries(cur, connection, config):
+    """
+    Records outbox events for licences and inspections not alerted for their current due date
+    """
+    report = upcoming(cur, config)
+    candidates = [
+        ('licence_expiry', 'driver', row['driver_id'], 'driver.licence_expiring', row)
+        for row in report['licences']
+    ] + [
+        # Never inspected vehicles have no due date to remember; the report lists them every day
+        ('inspection_due', 'vehicle', row['vehicle_id'], 'vehicle.inspection_due', row)
+        for row in report['inspections'] if row['due_date'] is not None
+    ]
+
+    alerted = 0
+    for kind, aggregate_type, subject_id, event_type, row in candidates:
+        cur.execute("""
+            INSERT IGNORE INTO compliance_alerts (kind, subject_id, due_date)
+            VALUES (%s, %s, %s)
+        """, (kind, subject_id, row['due_date']))
+        if cur.rowcount:
+            outbox.record(cur, aggregate_type, subject_id, event_type, {
+                'due_date': row['due_date'], 'days_left': row['days_left']
+            })
+            alerted += 1
+    connection.commit()
+
+    return {
+        'licences': len(report['licences']),
+        'inspections': len(report['inspections']),
+        'never_inspected': sum(1 for row in report['inspections'] if row['last_inspection_date'] is None),
+        'alerted': alerted,
+    }
@@ -0,0 +1,128 @@
+"""
+Negotiated response compression (br when the brotli package is installed,
+otherwise gzip or deflate) for JSON and text responses above a size threshold.
+Streamed responses are compressed incrementally.
+"""
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'text/html', 'text/plain', 'text/csv')
+
+# Preference order when the client accepts several encodings equally
+PREFERRED = ('br', 'gzip', 'deflate')
+
+
+def available_encodings():
+    return tuple(e for e in PREFERRED if e != 'br' or brotli is not None)
+
+
+def negotiate(accept_encoding):
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        pieces = part.strip().split(';')
+        name = pieces[0].strip().lower()
+        q = 1.0
+        for param in pieces[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+
+    best = None
+    for encoding in available_encodings():
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (encoding, q)
+    return best[0] if best else None
+
+
+def compress(data, encoding, level=6, brotli_quality=5):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level)
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    return data
+
+
+class _StreamCompressor:
+    def __init__(self, encoding, level, brotli_quality):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._obj = brotli.Compressor(quality=brotli_quality)
+        else:
+            # wbits 31 writes a gzip header and trailer, 15 a zlib (HTTP "deflate") stream
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+    def compress(self, chunk):
+        return self._obj.process(chunk) if self.encoding == 'br' else self._obj.compress(chunk)
+
+    def flush(self):
+        return self._obj.finish() if self.encoding == 'br' else self._obj.flush()
+
+
+def compress_stream(chunks, encoding, level=6, brotli_quality=5):
+    compressor = _StreamCompressor(encoding, level, brotli_quality)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _add_vary(response):
+    vary = response.headers.get('Vary', '')
+    if 'accept-encoding' not in vary.lower():
+        response.headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 1024)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_BROTLI_QUALITY', 5)
+
+    @app.after_request
+    def _compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_TYPES):
+            return response
+
+        _add_vary(response)
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+        if not encoding:
+            return response
+
+        level = app.config['COMPRESS_LEVEL']
+        quality = app.config['COMPRESS_BROTLI_QUALITY']
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, level, quality)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+            return response
+
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        response.set_data(compress(data, encoding, level, quality))
+        response.headers['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,30 @@
+"""
+Cursor class used for every MySQL connection, so per-statement
+instrumentation, time budgets and the slow query log live in one place.
+"""
+import time
+
+from MySQLdb.cursors import DictCursor
+
+import slow_queries
+import structured_log
+import time_budgets
+
+
+class InstrumentedDictCursor(DictCursor):
+    def execute(self, query, args=None):
+        statement, timer = time_budgets.before_execute(self, query)
+        started = time.perf_counter()
+        error = None
+        try:
+            return super().execute(statement, args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            time_budgets.after_execute(error)
+            structured_log.record_sql(query, elapsed_ms)
+            slow_queries.observe(self, statement, args, elapsed_ms, error)
@@ -0,0 +1,38 @@
+"""
+MySQL error codes the endpoints react to instead of checking first.
+"""
+import MySQLdb
+
+ER_DUP_ENTRY = 1062
+ER_LOCK_WAIT_TIMEOUT = 1205
+ER_QUERY_INTERRUPTED = 1317
+ER_QUERY_TIMEOUT = 3024
+
+
+def is_duplicate_key(error, key=None):
+    """
+    True for a unique constraint violation, optionally only on the named key
+    """
+    if not isinstance(error, MySQLdb.IntegrityError) or not error.args or error.args[0] != ER_DUP_ENTRY:
+        return False
+    if key is None:
+        return True
+    message = str(error.args[1]) if len(error.args) > 1 else ''
+    # MySQL 8 reports "for key 'table.key_name'", older servers just "for key 'key_name'"
+    return f".{key}'" in message or f"'{key}'" in message
+
+
+def is_query_timeout(error):
+    """
+    True for a statement stopped by MAX_EXECUTION_TIME or by KILL QUERY
+    """
+    return (isinstance(error, MySQLdb.OperationalError) and bool(error.args)
+            and error.args[0] in (ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED))
+
+
+def is_lock_wait_timeout(error):
+    """
+    True for a statement that gave up waiting for a row lock (innodb_lock_wait_timeout)
+    """
+    return (isinstance(error, MySQLdb.OperationalError) and bool(error.args)
+            and error.args[0] == ER_LOCK_WAIT_TIMEOUT)
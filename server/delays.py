@@ -0,0 +1,228 @@
+"""
+Sweeper that records 'delay' tracking events for overdue shipments.
+
+A shipment is overdue when it is picked up or in transit, its
+estimated_delivery passed more than DELAY_GRACE_MINUTES ago and it has had no
+tracking event for DELAY_QUIET_HOURS. Each sweep walks the (status,
+estimated_delivery) index from where the previous sweep stopped, looking at
+no more than DELAY_SWEEP_MAX_ROWS shipments or DELAY_SWEEP_SECONDS, so with
+millions of open shipments a full pass is spread over several sweeps. Where
+each status's walk stopped is kept in delay_sweep_state, so the next sweep
+carries on from there whichever worker runs it. The delay events found are
+inserted together, with their outbox rows and the new position, in one
+transaction.
+
+delay_alerts remembers the estimated delivery each shipment was last flagged
+for: a shipment gets one delay event per ETA, and a new one only after its
+ETA is changed and missed again. Sweeps run as the scheduler's delay-sweep
+job and take a MySQL named lock of their own, so a manual sweep never
+overlaps a scheduled one.
+"""
+import time
+
+import outbox
+from schema_utils import ensure_index
+
+OPEN_STATUSES = ('picked_up', 'in_transit')
+
+LOCK_NAME = 'delay_sweep'
+
+# Shipments read per index scan
+SCAN_CHUNK = 1000
+
+
+def init_app(app):
+    app.config.setdefault('DELAY_SWEEP_INTERVAL_SECONDS', 300)
+    app.config.setdefault('DELAY_GRACE_MINUTES', 30)
+    app.config.setdefault('DELAY_QUIET_HOURS', 6)
+    # Shipments overdue for longer than this are left alone (abandoned or bad data)
+    app.config.setdefault('DELAY_LOOKBACK_DAYS', 30)
+    app.config.setdefault('DELAY_SWEEP_MAX_ROWS', 20000)
+    app.config.setdefault('DELAY_SWEEP_MAX_EVENTS', 1000)
+    app.config.setdefault('DELAY_SWEEP_SECONDS', 10)
+
+
+def create_delay_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS delay_alerts (
+            shipment_id INT NOT NULL PRIMARY KEY,
+            estimated_delivery DATETIME NOT NULL,
+            event_id INT NULL,
+            detected_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Per status, the (estimated_delivery, shipment_id) the next sweep continues after;
+    # NULL once a sweep reached the grace cutoff
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS delay_sweep_state (
+            status VARCHAR(20) NOT NULL PRIMARY KEY,
+            estimated_delivery DATETIME NULL,
+            shipment_id INT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
+    # Overdue open shipments by status, in ETA order
+    ensure_index(cur, 'shipments', 'idx_shipments_status_eta', 'status, estimated_delivery')
+
+
+def _load_cursors(cur):
+    cur.execute("SELECT status, estimated_delivery, shipment_id FROM delay_sweep_state")
+    return {
+        row['status']: (row['estimated_delivery'], row['shipment_id'])
+        for row in cur.fetchall() if row['estimated_delivery'] is not None
+    }
+
+
+def _save_cursors(cur, cursors):
+    cur.executemany("""
+        INSERT INTO delay_sweep_state (status, estimated_delivery, shipment_id)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE estimated_delivery = VALUES(estimated_delivery), shipment_id = VALUES(shipment_id)
+    """, [(status, *(after or (None, None))) for status, after in cursors.items()])
+
+
+def _scan(cur, status, after, cutoff, limit):
+    eta, shipment_id = after
+    cur.execute("""
+        SELECT shipment_id, estimated_delivery
+        FROM shipments
+        WHERE status = %s
+          AND (estimated_delivery > %s OR (estimated_delivery = %s AND shipment_id > %s))
+          AND estimated_delivery <= %s
+        ORDER BY estimated_delivery, shipment_id
+        LIMIT %s
+    """, (status, eta, eta, shipment_id, cutoff, limit))
+    return cur.fetchall()
+
+
+def _overdue(cur, shipment_ids, quiet_hours):
+    """
+    Of the scanned shipments, those without a recent event that were not flagged for their current ETA
+    """
+    placeholders = ', '.join(['%s'] * len(shipment_ids))
+    cur.execute(f"""
+        SELECT s.shipment_id, s.estimated_delivery,
+               TIMESTAMPDIFF(MINUTE, s.estimated_delivery, NOW()) as overdue_minutes,
+               COALESCE((
+                   SELECT te.location_id FROM tracking_events te
+                   WHERE te.shipment_id = s.shipment_id AND te.location_id IS NOT NULL
+                   ORDER BY te.event_timestamp DESC, te.event_id DESC
+                   LIMIT 1
+               ), s.origin_id) as location_id
+        FROM shipments s
+        LEFT JOIN delay_alerts da ON da.shipment_id = s.shipment_id
+        WHERE s.shipment_id IN ({placeholders})
+          AND s.status IN ({', '.join(['%s'] * len(OPEN_STATUSES))})
+          AND (da.shipment_id IS NULL OR da.estimated_delivery <> s.estimated_delivery)
+          AND NOT EXISTS (
+              SELECT 1 FROM tracking_events te
+              WHERE te.shipment_id = s.shipment_id
+                AND te.event_timestamp >= NOW() - INTERVAL %s HOUR
+          )
+        ORDER BY s.estimated_delivery, s.shipment_id
+    """, (*shipment_ids, *OPEN_STATUSES, quiet_hours))
+    return cur.fetchall()
+
+
+def _record(cur, overdue, quiet_hours):
+    # All %s placeholders, so executemany sends multi-row INSERTs
+    cur.executemany("""
+        INSERT INTO tracking_events (shipment_id, event_type, location_id, notes, recorded_by)
+        VALUES (%s, %s, %s, %s, %s)
+    """, [
+        (row['shipment_id'], 'delay', row['location_id'],
+         f"No update in {quiet_hours} h; {row['overdue_minutes'] // 60} h past estimated delivery", None)
+        for row in overdue
+    ])
+
+    shipment_ids = [row['shipment_id'] for row in overdue]
+    cur.execute(f"""
+        SELECT shipment_id, MAX(event_id) as event_id
+        FROM tracking_events
+        WHERE shipment_id IN ({', '.join(['%s'] * len(shipment_ids))}) AND event_type = 'delay'
+        GROUP BY shipment_id
+    """, shipment_ids)
+    event_ids = {row['shipment_id']: row['event_id'] for row in cur.fetchall()}
+
+    cur.executemany("""
+        INSERT INTO delay_alerts (shipment_id, estimated_delivery, event_id)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE estimated_delivery = VALUES(estimated_delivery),
+                                event_id = VALUES(event_id), detected_at = NOW()
+    """, [(row['shipment_id'], row['estimated_delivery'], event_ids.get(row['shipment_id'])) for row in overdue])
+
+    outbox.record_many(cur, [
+        ('shipment', row['shipment_id'], 'tracking_event.created', {
+            'event_id': event_ids.get(row['shipment_id']),
+            'event_type': 'delay',
+            'location_id': row['location_id'],
+            'estimated_delivery': row['estimated_delivery'],
+        })
+        for row in overdue
+    ])
+
+
+def sweep(cur, connection, config):
+    """
+    One bounded sweep; returns what it scanned and flagged, or skipped=True when another worker is sweeping
+    """
+    started = time.perf_counter()
+    deadline = time.monotonic() + config['DELAY_SWEEP_SECONDS']
+    cur.execute("SELECT GET_LOCK(%s, 0) as acquired", (LOCK_NAME,))
+    if not cur.fetchone()['acquired']:
+        return {'skipped': True}
+
+    try:
+        cur.execute("""
+            SELECT NOW() - INTERVAL %s MINUTE as cutoff, NOW() - INTERVAL %s DAY as oldest
+        """, (config['DELAY_GRACE_MINUTES'], config['DELAY_LOOKBACK_DAYS']))
+        window = cur.fetchone()
+
+        max_rows = config['DELAY_SWEEP_MAX_ROWS'] // len(OPEN_STATUSES)
+        max_events = config['DELAY_SWEEP_MAX_EVENTS']
+        scanned = 0
+        wrapped = []
+        overdue = []
+        cursors = _load_cursors(cur)
+        for status in OPEN_STATUSES:
+            after = cursors.get(status)
+            if after is None or after[0] < window['oldest']:
+                after = (window['oldest'], 0)
+            status_scanned = 0
+            while status_scanned < max_rows and len(overdue) < max_events and time.monotonic() < deadline:
+                rows = _scan(cur, status, after, window['cutoff'], min(SCAN_CHUNK, max_rows - status_scanned))
+                if not rows:
+                    # Reached the grace cutoff: the next sweep starts again from the oldest ETA
+                    after = None
+                    wrapped.append(status)
+                    break
+                status_scanned += len(rows)
+                after = (rows[-1]['estimated_delivery'], rows[-1]['shipment_id'])
+                found = _overdue(cur, [row['shipment_id'] for row in rows], config['DELAY_QUIET_HOURS'])
+                if len(found) > max_events - len(overdue):
+                    # Event cap reached: continue after the last shipment flagged
+                    found = found[:max_events - len(overdue)]
+                    after = (found[-1]['estimated_delivery'], found[-1]['shipment_id'])
+                overdue.extend(found)
+            cursors[status] = after
+            scanned += status_scanned
+
+        if overdue:
+            _record(cur, overdue, config['DELAY_QUIET_HOURS'])
+        _save_cursors(cur, cursors)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cur.fetchall()
+
+    return {
+        'skipped': False,
+        'scanned': scanned,
+        'delayed': len(overdue),
+        'complete_pass': wrapped == list(OPEN_STATUSES),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
+
@@ -0,0 +1,233 @@
+"""
+Great-circle distance matrix over all locations.
+
+Distances are computed with vectorized haversine math and persisted as a
+memory-mapped .npy file per locations version, so workers share the OS page
+cache instead of each loading the whole matrix.
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Rows computed per pass when building the full matrix (bounds peak memory)
+BUILD_BLOCK_ROWS = 1024
+
+# How long a worker trusts its last version check before asking MySQL again
+VERSION_TTL_SECONDS = 30
+
+_lock = threading.Lock()
+_open_matrices = {}
+_version_cache = {'version': None, 'checked_at': 0.0}
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Broadcasts over any array shapes; inputs are in degrees
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distance_block(origin_coords, dest_coords):
+    # origin_coords: (m, 2), dest_coords: (n, 2) -> (m, n) km
+    origin_coords = np.asarray(origin_coords, dtype=np.float64).reshape(-1, 2)
+    dest_coords = np.asarray(dest_coords, dtype=np.float64).reshape(-1, 2)
+    return haversine_km(
+        origin_coords[:, 0][:, None], origin_coords[:, 1][:, None],
+        dest_coords[:, 0][None, :], dest_coords[:, 1][None, :]
+    )
+
+
+def locations_version(cur):
+    # Cheap fingerprint of every location's id and coordinates
+    cur.execute("""
+        SELECT COUNT(*) as n,
+               COALESCE(MAX(location_id), 0) as max_id,
+               COALESCE(SUM(CRC32(CONCAT_WS(',', location_id, latitude, longitude))), 0) as checksum
+        FROM locations
+    """)
+    row = cur.fetchone()
+    return f"{row['n']}-{row['max_id']}-{int(row['checksum']):x}"
+
+
+def current_version(cur):
+    now = time.monotonic()
+    with _lock:
+        if _version_cache['version'] and now - _version_cache['checked_at'] < VERSION_TTL_SECONDS:
+            return _version_cache['version']
+    version = locations_version(cur)
+    with _lock:
+        _version_cache['version'] = version
+        _version_cache['checked_at'] = now
+    return version
+
+
+def invalidate_version():
+    with _lock:
+        _version_cache['version'] = None
+
+
+def _paths(directory, version):
+    return (os.path.join(directory, f'distances-{version}.npy'),
+            os.path.join(directory, f'location-ids-{version}.npy'))
+
+
+def _fetch_coordinates(cur, location_ids=None):
+    query = "SELECT location_id, latitude, longitude FROM locations"
+    params = []
+    if location_ids is not None:
+        placeholders = ', '.join(['%s'] * len(location_ids))
+        query += f" WHERE location_id IN ({placeholders})"
+        params = list(location_ids)
+    query += " ORDER BY location_id"
+    cur.execute(query, params)
+    rows = cur.fetchall()
+
+    ids = np.fromiter((r['location_id'] for r in rows), dtype=np.int64, count=len(rows))
+    coords = np.array(
+        [(float(r['latitude']) if r['latitude'] is not None else np.nan,
+          float(r['longitude']) if r['longitude'] is not None else np.nan) for r in rows],
+        dtype=np.float64
+    ).reshape(-1, 2)
+    return ids, coords
+
+
+def build_matrix(cur, directory):
+    started = time.perf_counter()
+    version = locations_version(cur)
+    matrix_path, ids_path = _paths(directory, version)
+
+    if not (os.path.exists(matrix_path) and os.path.exists(ids_path)):
+        os.makedirs(directory, exist_ok=True)
+        ids, coords = _fetch_coordinates(cur)
+        n = len(ids)
+
+        # Write to a temporary file and rename, so readers never see a partial matrix
+        tmp_path = f'{matrix_path}.{os.getpid()}.tmp'
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(n, n))
+        for start in range(0, n, BUILD_BLOCK_ROWS):
+            stop = min(start + BUILD_BLOCK_ROWS, n)
+            matrix[start:stop] = distance_block(coords[start:stop], coords)
+        matrix.flush()
+        del matrix
+
+        # A file object keeps np.save from appending .npy, so the temp name stays per process
+        ids_tmp_path = f'{ids_path}.{os.getpid()}.tmp'
+        with open(ids_tmp_path, 'wb') as f:
+            np.save(f, ids)
+        os.replace(ids_tmp_path, ids_path)
+        os.replace(tmp_path, matrix_path)
+
+        _remove_stale(directory, version)
+
+    with _lock:
+        _version_cache['version'] = version
+        _version_cache['checked_at'] = time.monotonic()
+
+    ids, _ = _open(directory, version)
+    return {
+        'version': version,
+        'locations': int(len(ids)),
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+
+
+def _remove_stale(directory, keep_version):
+    keep = set(os.path.basename(p) for p in _paths(directory, keep_version))
+    for name in os.listdir(directory):
+        # Another process's build in progress writes *.tmp files; leave them alone
+        if name.endswith('.npy') and '.tmp' not in name and name not in keep:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    with _lock:
+        for version in list(_open_matrices):
+            if version != keep_version:
+                _open_matrices.pop(version, None)
+
+
+def _open(directory, version):
+    with _lock:
+        if version in _open_matrices:
+            return _open_matrices[version]
+
+    matrix_path, ids_path = _paths(directory, version)
+    if not (os.path.exists(matrix_path) and os.path.exists(ids_path)):
+        return None, None
+
+    # mmap_mode='r' pages the matrix in lazily and shares it between processes
+    opened = (np.load(ids_path), np.load(matrix_path, mmap_mode='r'))
+    with _lock:
+        _open_matrices[version] = opened
+    return opened
+
+
+def _indices(ids, wanted):
+    wanted = np.asarray(wanted, dtype=np.int64)
+    if not len(ids):
+        return np.zeros(len(wanted), dtype=np.int64), np.zeros(len(wanted), dtype=bool)
+    idx = np.clip(np.searchsorted(ids, wanted), 0, len(ids) - 1)
+    return idx, ids[idx] == wanted
+
+
+def get_distances(cur, directory, origin_ids, dest_ids):
+    # Returns (matrix of km with NaN for unknown pairs, source)
+    version = current_version(cur)
+    ids, matrix = _open(directory, version)
+
+    if matrix is not None and len(ids):
+        ri, r_found = _indices(ids, origin_ids)
+        ci, c_found = _indices(ids, dest_ids)
+        block = np.asarray(matrix[np.ix_(ri, ci)], dtype=np.float64)
+        block[~r_found, :] = np.nan
+        block[:, ~c_found] = np.nan
+        return block, 'matrix'
+
+    # No persisted matrix for this version yet: compute just the requested block
+    wanted = sorted(set(origin_ids) | set(dest_ids))
+    ids, coords = _fetch_coordinates(cur, wanted)
+    ri, r_found = _indices(ids, origin_ids)
+    ci, c_found = _indices(ids, dest_ids)
+    if not len(ids):
+        return np.full((len(origin_ids), len(dest_ids)), np.nan), 'computed'
+    block = distance_block(coords[ri], coords[ci])
+    block[~r_found, :] = np.nan
+    block[:, ~c_found] = np.nan
+    return block, 'computed'
+
+
+def get_pair_distances(cur, directory, origin_ids, dest_ids):
+    # Element-wise distances for aligned origin/destination id arrays
+    origin_ids = np.asarray(origin_ids, dtype=np.int64)
+    dest_ids = np.asarray(dest_ids, dtype=np.int64)
+    version = current_version(cur)
+    ids, matrix = _open(directory, version)
+
+    if matrix is None or not len(ids):
+        wanted = sorted(set(origin_ids.tolist()) | set(dest_ids.tolist()))
+        if not wanted:
+            return np.zeros(0, dtype=np.float64)
+        ids, coords = _fetch_coordinates(cur, wanted)
+        if not len(ids):
+            return np.full(len(origin_ids), np.nan)
+        ri, r_found = _indices(ids, origin_ids)
+        ci, c_found = _indices(ids, dest_ids)
+        distances = haversine_km(coords[ri, 0], coords[ri, 1], coords[ci, 0], coords[ci, 1])
+    else:
+        ri, r_found = _indices(ids, origin_ids)
+        ci, c_found = _indices(ids, dest_ids)
+        distances = np.asarray(matrix[ri, ci], dtype=np.float64)
+
+    distances[~(r_found & c_found)] = np.nan
+    return distances
+
+
+def to_json_rows(block):
+    # JSON has no NaN; unknown distances become null
+    return [[None if np.isnan(v) else round(float(v), 3) for v in row] for row in block]
@@ -0,0 +1,474 @@
+"""
+Transit time model learned from delivered shipments.
+
+log(transit hours), from pickup to delivery, is fitted as a linear function
+of log distance, route hazard level and log weight over all delivered
+shipments (live and archived). Each route and each origin/destination lane
+then gets its own offset and spread on top of that fit, shrunk towards the
+global model while it has few deliveries. A prediction uses the route when it
+has ETA_MIN_SAMPLES deliveries, else the lane, else the global fit, and is a
+log-normal distribution reported as p10/p50/p90 hours.
+
+The fit only keeps sufficient statistics (sums of x, y and their products,
+globally and per route and lane), so a refresh adds the shipments delivered
+since the last one instead of reading the history again. The model lives in
+each worker process and is refreshed when it is older than
+ETA_REFRESH_SECONDS.
+"""
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from archive import EVENTS_WITH_ARCHIVE, SHIPMENTS_WITH_ARCHIVE
+from distance_matrix import haversine_km
+from schema_utils import ensure_index
+
+# Design matrix columns
+FEATURES = ('intercept', 'log_distance_km', 'hazard_medium', 'hazard_high', 'log_weight')
+
+# Rows read per training query
+CHUNK_SIZE = 5000
+
+# Transit times outside (0, MAX_TRANSIT_HOURS] are data entry errors, not deliveries
+MAX_TRANSIT_HOURS = 24 * 90
+
+# Deliveries' worth of weight the global fit has in a route or lane estimate
+PRIOR_WEIGHT = 10.0
+
+# Ridge penalty on the non-intercept coefficients (keeps the fit stable with little history)
+RIDGE = 1.0
+
+# Standard normal quantiles for p10 and p90
+Z90 = 1.2815515655446004
+
+_state = {'model': None, 'stats': None, 'watermark': None, 'refreshed_at': 0.0}
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('ETA_REFRESH_SECONDS', 300)
+    # Deliveries newer than this may still be committing; the next refresh picks them up
+    app.config.setdefault('ETA_SETTLE_SECONDS', 60)
+    app.config.setdefault('ETA_MIN_SAMPLES', 5)
+    app.config.setdefault('ETA_MAX_BATCH', 1000)
+
+
+def create_eta_indexes(cur):
+    # Incremental refits read the shipments delivered since the last one
+    ensure_index(cur, 'shipments', 'idx_shipments_status_delivered', 'status, actual_delivery')
+
+
+def lane_keys(origin_ids, destination_ids):
+    return (np.asarray(origin_ids, dtype=np.int64) << 32) | np.asarray(destination_ids, dtype=np.int64)
+
+
+def design_matrix(distance_km, hazard_levels, weights):
+    distance_km = np.asarray(distance_km, dtype=np.float64)
+    hazard_levels = np.asarray(hazard_levels, dtype=object)
+    X = np.empty((len(distance_km), len(FEATURES)))
+    X[:, 0] = 1.0
+    X[:, 1] = np.log1p(np.maximum(distance_km, 0.0))
+    X[:, 2] = hazard_levels == 'medium'
+    X[:, 3] = hazard_levels == 'high'
+    X[:, 4] = np.log1p(np.maximum(np.asarray(weights, dtype=np.float64), 0.0))
+    return X
+
+
+def _column(rows, key):
+    return np.array([np.nan if row[key] is None else float(row[key]) for row in rows])
+
+
+def _distances(rows):
+    # Route distance when the shipment has a route, else the great-circle distance of its lane
+    distance = _column(rows, 'distance_km')
+    missing = np.isnan(distance)
+    if missing.any():
+        lane = haversine_km(_column(rows, 'origin_lat'), _column(rows, 'origin_lon'),
+                            _column(rows, 'dest_lat'), _column(rows, 'dest_lon'))
+        distance[missing] = lane[missing]
+    return distance
+
+
+def _features(rows):
+    distance = _distances(rows)
+    X = design_matrix(
+        np.nan_to_num(distance),
+        [row['hazard_level'] or 'low' for row in rows],
+        _column(rows, 'total_weight'),
+    )
+    routes = np.array([row['route_id'] or -1 for row in rows], dtype=np.int64)
+    lanes = lane_keys([row['origin_id'] for row in rows], [row['destination_id'] for row in rows])
+    return X, routes, lanes, ~np.isnan(distance)
+
+
+class GroupStats:
+    """
+    Per-key sums of x, y, y², x·y and x·xᵀ, with keys kept sorted for vectorized lookups
+    """
+
+    def __init__(self, k):
+        self.keys = np.empty(0, dtype=np.int64)
+        self.n = np.empty(0)
+        self.sy = np.empty(0)
+        self.syy = np.empty(0)
+        self.sx = np.empty((0, k))
+        self.sxy = np.empty((0, k))
+        self.sxx = np.empty((0, k, k))
+
+    def add(self, keys, X, y):
+        unique, inverse = np.unique(keys, return_inverse=True)
+        k = X.shape[1]
+        sums = {
+            'n': np.bincount(inverse, minlength=len(unique)).astype(np.float64),
+            'sy': np.bincount(inverse, y, minlength=len(unique)),
+            'syy': np.bincount(inverse, y * y, minlength=len(unique)),
+            'sx': np.zeros((len(unique), k)),
+            'sxy': np.zeros((len(unique), k)),
+            'sxx': np.zeros((len(unique), k, k)),
+        }
+        np.add.at(sums['sx'], inverse, X)
+        np.add.at(sums['sxy'], inverse, X * y[:, None])
+        np.add.at(sums['sxx'], inverse, X[:, :, None] * X[:, None, :])
+        self._accumulate(unique, sums)
+
+    def merge(self, other):
+        self._accumulate(other.keys, {name: getattr(other, name) for name in ('n', 'sy', 'syy', 'sx', 'sxy', 'sxx')})
+
+    def _accumulate(self, unique, sums):
+        """
+        Adds per-key sums for sorted, distinct keys
+        """
+        position = np.searchsorted(self.keys, unique)
+        known = position < len(self.keys)
+        known[known] = self.keys[position[known]] == unique[known]
+        for name, values in sums.items():
+            getattr(self, name)[position[known]] += values[known]
+
+        if not known.all():
+            keys = np.concatenate([self.keys, unique[~known]])
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            for name, values in sums.items():
+                setattr(self, name, np.concatenate([getattr(self, name), values[~known]])[order])
+
+    def residuals(self, beta):
+        """
+        Per key: count, sum and sum of squares of y - x·beta
+        """
+        total = self.sy - self.sx @ beta
+        squares = self.syy - 2 * (self.sxy @ beta) + np.einsum('gij,i,j->g', self.sxx, beta, beta)
+        return self.n, total, np.maximum(squares, 0.0)
+
+
+class SufficientStats:
+    def __init__(self):
+        k = len(FEATURES)
+        self.n = 0
+        self.xtx = np.zeros((k, k))
+        self.xty = np.zeros(k)
+        self.yy = 0.0
+        self.groups = {'route': GroupStats(k), 'lane': GroupStats(k)}
+
+    def add(self, X, y, routes, lanes):
+        self.n += len(y)
+        self.xtx += X.T @ X
+        self.xty += X.T @ y
+        self.yy += float(y @ y)
+        has_route = routes >= 0
+        self.groups['route'].add(routes[has_route], X[has_route], y[has_route])
+        self.groups['lane'].add(lanes, X, y)
+
+    def merge(self, other):
+        self.n += other.n
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yy += other.yy
+        for name, group in self.groups.items():
+            group.merge(other.groups[name])
+
+    def fit(self):
+        k = len(FEATURES)
+        penalty = RIDGE * np.eye(k)
+        penalty[0, 0] = 0.0
+        beta = np.linalg.solve(self.xtx + penalty + 1e-9 * np.eye(k), self.xty)
+        residual_ss = max(self.yy - 2 * beta @ self.xty + beta @ self.xtx @ beta, 0.0)
+        variance = residual_ss / max(self.n - k, 1)
+
+        groups = {}
+        for name, group in self.groups.items():
+            n, total, squares = group.residuals(beta)
+            mean = np.divide(total, n, out=np.zeros_like(total), where=n > 0)
+            within = np.maximum(squares - n * mean ** 2, 0.0)
+            groups[name] = {
+                'keys': group.keys.copy(),
+                'n': n.copy(),
+                'offset': total / (n + PRIOR_WEIGHT),
+                'sigma': np.sqrt((within + PRIOR_WEIGHT * variance) / (n + PRIOR_WEIGHT)),
+            }
+
+        mean_x = self.xtx[0] / self.n
+        return EtaModel(beta, float(np.sqrt(variance)), groups, self.n, mean_x[1])
+
+
+class EtaModel:
+    def __init__(self, beta, sigma, groups, samples, fill_log_distance):
+        self.beta = beta
+        self.sigma = sigma
+        self.groups = groups
+        self.samples = samples
+        # Lanes without a route or coordinates are scored at the average distance
+        self.fill_log_distance = fill_log_distance
+        self.fitted_at = time.time()
+
+    def _lookup(self, name, keys, min_samples):
+        group = self.groups[name]
+        position = np.minimum(np.searchsorted(group['keys'], keys), max(len(group['keys']) - 1, 0))
+        if not len(group['keys']):
+            return np.zeros(len(keys), dtype=bool), position
+        found = (group['keys'][position] == keys) & (group['n'][position] >= min_samples)
+        return found, position
+
+    def predict(self, X, routes, lanes, min_samples):
+        mu = X @ self.beta
+        sigma = np.full(len(mu), self.sigma)
+        samples = np.zeros(len(mu), dtype=np.int64)
+        basis = np.full(len(mu), 'global', dtype=object)
+
+        # Lane first so a known route overrides it
+        for name, keys in (('lane', lanes), ('route', routes)):
+            found, position = self._lookup(name, keys, min_samples)
+            group = self.groups[name]
+            mu[found] += group['offset'][position[found]]
+            sigma[found] = group['sigma'][position[found]]
+            samples[found] = group['n'][position[found]]
+            basis[found] = name
+        return mu, sigma, samples, basis
+
+    def summary(self):
+        return {
+            'samples': self.samples,
+            'routes': int(len(self.groups['route']['keys'])),
+            'lanes': int(len(self.groups['lane']['keys'])),
+            'coefficients': {name: round(float(value), 4) for name, value in zip(FEATURES, self.beta)},
+            'sigma': round(self.sigma, 4),
+            'fitted_at': self.fitted_at,
+        }
+
+
+_TRAINING_QUERY = """
+    SELECT t.*, TIMESTAMPDIFF(SECOND, t.started_at, t.delivered_at) / 3600 as transit_hours
+    FROM (
+        SELECT s.shipment_id, s.route_id, s.origin_id, s.destination_id, s.total_weight,
+               r.distance_km, r.hazard_level,
+               o.latitude as origin_lat, o.longitude as origin_lon,
+               d.latitude as dest_lat, d.longitude as dest_lon,
+               COALESCE((
+                   SELECT MIN(te.event_timestamp) FROM {events} te
+                   WHERE te.shipment_id = s.shipment_id AND te.event_type = 'pickup'
+               ), s.pickup_date, s.created_at) as started_at,
+               COALESCE(s.actual_delivery, (
+                   SELECT MAX(te.event_timestamp) FROM {events} te
+                   WHERE te.shipment_id = s.shipment_id AND te.event_type = 'delivery'
+               )) as delivered_at
+        FROM {shipments} s
+        LEFT JOIN routes r ON r.route_id = s.route_id
+        LEFT JOIN locations o ON o.location_id = s.origin_id
+        LEFT JOIN locations d ON d.location_id = s.destination_id
+        WHERE s.status = 'delivered' AND s.shipment_id > %s AND {condition}
+        ORDER BY s.shipment_id
+        LIMIT %s
+    ) t
+"""
+
+
+def _training_chunks(cur, shipments, events, condition, params):
+    query = _TRAINING_QUERY.format(shipments=shipments, events=events, condition=condition)
+    last_id = 0
+    while True:
+        cur.execute(query, (last_id, *params, CHUNK_SIZE))
+        rows = cur.fetchall()
+        if not rows:
+            return
+        last_id = rows[-1]['shipment_id']
+        yield rows
+        if len(rows) < CHUNK_SIZE:
+            return
+
+
+def _add_rows(stats, rows):
+    hours = _column(rows, 'transit_hours')
+    X, routes, lanes, has_distance = _features(rows)
+    keep = has_distance & (hours > 0) & (hours <= MAX_TRANSIT_HOURS)
+    stats.add(X[keep], np.log(hours[keep]), routes[keep], lanes[keep])
+    return int(keep.sum())
+
+
+def refresh(cur, settle_seconds, full=False):
+    """
+    Adds shipments delivered since the last refresh (all history when full or first run) and refits
+    """
+    started = time.perf_counter()
+    with _lock:
+        cur.execute("SELECT NOW() - INTERVAL %s SECOND as cutoff", (settle_seconds,))
+        cutoff = cur.fetchone()['cutoff']
+
+        full = full or _state['stats'] is None
+        if full:
+            stats = SufficientStats()
+            # Deliveries recorded only as tracking events have no actual_delivery to order by
+            chunks = _training_chunks(cur, SHIPMENTS_WITH_ARCHIVE, EVENTS_WITH_ARCHIVE,
+                                      "(s.actual_delivery IS NULL OR s.actual_delivery <= %s)", (cutoff,))
+        else:
+            # Merged in only once every chunk has been read, so a failed refresh adds nothing
+            stats = SufficientStats()
+            chunks = _training_chunks(cur, 'shipments', 'tracking_events',
+                                      "s.actual_delivery > %s AND s.actual_delivery <= %s",
+                                      (_state['watermark'], cutoff))
+
+        added = sum(_add_rows(stats, rows) for rows in chunks)
+        if not full:
+            _state['stats'].merge(stats)
+            stats = _state['stats']
+        if stats.n:
+            _state['model'] = stats.fit()
+        _state['stats'] = stats
+        _state['watermark'] = cutoff
+        _state['refreshed_at'] = time.monotonic()
+
+    return {
+        'full': full,
+        'added': added,
+        'samples': stats.n,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 2),
+    }
+
+
+def current_model(cur, config):
+    """
+    The fitted model, refreshed first when it is stale; None without any delivered history
+    """
+    stale = time.monotonic() - _state['refreshed_at'] >= config['ETA_REFRESH_SECONDS']
+    if _state['stats'] is None or stale:
+        if _state['model'] is None or not _lock.locked():
+            refresh(cur, config['ETA_SETTLE_SECONDS'])
+        # else another thread is refreshing: keep answering with the current fit
+    return _state['model']
+
+
+def model_summary():
+    model = _state['model']
+    if model is None:
+        return None
+    return dict(model.summary(), watermark=_state['watermark'])
+
+
+def _score(model, rows, min_samples):
+    X, routes, lanes, has_distance = _features(rows)
+    X[~has_distance, 1] = model.fill_log_distance
+    mu, sigma, samples, basis = model.predict(X, routes, lanes, min_samples)
+    return {
+        'p10_hours': np.exp(mu - Z90 * sigma),
+        'p50_hours': np.exp(mu),
+        'p90_hours': np.exp(mu + Z90 * sigma),
+        'samples': samples,
+        'basis': basis,
+    }
+
+
+def _prediction(scores, i):
+    return {
+        'basis': scores['basis'][i],
+        'samples': int(scores['samples'][i]),
+        'p10_hours': round(float(scores['p10_hours'][i]), 2),
+        'p50_hours': round(float(scores['p50_hours'][i]), 2),
+        'p90_hours': round(float(scores['p90_hours'][i]), 2),
+    }
+
+
+def predict_shipments(cur, model, shipment_ids, min_samples):
+    """
+    Predictions for existing shipments, with delivery times counted from pickup (or now, before pickup)
+    """
+    if not shipment_ids:
+        return []
+    cur.execute(f"""
+        SELECT s.shipment_id, s.route_id, s.origin_id, s.destination_id, s.total_weight, s.status,
+               r.distance_km, r.hazard_level,
+               o.latitude as origin_lat, o.longitude as origin_lon,
+               d.latitude as dest_lat, d.longitude as dest_lon,
+               COALESCE((
+                   SELECT MIN(te.event_timestamp) FROM tracking_events te
+                   WHERE te.shipment_id = s.shipment_id AND te.event_type = 'pickup'
+               ), GREATEST(COALESCE(s.pickup_date, NOW()), NOW())) as departs_at
+        FROM shipments s
+        LEFT JOIN routes r ON r.route_id = s.route_id
+        LEFT JOIN locations o ON o.location_id = s.origin_id
+        LEFT JOIN locations d ON d.location_id = s.destination_id
+        WHERE s.shipment_id IN ({', '.join(['%s'] * len(shipment_ids))})
+        ORDER BY s.shipment_id
+    """, shipment_ids)
+    rows = cur.fetchall()
+    if not rows:
+        return []
+
+    scores = _score(model, rows, min_samples)
+    predictions = []
+    for i, row in enumerate(rows):
+        prediction = _prediction(scores, i)
+        departs_at = row['departs_at']
+        predictions.append(dict(
+            prediction,
+            shipment_id=row['shipment_id'],
+            status=row['status'],
+            departs_at=departs_at,
+            p50_delivery=departs_at + timedelta(hours=prediction['p50_hours']),
+            p90_delivery=departs_at + timedelta(hours=prediction['p90_hours']),
+        ))
+    return predictions
+
+
+def predict_lanes(cur, model, specs, min_samples):
+    """
+    Predictions for prospective shipments given as origin_id, destination_id, optional route_id and total_weight
+    """
+    if not specs:
+        return []
+    location_ids = sorted({spec[key] for spec in specs for key in ('origin_id', 'destination_id')})
+    cur.execute(f"""
+        SELECT location_id, latitude, longitude FROM locations
+        WHERE location_id IN ({', '.join(['%s'] * len(location_ids))})
+    """, location_ids)
+    locations = {row['location_id']: row for row in cur.fetchall()}
+
+    routes = {}
+    route_ids = sorted({spec['route_id'] for spec in specs if spec.get('route_id')})
+    if route_ids:
+        cur.execute(f"""
+            SELECT route_id, distance_km, hazard_level FROM routes
+            WHERE route_id IN ({', '.join(['%s'] * len(route_ids))})
+        """, route_ids)
+        routes = {row['route_id']: row for row in cur.fetchall()}
+
+    rows = []
+    for spec in specs:
+        route = routes.get(spec.get('route_id'), {})
+        origin = locations.get(spec['origin_id'], {})
+        destination = locations.get(spec['destination_id'], {})
+        rows.append({
+            'route_id': spec.get('route_id') if route else None,
+            'origin_id': spec['origin_id'],
+            'destination_id': spec['destination_id'],
+            'total_weight': spec.get('total_weight') or 0,
+            'distance_km': route.get('distance_km'),
+            'hazard_level': route.get('hazard_level'),
+            'origin_lat': origin.get('latitude'),
+            'origin_lon': origin.get('longitude'),
+            'dest_lat': destination.get('latitude'),
+            'dest_lon': destination.get('longitude'),
+        })
+
+    scores = _score(model, rows, min_samples)
+    return [dict(_prediction(scores, i), **spec) for i, spec in enumerate(specs)]
+
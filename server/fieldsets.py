@@ -0,0 +1,101 @@
+"""
+Sparse fieldsets for shipment endpoints.
+
+A ?fields=a,b,c parameter is checked against the endpoint's whitelist and
+turned into a SELECT list plus only the joins those fields depend on.
+Without the parameter every whitelisted field is returned, as before.
+"""
+import archive
+
+SHIPMENT_BASE_COLUMNS = [c.strip() for c in archive.SHIPMENT_COLUMNS.split(',')]
+
+# alias -> (join clause, aliases it depends on); listed in the order they must appear
+JOINS = {
+    'c': ("LEFT JOIN customers c ON s.customer_id = c.customer_id", ()),
+    'o': ("LEFT JOIN locations o ON s.origin_id = o.location_id", ()),
+    'd': ("LEFT JOIN locations d ON s.destination_id = d.location_id", ()),
+    'dr': ("LEFT JOIN drivers dr ON s.driver_id = dr.driver_id", ()),
+    'u': ("LEFT JOIN users u ON dr.user_id = u.user_id", ('dr',)),
+    'v': ("LEFT JOIN vehicles v ON s.vehicle_id = v.vehicle_id", ()),
+}
+
+
+class FieldSet:
+    def __init__(self, extra_fields, required=('shipment_id',)):
+        # field name -> (select expression, join aliases it needs)
+        self.fields = {name: (f"s.{name}", ()) for name in SHIPMENT_BASE_COLUMNS}
+        self.fields.update(extra_fields)
+        self.required = tuple(required)
+
+    def parse(self, value):
+        """
+        Returns the requested field names, or all of them when value is empty;
+        raises ValueError for names outside the whitelist
+        """
+        if not value:
+            return list(self.fields)
+
+        names = []
+        for name in value.split(','):
+            name = name.strip()
+            if not name or name in names:
+                continue
+            if name not in self.fields:
+                raise ValueError(f"Unknown field '{name}'. Allowed fields: {', '.join(self.fields)}")
+            names.append(name)
+
+        for name in self.required:
+            if name not in names:
+                names.insert(0, name)
+        return names
+
+    def select(self, names):
+        """
+        Returns (select list, join clauses) for the given field names
+        """
+        needed = set()
+        for name in names:
+            pending = list(self.fields[name][1])
+            while pending:
+                alias = pending.pop()
+                if alias not in needed:
+                    needed.add(alias)
+                    pending.extend(JOINS[alias][1])
+
+        columns = ",\n                   ".join(
+            f"{self.fields[name][0]} as {name}" for name in names
+        )
+        joins = "\n            ".join(sql for alias, (sql, _) in JOINS.items() if alias in needed)
+        return columns, joins
+
+
+SHIPMENT_LIST = FieldSet({
+    'company_name': ("c.company_name", ('c',)),
+    'origin': ("CONCAT(o.city, ', ', o.state)", ('o',)),
+    'destination': ("CONCAT(d.city, ', ', d.state)", ('d',)),
+    'driver_name': ("u.full_name", ('u',)),
+    'license_plate': ("v.license_plate", ('v',)),
+})
+
+SHIPMENT_DETAIL = FieldSet({
+    'company_name': ("c.company_name", ('c',)),
+    'origin_address': ("CONCAT(o.address, ', ', o.city, ', ', o.state, ' ', o.postal_code)", ('o',)),
+    'destination_address': ("CONCAT(d.address, ', ', d.city, ', ', d.state, ' ', d.postal_code)", ('d',)),
+    'driver_name': ("u.full_name", ('u',)),
+    'license_plate': ("v.license_plate", ('v',)),
+    'make': ("v.make", ('v',)),
+    'model': ("v.model", ('v',)),
+    'year': ("v.year", ('v',)),
+})
+
+CUSTOMER_DASHBOARD_SHIPMENTS = FieldSet({
+    'origin': ("CONCAT(o.city, ', ', o.state)", ('o',)),
+    'destination': ("CONCAT(d.city, ', ', d.state)", ('d',)),
+})
+
+DRIVER_DASHBOARD_SHIPMENTS = FieldSet({
+    'company_name': ("c.company_name", ('c',)),
+    'origin': ("CONCAT(o.city, ', ', o.state)", ('o',)),
+    'destination': ("CONCAT(d.city, ', ', d.state)", ('d',)),
+    'license_plate': ("v.license_plate", ('v',)),
+})
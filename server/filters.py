@@ -0,0 +1,181 @@
+"""
+Server-side filters, sorting and paging for the shipment and tracking event lists.
+
+Each builder reads query parameters and returns WHERE clauses with their
+parameters; bad input raises ValueError, which the endpoints turn into a 400.
+"""
+from datetime import datetime, timedelta
+
+SHIPMENT_STATUSES = ('pending', 'picked_up', 'in_transit', 'delivered', 'returned')
+EVENT_TYPES = ('pickup', 'departure', 'arrival', 'delivery', 'delay', 'issue')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+
+# query parameter -> shipment column compared by id (comma separated lists allowed)
+SHIPMENT_ID_FILTERS = {
+    'customer_id': 's.customer_id',
+    'driver_id': 's.driver_id',
+    'vehicle_id': 's.vehicle_id',
+    'route_id': 's.route_id',
+    'origin_id': 's.origin_id',
+    'destination_id': 's.destination_id',
+}
+
+# parameter prefix -> column, read as <prefix>_from / <prefix>_to
+SHIPMENT_DATE_FILTERS = {
+    'created': 's.created_at',
+    'pickup': 's.pickup_date',
+    'eta': 's.estimated_delivery',
+    'delivered': 's.actual_delivery',
+}
+
+SHIPMENT_SORT_KEYS = {
+    'created_at': 's.created_at',
+    'pickup_date': 's.pickup_date',
+    'estimated_delivery': 's.estimated_delivery',
+    'actual_delivery': 's.actual_delivery',
+    'status': 's.status',
+    'shipment_value': 's.shipment_value',
+    'total_weight': 's.total_weight',
+    'tracking_number': 's.tracking_number',
+    'shipment_id': 's.shipment_id',
+}
+
+EVENT_SORT_KEYS = {
+    'event_timestamp': 'e.event_timestamp',
+    'event_type': 'e.event_type',
+    'shipment_id': 'e.shipment_id',
+    'event_id': 'e.event_id',
+}
+
+
+def _split(value):
+    return [part.strip() for part in value.split(',') if part.strip()]
+
+
+def _ids(name, value):
+    try:
+        return [int(part) for part in _split(value)]
+    except ValueError:
+        raise ValueError(f"{name} must be an integer or a comma separated list of integers")
+
+
+def _choices(name, value, allowed):
+    values = _split(value)
+    unknown = [v for v in values if v not in allowed]
+    if unknown:
+        raise ValueError(f"Invalid {name} '{unknown[0]}'. Allowed values: {', '.join(allowed)}")
+    return values
+
+
+def _in(column, values, clauses, params):
+    if len(values) == 1:
+        clauses.append(f"{column} = %s")
+    else:
+        clauses.append(f"{column} IN ({', '.join(['%s'] * len(values))})")
+    params.extend(values)
+
+
+def parse_bound(name, value, upper=False):
+    """
+    Returns (operator, datetime). A bare date as an upper bound covers that whole day.
+    """
+    try:
+        if len(value) == 10:
+            moment = datetime.strptime(value, '%Y-%m-%d')
+            if upper:
+                return '<', moment + timedelta(days=1)
+            return '>=', moment
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a date (YYYY-MM-DD) or an ISO datetime")
+    return ('<=' if upper else '>='), moment
+
+
+def _date_range(args, prefix, column, clauses, params):
+    for suffix, upper in (('from', False), ('to', True)):
+        name = f"{prefix}_{suffix}"
+        if args.get(name):
+            op, moment = parse_bound(name, args[name], upper)
+            clauses.append(f"{column} {op} %s")
+            params.append(moment)
+
+
+def shipment_filters(args):
+    clauses = []
+    params = []
+
+    if args.get('status'):
+        _in('s.status', _choices('status', args['status'], SHIPMENT_STATUSES), clauses, params)
+
+    for name, column in SHIPMENT_ID_FILTERS.items():
+        if args.get(name):
+            _in(column, _ids(name, args[name]), clauses, params)
+
+    for prefix, column in SHIPMENT_DATE_FILTERS.items():
+        _date_range(args, prefix, column, clauses, params)
+
+    if args.get('tracking_number'):
+        # Prefix match keeps the unique index on tracking_number usable
+        prefix = args['tracking_number'].strip().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        clauses.append("s.tracking_number LIKE %s")
+        params.append(prefix + '%')
+
+    return clauses, params
+
+
+def event_filters(args):
+    clauses = []
+    params = []
+
+    if args.get('shipment_id'):
+        _in('e.shipment_id', _ids('shipment_id', args['shipment_id']), clauses, params)
+    if args.get('event_type'):
+        _in('e.event_type', _choices('event_type', args['event_type'], EVENT_TYPES), clauses, params)
+    if args.get('location_id'):
+        _in('e.location_id', _ids('location_id', args['location_id']), clauses, params)
+    _date_range(args, 'event', 'e.event_timestamp', clauses, params)
+
+    return clauses, params
+
+
+def order_by(args, keys, default, tiebreaker):
+    """
+    Builds ORDER BY from ?sort=-created_at,status (a leading - sorts descending)
+    """
+    # ?sort=, or a blank value names no keys; sort as if it was left out
+    sort = _split(args.get('sort') or '') or _split(default)
+    terms = []
+    for key in sort:
+        direction = 'DESC' if key.startswith('-') else 'ASC'
+        key = key.lstrip('-+')
+        if key not in keys:
+            raise ValueError(f"Invalid sort key '{key}'. Allowed keys: {', '.join(keys)}")
+        terms.append(f"{keys[key]} {direction}")
+
+    # A unique last key keeps limit/offset pages stable
+    if not any(term.startswith(tiebreaker + ' ') for term in terms):
+        terms.append(f"{tiebreaker} {terms[-1].rsplit(' ', 1)[1]}")
+    return " ORDER BY " + ", ".join(terms)
+
+
+def pagination(args):
+    """
+    Returns (limit, offset); without ?limit a page holds DEFAULT_LIMIT rows
+    """
+    try:
+        limit = int(args['limit']) if args.get('limit') else DEFAULT_LIMIT
+        offset = int(args.get('offset') or 0)
+    except ValueError:
+        raise ValueError("limit and offset must be integers")
+    if limit < 1 or offset < 0:
+        raise ValueError("limit must be positive and offset must not be negative")
+    return min(limit, MAX_LIMIT), offset
+
+
+def apply_pagination(query, params, limit, offset):
+    # One extra row tells the caller whether another page exists
+    if limit is None:
+        return query, params
+    return query + " LIMIT %s OFFSET %s", params + [limit + 1, offset]
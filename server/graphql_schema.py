@@ -0,0 +1,479 @@
+"""
+GraphQL schema over shipments and their reference data.
+
+Nested fields go through per-request DataLoaders, so a selection such as
+shipments { customer items events { location } } costs one query per level
+instead of one per parent row. Queries are rejected before execution when
+their depth or estimated complexity is over the configured limits.
+"""
+import graphene
+from graphql import parse
+from graphql.error import GraphQLError, format_error
+from graphql.language import ast
+from promise import Promise
+from promise.dataloader import DataLoader
+
+import archive
+import filters
+
+# Most recent shipments returned under a customer or driver
+NESTED_SHIPMENTS_LIMIT = 50
+MAX_PAGE_SIZE = 100
+
+# List fields and the row count assumed when no limit is given; shipments
+# nested under a customer or driver always count as NESTED_SHIPMENTS_LIMIT
+LIST_FIELD_SIZES = {
+    'shipments': 20,
+    'customers': 20,
+    'drivers': 20,
+    'vehicles': 20,
+    'locations': 20,
+    'routes': 20,
+    'items': 10,
+    'events': 10,
+}
+
+
+def _fetch(cursor_factory, query, params):
+    cur = cursor_factory()
+    try:
+        cur.execute(query, params)
+        return cur.fetchall()
+    finally:
+        cur.close()
+
+
+class RowLoader(DataLoader):
+    """
+    Loads single rows by key with one IN (...) query per batch
+    """
+
+    def __init__(self, cursor_factory, query, key_column):
+        super().__init__()
+        self.cursor_factory = cursor_factory
+        self.query = query
+        self.key_column = key_column
+
+    def batch_load_fn(self, keys):
+        placeholders = ', '.join(['%s'] * len(keys))
+        rows = _fetch(self.cursor_factory, f"{self.query} WHERE {self.key_column} IN ({placeholders})", list(keys))
+        by_key = {row[self.key_column.split('.')[-1]]: row for row in rows}
+        return Promise.resolve([by_key.get(key) for key in keys])
+
+
+class GroupLoader(DataLoader):
+    """
+    Loads the child rows of many parents with one query, optionally keeping only the
+    first per_key_limit rows of each parent in the given order
+    """
+
+    def __init__(self, cursor_factory, table, key_column, order_by, per_key_limit=None):
+        super().__init__()
+        self.cursor_factory = cursor_factory
+        self.table = table
+        self.key_column = key_column
+        self.order_by = order_by
+        self.per_key_limit = per_key_limit
+
+    def batch_load_fn(self, keys):
+        placeholders = ', '.join(['%s'] * len(keys))
+        params = list(keys)
+        if self.per_key_limit:
+            query = f"""
+                SELECT * FROM (
+                    SELECT t.*, ROW_NUMBER() OVER (PARTITION BY t.{self.key_column} ORDER BY {self.order_by}) as row_num
+                    FROM {self.table} t
+                    WHERE t.{self.key_column} IN ({placeholders})
+                ) ranked
+                WHERE row_num <= %s
+                ORDER BY {self.key_column}, row_num
+            """
+            params.append(self.per_key_limit)
+        else:
+            query = f"""
+                SELECT t.* FROM {self.table} t
+                WHERE t.{self.key_column} IN ({placeholders})
+                ORDER BY t.{self.key_column}, {self.order_by}
+            """
+
+        groups = {key: [] for key in keys}
+        for row in _fetch(self.cursor_factory, query, params):
+            groups[row[self.key_column]].append(row)
+        return Promise.resolve([groups[key] for key in keys])
+
+
+CUSTOMER_QUERY = """
+    SELECT c.*, u.full_name, u.email, u.phone
+    FROM customers c JOIN users u ON c.user_id = u.user_id
+"""
+
+DRIVER_QUERY = """
+    SELECT d.*, u.full_name, u.email, u.phone
+    FROM drivers d JOIN users u ON d.user_id = u.user_id
+"""
+
+SHIPMENT_QUERY = f"SELECT {archive.SHIPMENT_COLUMNS} FROM shipments"
+
+
+class Loaders:
+    """
+    One set of loaders per request, so batching and caching never cross requests
+    """
+
+    def __init__(self, cursor_factory):
+        self.shipment = RowLoader(cursor_factory, SHIPMENT_QUERY, 'shipment_id')
+        self.customer = RowLoader(cursor_factory, CUSTOMER_QUERY, 'c.customer_id')
+        self.driver = RowLoader(cursor_factory, DRIVER_QUERY, 'd.driver_id')
+        self.vehicle = RowLoader(cursor_factory, "SELECT * FROM vehicles", 'vehicle_id')
+        self.location = RowLoader(cursor_factory, "SELECT * FROM locations", 'location_id')
+        self.route = RowLoader(cursor_factory, "SELECT * FROM routes", 'route_id')
+        self.items_by_shipment = GroupLoader(cursor_factory, 'shipment_items', 'shipment_id', 't.item_id')
+        self.events_by_shipment = GroupLoader(cursor_factory, 'tracking_events', 'shipment_id', 't.event_timestamp')
+        self.shipments_by_customer = GroupLoader(
+            cursor_factory, 'shipments', 'customer_id', 't.created_at DESC', NESTED_SHIPMENTS_LIMIT
+        )
+        self.shipments_by_driver = GroupLoader(
+            cursor_factory, 'shipments', 'driver_id', 't.created_at DESC', NESTED_SHIPMENTS_LIMIT
+        )
+
+
+class Context:
+    def __init__(self, cursor_factory):
+        self.cursor_factory = cursor_factory
+        self.loaders = Loaders(cursor_factory)
+
+
+def _load(loader, key):
+    return loader.load(key) if key is not None else None
+
+
+class Location(graphene.ObjectType):
+    location_id = graphene.Int()
+    address = graphene.String()
+    city = graphene.String()
+    state = graphene.String()
+    country = graphene.String()
+    postal_code = graphene.String()
+    latitude = graphene.Float()
+    longitude = graphene.Float()
+    location_type = graphene.String()
+
+
+class Route(graphene.ObjectType):
+    route_id = graphene.Int()
+    route_name = graphene.String()
+    distance_km = graphene.Float()
+    estimated_duration_min = graphene.Int()
+    status = graphene.String()
+    hazard_level = graphene.String()
+    origin = graphene.Field(Location)
+    destination = graphene.Field(Location)
+
+    def resolve_origin(parent, info):
+        return _load(info.context.loaders.location, parent['origin_id'])
+
+    def resolve_destination(parent, info):
+        return _load(info.context.loaders.location, parent['destination_id'])
+
+
+class Vehicle(graphene.ObjectType):
+    vehicle_id = graphene.Int()
+    license_plate = graphene.String()
+    make = graphene.String()
+    model = graphene.String()
+    year = graphene.Int()
+    capacity_kg = graphene.Float()
+    vehicle_type = graphene.String()
+    status = graphene.String()
+    last_inspection_date = graphene.Date()
+    current_location = graphene.Field(Location)
+
+    def resolve_current_location(parent, info):
+        return _load(info.context.loaders.location, parent['current_location_id'])
+
+
+class ShipmentItem(graphene.ObjectType):
+    item_id = graphene.Int()
+    shipment_id = graphene.Int()
+    description = graphene.String()
+    quantity = graphene.Int()
+    weight = graphene.Float()
+    volume = graphene.Float()
+    item_value = graphene.Float()
+    is_hazardous = graphene.Boolean()
+    is_fragile = graphene.Boolean()
+
+
+class TrackingEvent(graphene.ObjectType):
+    event_id = graphene.Int()
+    shipment_id = graphene.Int()
+    event_type = graphene.String()
+    event_timestamp = graphene.DateTime()
+    recorded_by = graphene.Int()
+    notes = graphene.String()
+    location = graphene.Field(Location)
+
+    def resolve_location(parent, info):
+        return _load(info.context.loaders.location, parent['location_id'])
+
+
+class Customer(graphene.ObjectType):
+    customer_id = graphene.Int()
+    user_id = graphene.Int()
+    company_name = graphene.String()
+    full_name = graphene.String()
+    email = graphene.String()
+    phone = graphene.String()
+    credit_limit = graphene.Float()
+    payment_terms = graphene.String()
+    shipments = graphene.List(lambda: Shipment, description=f"Most recent {NESTED_SHIPMENTS_LIMIT} shipments")
+
+    def resolve_shipments(parent, info):
+        return info.context.loaders.shipments_by_customer.load(parent['customer_id'])
+
+
+class Driver(graphene.ObjectType):
+    driver_id = graphene.Int()
+    user_id = graphene.Int()
+    full_name = graphene.String()
+    email = graphene.String()
+    phone = graphene.String()
+    license_number = graphene.String()
+    license_expiry = graphene.Date()
+    medical_check_date = graphene.Date()
+    training_certification = graphene.String()
+    status = graphene.String()
+    shipments = graphene.List(lambda: Shipment, description=f"Most recent {NESTED_SHIPMENTS_LIMIT} shipments")
+
+    def resolve_shipments(parent, info):
+        return info.context.loaders.shipments_by_driver.load(parent['driver_id'])
+
+
+class Shipment(graphene.ObjectType):
+    shipment_id = graphene.Int()
+    tracking_number = graphene.String()
+    status = graphene.String()
+    total_weight = graphene.Float()
+    total_volume = graphene.Float()
+    shipment_value = graphene.Float()
+    insurance_required = graphene.Boolean()
+    special_instructions = graphene.String()
+    created_at = graphene.DateTime()
+    pickup_date = graphene.DateTime()
+    estimated_delivery = graphene.DateTime()
+    actual_delivery = graphene.DateTime()
+    customer = graphene.Field(Customer)
+    driver = graphene.Field(Driver)
+    vehicle = graphene.Field(Vehicle)
+    route = graphene.Field(Route)
+    origin = graphene.Field(Location)
+    destination = graphene.Field(Location)
+    items = graphene.List(ShipmentItem)
+    events = graphene.List(TrackingEvent)
+
+    def resolve_customer(parent, info):
+        return _load(info.context.loaders.customer, parent['customer_id'])
+
+    def resolve_driver(parent, info):
+        return _load(info.context.loaders.driver, parent['driver_id'])
+
+    def resolve_vehicle(parent, info):
+        return _load(info.context.loaders.vehicle, parent['vehicle_id'])
+
+    def resolve_route(parent, info):
+        return _load(info.context.loaders.route, parent['route_id'])
+
+    def resolve_origin(parent, info):
+        return _load(info.context.loaders.location, parent['origin_id'])
+
+    def resolve_destination(parent, info):
+        return _load(info.context.loaders.location, parent['destination_id'])
+
+    def resolve_items(parent, info):
+        return info.context.loaders.items_by_shipment.load(parent['shipment_id'])
+
+    def resolve_events(parent, info):
+        return info.context.loaders.events_by_shipment.load(parent['shipment_id'])
+
+
+def _page(limit, offset):
+    if limit < 1 or offset < 0:
+        raise GraphQLError("limit must be positive and offset must not be negative")
+    return min(limit, MAX_PAGE_SIZE), offset
+
+
+def _list(info, query, limit, offset, order_by):
+    limit, offset = _page(limit, offset)
+    return _fetch(info.context.cursor_factory, f"{query} ORDER BY {order_by} LIMIT %s OFFSET %s", [limit, offset])
+
+
+class Query(graphene.ObjectType):
+    shipment = graphene.Field(Shipment, id=graphene.Int(), tracking_number=graphene.String())
+    shipments = graphene.List(
+        Shipment,
+        status=graphene.String(),
+        customer_id=graphene.Int(),
+        driver_id=graphene.Int(),
+        limit=graphene.Int(default_value=20),
+        offset=graphene.Int(default_value=0),
+    )
+    customer = graphene.Field(Customer, id=graphene.Int(required=True))
+    customers = graphene.List(Customer, limit=graphene.Int(default_value=20), offset=graphene.Int(default_value=0))
+    driver = graphene.Field(Driver, id=graphene.Int(required=True))
+    drivers = graphene.List(Driver, limit=graphene.Int(default_value=20), offset=graphene.Int(default_value=0))
+    vehicle = graphene.Field(Vehicle, id=graphene.Int(required=True))
+    vehicles = graphene.List(Vehicle, limit=graphene.Int(default_value=20), offset=graphene.Int(default_value=0))
+    location = graphene.Field(Location, id=graphene.Int(required=True))
+    locations = graphene.List(Location, limit=graphene.Int(default_value=20), offset=graphene.Int(default_value=0))
+    route = graphene.Field(Route, id=graphene.Int(required=True))
+    routes = graphene.List(Route, limit=graphene.Int(default_value=20), offset=graphene.Int(default_value=0))
+
+    def resolve_shipment(root, info, id=None, tracking_number=None):
+        if id is not None:
+            return info.context.loaders.shipment.load(id)
+        if tracking_number:
+            rows = _fetch(info.context.cursor_factory,
+                          f"{SHIPMENT_QUERY} WHERE tracking_number = %s", [tracking_number])
+            return rows[0] if rows else None
+        raise GraphQLError("shipment needs id or trackingNumber")
+
+    def resolve_shipments(root, info, limit, offset, status=None, customer_id=None, driver_id=None):
+        # Same validation and indexed filters as GET /api/shipments
+        args = {'status': status, 'customer_id': customer_id and str(customer_id),
+                'driver_id': driver_id and str(driver_id)}
+        try:
+            clauses, params = filters.shipment_filters(args)
+        except ValueError as e:
+            raise GraphQLError(str(e))
+        limit, offset = _page(limit, offset)
+        query = f"SELECT {archive.SHIPMENT_COLUMNS} FROM shipments s"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY s.created_at DESC, s.shipment_id DESC LIMIT %s OFFSET %s"
+        return _fetch(info.context.cursor_factory, query, params + [limit, offset])
+
+    def resolve_customer(root, info, id):
+        return info.context.loaders.customer.load(id)
+
+    def resolve_customers(root, info, limit, offset):
+        return _list(info, CUSTOMER_QUERY, limit, offset, 'c.customer_id')
+
+    def resolve_driver(root, info, id):
+        return info.context.loaders.driver.load(id)
+
+    def resolve_drivers(root, info, limit, offset):
+        return _list(info, DRIVER_QUERY, limit, offset, 'd.driver_id')
+
+    def resolve_vehicle(root, info, id):
+        return info.context.loaders.vehicle.load(id)
+
+    def resolve_vehicles(root, info, limit, offset):
+        return _list(info, "SELECT * FROM vehicles", limit, offset, 'vehicle_id')
+
+    def resolve_location(root, info, id):
+        return info.context.loaders.location.load(id)
+
+    def resolve_locations(root, info, limit, offset):
+        return _list(info, "SELECT * FROM locations", limit, offset, 'location_id')
+
+    def resolve_route(root, info, id):
+        return info.context.loaders.route.load(id)
+
+    def resolve_routes(root, info, limit, offset):
+        return _list(info, "SELECT * FROM routes", limit, offset, 'route_id')
+
+
+schema = graphene.Schema(query=Query)
+
+
+def _argument_value(value, variables):
+    if isinstance(value, ast.IntValue):
+        return int(value.value)
+    if isinstance(value, ast.Variable):
+        return (variables or {}).get(value.name.value)
+    return None
+
+
+def measure(document, variables=None):
+    """
+    Returns (depth, complexity) of a parsed query. Every field costs 1 and a list
+    field multiplies the cost of its selections by its limit (or an assumed size).
+    Variables left out of the request take their declared default.
+    """
+    fragments = {d.name.value: d for d in document.definitions if isinstance(d, ast.FragmentDefinition)}
+
+    def walk(selection_set, depth, seen, values):
+        max_depth = depth
+        cost = 0
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.FragmentSpread):
+                name = selection.name.value
+                if name in seen or name not in fragments:
+                    continue
+                d, c = walk(fragments[name].selection_set, depth, seen | {name}, values)
+            elif isinstance(selection, ast.InlineFragment):
+                d, c = walk(selection.selection_set, depth, seen, values)
+            else:
+                d, c = depth + 1, 1
+                if selection.selection_set:
+                    child_depth, child_cost = walk(selection.selection_set, depth + 1, seen, values)
+                    size = 1
+                    name = selection.name.value
+                    if name == 'shipments' and depth > 0:
+                        size = NESTED_SHIPMENTS_LIMIT
+                    elif name in LIST_FIELD_SIZES:
+                        size = LIST_FIELD_SIZES[name]
+                        for argument in selection.arguments or []:
+                            if argument.name.value == 'limit':
+                                limit = _argument_value(argument.value, values)
+                                if isinstance(limit, int):
+                                    size = min(max(limit, 1), MAX_PAGE_SIZE)
+                    d, c = child_depth, 1 + size * child_cost
+            max_depth = max(max_depth, d)
+            cost += c
+        return max_depth, cost
+
+    depth = 0
+    complexity = 0
+    for definition in document.definitions:
+        if isinstance(definition, ast.OperationDefinition):
+            values = {
+                v.variable.name.value: _argument_value(v.default_value, None)
+                for v in definition.variable_definitions or []
+                if v.default_value is not None
+            }
+            values.update(variables or {})
+            d, c = walk(definition.selection_set, 0, frozenset(), values)
+            depth = max(depth, d)
+            complexity += c
+    return depth, complexity
+
+
+def execute(query, cursor_factory, variables=None, operation_name=None, max_depth=8, max_complexity=5000):
+    """
+    Validates limits and runs a query; returns (payload, http status)
+    """
+    if not query:
+        return {'errors': [{'message': 'Must provide query string.'}]}, 400
+    try:
+        document = parse(query)
+    except GraphQLError as e:
+        return {'errors': [format_error(e)]}, 400
+
+    depth, complexity = measure(document, variables)
+    if depth > max_depth:
+        return {'errors': [{'message': f'Query depth {depth} exceeds the limit of {max_depth}'}]}, 400
+    if complexity > max_complexity:
+        return {'errors': [{'message': f'Query complexity {complexity} exceeds the limit of {max_complexity}'}]}, 400
+
+    result = schema.execute(
+        document,
+        context_value=Context(cursor_factory),
+        variable_values=variables,
+        operation_name=operation_name,
+    )
+    payload = {'data': result.data}
+    if result.errors:
+        payload['errors'] = [format_error(e) for e in result.errors]
+    # Queries that fail validation never ran
+    return payload, 400 if result.invalid else 200
@@ -0,0 +1,61 @@
+"""
+Production server settings: gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app) and shared copy-on-write
+by WEB_WORKERS forked workers, each serving WEB_THREADS requests at a time.
+MySQL connections are opened per request, so none exist at fork time; the
+per-process background threads (log writer, outbox relay, job scheduler,
+warm-up) are started in post_fork rather than waiting for each worker's first
+request.
+
+Signals to the master:
+  HUP   start a fresh set of workers, then gracefully stop the old ones
+        (settings are re-read; code stays as preloaded)
+  USR2  start a new master with new code next to the old one; then send
+        WINCH and QUIT to the old master once the new workers answer /readyz
+  TERM  graceful shutdown, waiting up to graceful_timeout for open requests
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+preload_app = True
+
+# Recycle each worker after this many requests (jittered so they do not all restart together)
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+
+timeout = 60
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = None
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    import outbox
+    import scheduler
+    import structured_log
+    import warmup
+    from app import app, mysql
+
+    structured_log.start(app.config)
+    outbox.start(app, mysql)
+    if app.config['SCHEDULER_ENABLED']:
+        scheduler.start(app, mysql)
+    if app.config['WARMUP_ENABLED']:
+        warmup.start(app, mysql)
+
+
+def worker_exit(server, worker):
+    import outbox
+    import scheduler
+    import structured_log
+
+    scheduler.stop()
+    outbox.stop()
+    structured_log.stop()
@@ -0,0 +1,90 @@
+"""
+Liveness and readiness checks for the load balancer.
+
+Liveness only says the process answers. Readiness takes a worker out of
+rotation when MySQL is slow or unreachable, when most of its database slots
+are busy, when the schema is older than this code expects, or while the
+first warm-up since the deploy is still running.
+"""
+import os
+import time
+
+import admission
+import outbox
+import response_cache
+import structured_log
+import warmup
+from schema_utils import SCHEMA_VERSION, schema_version
+
+_started = {'at': time.time()}
+
+# Workers forked from a preloaded master report their own uptime
+os.register_at_fork(after_in_child=lambda: _started.update(at=time.time()))
+
+
+def init_app(app):
+    app.config.setdefault('READY_MAX_DB_LATENCY_MS', 250)
+    app.config.setdefault('READY_MAX_DB_SATURATION', 0.9)
+
+
+def liveness():
+    return {
+        'status': 'ok',
+        'pid': os.getpid(),
+        'uptime_seconds': round(time.time() - _started['at'], 1),
+        'outbox_relay_running': outbox.is_running(),
+        'dropped_log_records': structured_log.dropped_records(),
+    }
+
+
+def _database_check(connection, max_latency_ms):
+    started = time.perf_counter()
+    try:
+        cur = connection.cursor()
+        try:
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            latency_ms = round((time.perf_counter() - started) * 1000, 2)
+            version = schema_version(cur)
+        finally:
+            cur.close()
+    except Exception as e:
+        return {'ok': False, 'error': str(e)}, {'ok': False, 'error': 'database unreachable'}
+
+    database = {'ok': latency_ms <= max_latency_ms, 'latency_ms': latency_ms, 'max_latency_ms': max_latency_ms}
+    schema = {'ok': version >= SCHEMA_VERSION, 'version': version, 'required': SCHEMA_VERSION}
+    return database, schema
+
+
+def readiness(get_connection, config):
+    """
+    Runs every check and returns (payload, ready); get_connection is only called here
+    """
+    try:
+        connection = get_connection()
+    except Exception as e:
+        database, schema = {'ok': False, 'error': str(e)}, {'ok': False, 'error': 'database unreachable'}
+    else:
+        database, schema = _database_check(connection, config['READY_MAX_DB_LATENCY_MS'])
+
+    slots = admission.stats()
+    saturation = slots.get('db_saturation', 0.0)
+    pool = {
+        'ok': saturation < config['READY_MAX_DB_SATURATION'],
+        'saturation': saturation,
+        'in_use': slots.get('db_in_use'),
+        'limit': slots.get('db_limit'),
+        'shed': slots.get('shed'),
+        'rate_limited': slots.get('rate_limited'),
+    }
+
+    cache = response_cache.get_cache()
+    checks = {
+        'database': database,
+        'schema': schema,
+        'pool': pool,
+        'cache': dict(cache.stats() if cache is not None else {}, ok=True),
+        'warmup': dict(warmup.status(), ok=warmup.ready()),
+    }
+    ready = all(check['ok'] for check in checks.values())
+    return {'status': 'ready' if ready else 'not_ready', 'checks': checks}, ready
@@ -0,0 +1,205 @@
+"""
+Idempotency-Key support for create endpoints.
+
+The first request with a key claims it in idempotency_keys and runs the view;
+its response is stored until the key expires. Retries with the same key and
+body get the stored response back without running the view again, a retry
+that arrives while the first attempt is still running gets a 409, and reusing
+a key for a different body gets a 422.
+
+The claim is inserted on the request's own connection and left uncommitted,
+so it commits together with the view's writes: if the first attempt dies
+before its commit the claim disappears with them and a retry runs the view
+afresh. A claim that is still in_progress once committed therefore means the
+create happened; such a key is never claimed again, even if the attempt died
+before its response was stored.
+"""
+import hashlib
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request, Response
+
+from db_errors import is_duplicate_key, is_lock_wait_timeout
+
+MAX_KEY_LENGTH = 255
+
+_state = {'mysql': None}
+
+
+def create_idempotency_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope VARCHAR(100) NOT NULL,
+            idem_key VARCHAR(255) NOT NULL,
+            request_hash CHAR(64) NOT NULL,
+            status ENUM('in_progress','completed') NOT NULL DEFAULT 'in_progress',
+            response_status SMALLINT NULL,
+            response_body MEDIUMBLOB NULL,
+            response_mimetype VARCHAR(100) NULL,
+            locked_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            PRIMARY KEY (scope, idem_key),
+            KEY idx_idempotency_expires (expires_at)
+        )
+    """)
+
+
+def init_app(app, mysql):
+    # How long a stored response is replayed, and how long a committed claim without a stored
+    # response is reported as still being processed before retries are told it was lost
+    app.config.setdefault('IDEMPOTENCY_TTL_SECONDS', 24 * 3600)
+    app.config.setdefault('IDEMPOTENCY_LOCK_SECONDS', 60)
+    # How long a retry waits on another attempt's uncommitted claim before its 409
+    app.config.setdefault('IDEMPOTENCY_CLAIM_WAIT_SECONDS', 1)
+    _state['mysql'] = mysql
+
+
+def _request_hash():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode('utf-8'))
+    digest.update(request.full_path.encode('utf-8'))
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+@contextmanager
+def _lock_wait(cur, seconds):
+    # innodb_lock_wait_timeout is per session; the connection's other statements keep theirs
+    cur.execute("SELECT @@SESSION.innodb_lock_wait_timeout AS seconds")
+    previous = cur.fetchone()['seconds']
+    cur.execute("SET SESSION innodb_lock_wait_timeout = %s", (seconds,))
+    try:
+        yield
+    finally:
+        cur.execute("SET SESSION innodb_lock_wait_timeout = %s", (previous,))
+
+
+def _claim(cur, connection, scope, key, request_hash):
+    """
+    Returns None when this request now owns the key, otherwise the existing row.
+    A new claim is left uncommitted; the view's commit makes it visible.
+    """
+    ttl = current_app.config['IDEMPOTENCY_TTL_SECONDS']
+    lock_seconds = current_app.config['IDEMPOTENCY_LOCK_SECONDS']
+    wait_seconds = current_app.config['IDEMPOTENCY_CLAIM_WAIT_SECONDS']
+    for _ in range(2):
+        try:
+            # Blocks while another attempt holds an uncommitted claim on the same key
+            with _lock_wait(cur, wait_seconds):
+                cur.execute("""
+                    INSERT INTO idempotency_keys (scope, idem_key, request_hash, expires_at)
+                    VALUES (%s, %s, %s, NOW() + INTERVAL %s SECOND)
+                """, (scope, key, request_hash, ttl))
+            return None
+        except Exception as e:
+            connection.rollback()
+            if is_lock_wait_timeout(e):
+                return {'request_hash': request_hash, 'status': 'in_progress', 'abandoned': False}
+            if not is_duplicate_key(e):
+                raise
+
+        cur.execute("""
+            SELECT request_hash, status, response_status, response_body, response_mimetype,
+                   expires_at < NOW() as expired,
+                   locked_at < NOW() - INTERVAL %s SECOND as abandoned
+            FROM idempotency_keys
+            WHERE scope = %s AND idem_key = %s
+        """, (lock_seconds, scope, key))
+        row = cur.fetchone()
+        if row is None:
+            continue
+        if not row['expired']:
+            return row
+
+        # Expired: free the key and claim it again
+        cur.execute("""
+            DELETE FROM idempotency_keys
+            WHERE scope = %s AND idem_key = %s AND request_hash = %s AND status = %s
+        """, (scope, key, row['request_hash'], row['status']))
+        connection.commit()
+    return None
+
+
+def _replay(row):
+    response = Response(row['response_body'], status=row['response_status'], mimetype=row['response_mimetype'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """
+    Honours an Idempotency-Key header on a create endpoint; requests without one run as before
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'success': False, 'error': f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+        connection = _state['mysql'].connection
+        scope = request.endpoint
+        request_hash = _request_hash()
+
+        cur = connection.cursor()
+        try:
+            existing = _claim(cur, connection, scope, key, request_hash)
+        finally:
+            cur.close()
+
+        if existing is not None:
+            if existing['request_hash'] != request_hash:
+                return jsonify({'success': False, 'error': 'Idempotency-Key was already used for a different request'}), 422
+            if existing['status'] == 'in_progress' and existing['abandoned']:
+                # The create committed but its response was never stored; running it again would duplicate it
+                return jsonify({
+                    'success': False,
+                    'error': 'The request with this Idempotency-Key was processed but its response is not available'
+                }), 409
+            if existing['status'] == 'in_progress':
+                response = jsonify({'success': False, 'error': 'A request with this Idempotency-Key is still being processed'})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            return _replay(existing)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            connection.rollback()
+            raise
+
+        if response.status_code >= 500:
+            # Server errors are not final: rolling back drops the claim unless the view already committed,
+            # in which case the key stays taken rather than letting a retry create the record again
+            connection.rollback()
+            return response
+
+        # A view that rolled back before answering took its claim with it; there is nothing to store then
+        cur = connection.cursor()
+        try:
+            cur.execute("""
+                UPDATE idempotency_keys
+                SET status = 'completed', response_status = %s, response_body = %s, response_mimetype = %s
+                WHERE scope = %s AND idem_key = %s
+            """, (response.status_code, response.get_data(), response.mimetype, scope, key))
+            connection.commit()
+        finally:
+            cur.close()
+        return response
+    return wrapper
+
+
+def purge_expired(cur, connection, batch_size=1000):
+    """
+    Deletes expired keys in small batches; returns how many were removed
+    """
+    removed = 0
+    while True:
+        cur.execute("DELETE FROM idempotency_keys WHERE expires_at < NOW() LIMIT %s", (batch_size,))
+        connection.commit()
+        removed += cur.rowcount
+        if cur.rowcount < batch_size:
+            return removed
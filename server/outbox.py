@@ -0,0 +1,483 @@
+"""
+Transactional outbox for shipment, item, tracking event, vehicle, driver and
+reference data changes.
+
+Endpoints call record() before they commit, so an outbox row exists exactly
+when the change does. A relay thread in every worker process reads new rows
+in id order and hands them to subscribers:
+
+* local subscribers (cache invalidation, SSE clients) see events from the
+  moment the process started, since their state lives in the process;
+* durable subscribers (webhooks) resume from a checkpoint in
+  outbox_checkpoints, and only the process holding their MySQL named lock
+  delivers them.
+
+Ids are assigned at insert but become visible at commit, so a transaction
+that commits late leaves a gap below ids already read. Each reader keeps the
+ids it skipped and looks for them again for OUTBOX_GAP_SECONDS; such an event
+is delivered when it shows up, after higher ids. A durable checkpoint stops
+below the oldest open gap, so a worker that takes over after a crash or
+restart may deliver some events a second time, never skip them.
+"""
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from datetime import date, datetime
+from decimal import Decimal
+
+import structured_log
+
+log = structured_log.get_logger()
+
+# Reconnect delay suggested to EventSource clients
+SSE_RETRY_MS = 3000
+
+# Skipped ids a reader keeps looking for; a larger jump in ids is not tracked
+MAX_GAPS = 1000
+
+_state = {'pid': None, 'thread': None, 'stop': None}
+_lock = threading.Lock()
+
+# name -> callable(list of events); registered at import time by the app
+_local_subscribers = {}
+_durable_subscribers = {}
+
+
+def create_outbox_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_events (
+            event_id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            aggregate_type VARCHAR(32) NOT NULL,
+            aggregate_id INT NOT NULL,
+            event_type VARCHAR(64) NOT NULL,
+            payload JSON NULL,
+            created_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+            KEY idx_outbox_aggregate (aggregate_type, aggregate_id, event_id),
+            KEY idx_outbox_created (created_at)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS outbox_checkpoints (
+            consumer VARCHAR(64) NOT NULL PRIMARY KEY,
+            last_event_id BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def record(cur, aggregate_type, aggregate_id, event_type, payload=None):
+    """
+    Adds an outbox row in the caller's transaction; commit it together with the change
+    """
+    cur.execute("""
+        INSERT INTO outbox_events (aggregate_type, aggregate_id, event_type, payload)
+        VALUES (%s, %s, %s, %s)
+    """, (aggregate_type, aggregate_id, event_type,
+          json.dumps(payload, default=_json_default) if payload is not None else None))
+
+
+def record_many(cur, events):
+    """
+    record() for many (aggregate_type, aggregate_id, event_type, payload) tuples in one statement
+    """
+    if not events:
+        return
+    cur.executemany("""
+        INSERT INTO outbox_events (aggregate_type, aggregate_id, event_type, payload)
+        VALUES (%s, %s, %s, %s)
+    """, [
+        (aggregate_type, aggregate_id, event_type,
+         json.dumps(payload, default=_json_default) if payload is not None else None)
+        for aggregate_type, aggregate_id, event_type, payload in events
+    ])
+
+
+def subscribe(name, handler, durable=False):
+    (_durable_subscribers if durable else _local_subscribers)[name] = handler
+
+
+def fetch_events(cur, after_id, limit, aggregate_type=None, aggregate_id=None, settle_seconds=0):
+    query = """
+        SELECT event_id, aggregate_type, aggregate_id, event_type, payload, created_at
+        FROM outbox_events
+        WHERE event_id > %s
+    """
+    params = [after_id]
+    if settle_seconds:
+        # Ids are assigned at insert but become visible at commit; leaving the newest rows
+        # for the next poll keeps a slower transaction's lower id from being skipped
+        query += " AND created_at <= NOW(3) - INTERVAL %s MICROSECOND"
+        params.append(int(settle_seconds * 1000000))
+    if aggregate_type:
+        query += " AND aggregate_type = %s"
+        params.append(aggregate_type)
+        if aggregate_id is not None:
+            query += " AND aggregate_id = %s"
+            params.append(aggregate_id)
+    query += " ORDER BY event_id LIMIT %s"
+    params.append(limit)
+
+    cur.execute(query, params)
+    return _events(cur.fetchall())
+
+
+def fetch_events_by_id(cur, event_ids):
+    cur.execute(f"""
+        SELECT event_id, aggregate_type, aggregate_id, event_type, payload, created_at
+        FROM outbox_events
+        WHERE event_id IN ({', '.join(['%s'] * len(event_ids))})
+        ORDER BY event_id
+    """, list(event_ids))
+    return _events(cur.fetchall())
+
+
+def _events(rows):
+    events = []
+    for row in rows:
+        payload = row['payload']
+        events.append({
+            'event_id': row['event_id'],
+            'aggregate_type': row['aggregate_type'],
+            'aggregate_id': row['aggregate_id'],
+            'event_type': row['event_type'],
+            'payload': json.loads(payload) if payload else None,
+            'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+        })
+    return events
+
+
+class Position:
+    """
+    How far a reader has got: the highest id read, and the lower ids it skipped
+    (by monotonic time first skipped) that it still looks for
+    """
+
+    def __init__(self, last_id, gap_seconds, gaps=None):
+        self.last_id = last_id
+        self.gap_seconds = gap_seconds
+        self.gaps = gaps or {}
+
+    @property
+    def checkpoint(self):
+        """
+        The id below which nothing is left to read
+        """
+        return min(self.gaps) - 1 if self.gaps else self.last_id
+
+    def read(self, cur, limit, settle_seconds):
+        """
+        Returns (events, the position after them): late arrivals from the gaps first,
+        then up to limit new events. The position itself is left as it was.
+        """
+        now = time.monotonic()
+        gaps = {event_id: seen for event_id, seen in self.gaps.items() if now - seen < self.gap_seconds}
+        late = fetch_events_by_id(cur, sorted(gaps)) if gaps else []
+        for event in late:
+            del gaps[event['event_id']]
+
+        events = fetch_events(cur, self.last_id, limit, settle_seconds=settle_seconds)
+        expected = self.last_id + 1
+        for event in events:
+            if event['event_id'] - expected <= MAX_GAPS - len(gaps):
+                gaps.update((event_id, now) for event_id in range(expected, event['event_id']))
+            expected = event['event_id'] + 1
+        last_id = events[-1]['event_id'] if events else self.last_id
+        return late + events, Position(last_id, self.gap_seconds, gaps)
+
+
+class Relay(threading.Thread):
+    def __init__(self, app, mysql, stop_event):
+        super().__init__(name='outbox-relay', daemon=True)
+        self.app = app
+        self.mysql = mysql
+        self.stop_event = stop_event
+        self.interval = app.config['OUTBOX_POLL_SECONDS']
+        self.batch_size = app.config['OUTBOX_BATCH_SIZE']
+        self.settle_seconds = app.config['OUTBOX_SETTLE_SECONDS']
+        self.gap_seconds = app.config['OUTBOX_GAP_SECONDS']
+        self.connection = None
+        self.local_position = None
+        # consumer -> Position, only for durable consumers whose lock this process holds
+        self.leading = {}
+        self.retry_at = {}
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stop_event.is_set():
+                try:
+                    busy = self.poll()
+                except Exception:
+                    log.exception("Outbox relay poll failed")
+                    self._reset_connection()
+                    busy = False
+                if not busy:
+                    self.stop_event.wait(self.interval)
+            self._reset_connection()
+
+    def _cursor(self):
+        if self.connection is None:
+            self.connection = self.mysql.connect
+            self.connection.autocommit(True)
+            self.leading = {}
+        return self.connection.cursor()
+
+    def _reset_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        # Closing the connection also released any named locks it held
+        self.connection = None
+        self.leading = {}
+
+    def poll(self):
+        cur = self._cursor()
+        try:
+            if self.local_position is None:
+                # Local subscribers only care about changes from now on
+                cur.execute("SELECT COALESCE(MAX(event_id), 0) as last_id FROM outbox_events")
+                self.local_position = Position(cur.fetchone()['last_id'], self.gap_seconds)
+
+            busy = False
+            events, position = self.local_position.read(cur, self.batch_size, self.settle_seconds)
+            if events:
+                for name, handler in list(_local_subscribers.items()):
+                    try:
+                        handler(events)
+                    except Exception:
+                        log.exception("Outbox subscriber failed", extra={'subscriber': name})
+                busy = position.last_id - self.local_position.last_id >= self.batch_size
+            self.local_position = position
+
+            for name, handler in list(_durable_subscribers.items()):
+                busy = self._deliver_durable(cur, name, handler) or busy
+            return busy
+        finally:
+            cur.close()
+
+    def _deliver_durable(self, cur, name, handler):
+        if name not in self.leading:
+            cur.execute("SELECT GET_LOCK(%s, 0) as acquired", (f'outbox:{name}',))
+            if not cur.fetchone()['acquired']:
+                return False
+            cur.execute("INSERT IGNORE INTO outbox_checkpoints (consumer, last_event_id) VALUES (%s, 0)", (name,))
+            cur.execute("SELECT last_event_id FROM outbox_checkpoints WHERE consumer = %s", (name,))
+            self.leading[name] = Position(cur.fetchone()['last_event_id'], self.gap_seconds)
+
+        if self.retry_at.get(name, 0) > time.monotonic():
+            return False
+
+        previous = self.leading[name]
+        events, position = previous.read(cur, self.batch_size, self.settle_seconds)
+        if not events:
+            # Gaps given up on can still move the checkpoint
+            self._save_checkpoint(cur, name, previous, position)
+            return False
+        try:
+            handler(events)
+        except Exception:
+            # Keep the checkpoint so the same batch is retried after a pause
+            log.exception("Durable outbox subscriber failed", extra={'subscriber': name})
+            self.retry_at[name] = time.monotonic() + self.app.config['OUTBOX_RETRY_SECONDS']
+            return False
+
+        self._save_checkpoint(cur, name, previous, position)
+        return position.last_id - previous.last_id >= self.batch_size
+
+    def _save_checkpoint(self, cur, name, previous, position):
+        if position.checkpoint != previous.checkpoint:
+            cur.execute("UPDATE outbox_checkpoints SET last_event_id = %s WHERE consumer = %s",
+                        (position.checkpoint, name))
+        self.leading[name] = position
+
+
+def init_app(app, mysql):
+    app.config.setdefault('OUTBOX_POLL_SECONDS', 1.0)
+    app.config.setdefault('OUTBOX_BATCH_SIZE', 500)
+    app.config.setdefault('OUTBOX_SETTLE_SECONDS', 0.5)
+    # How long a skipped id is looked for before it is taken to be rolled back
+    app.config.setdefault('OUTBOX_GAP_SECONDS', 60)
+    app.config.setdefault('OUTBOX_RETRY_SECONDS', 30)
+    app.config.setdefault('OUTBOX_RETENTION_DAYS', 7)
+    app.config.setdefault('OUTBOX_WEBHOOK_URLS', [
+        url for url in os.environ.get('OUTBOX_WEBHOOK_URLS', '').split(',') if url
+    ])
+    app.config.setdefault('OUTBOX_WEBHOOK_TIMEOUT', 5)
+    app.config.setdefault('SSE_HEARTBEAT_SECONDS', 15)
+    app.config.setdefault('SSE_QUEUE_SIZE', 1000)
+    # Every open stream holds a worker thread: cap them below WEB_THREADS, and end each
+    # after a while so the client reconnects (with Last-Event-ID) and the thread is shared
+    app.config.setdefault('SSE_MAX_CLIENTS', max(int(os.environ.get('WEB_THREADS', 8)) // 2, 1))
+    app.config.setdefault('SSE_MAX_STREAM_SECONDS', 300)
+    # Missed events sent per connection; a client further behind gets the rest after reconnecting
+    app.config.setdefault('SSE_BACKLOG_SIZE', 1000)
+
+    if app.config['OUTBOX_WEBHOOK_URLS']:
+        subscribe('webhooks', lambda events: deliver_webhooks(app.config, events), durable=True)
+    subscribe('sse', broadcaster.publish)
+
+    @app.before_request
+    def _ensure_relay():
+        start(app, mysql)
+
+
+def start(app, mysql):
+    """
+    Starts this process's relay thread (again, in a freshly forked worker)
+    """
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        stop_event = threading.Event()
+        relay = Relay(app, mysql, stop_event)
+        relay.start()
+        _state.update(pid=os.getpid(), thread=relay, stop=stop_event)
+
+
+def is_running():
+    thread = _state['thread']
+    return _state['pid'] == os.getpid() and thread is not None and thread.is_alive()
+
+
+def stop(timeout=5):
+    with _lock:
+        if _state['pid'] == os.getpid() and _state['stop'] is not None:
+            _state['stop'].set()
+            _state['thread'].join(timeout)
+        _state.update(pid=None, thread=None, stop=None)
+
+
+def purge_events(cur, connection, days, batch_size=1000):
+    """
+    Deletes events older than days that every durable subscriber has delivered;
+    returns how many were removed
+    """
+    delivered = None
+    if _durable_subscribers:
+        cur.execute(f"""
+            SELECT COALESCE(MIN(last_event_id), 0) as last_id
+            FROM outbox_checkpoints
+            WHERE consumer IN ({', '.join(['%s'] * len(_durable_subscribers))})
+        """, list(_durable_subscribers))
+        delivered = cur.fetchone()['last_id']
+
+    removed = 0
+    while True:
+        query = "DELETE FROM outbox_events WHERE created_at < NOW() - INTERVAL %s DAY"
+        params = [days]
+        if delivered is not None:
+            query += " AND event_id <= %s"
+            params.append(delivered)
+        cur.execute(query + " LIMIT %s", params + [batch_size])
+        connection.commit()
+        removed += cur.rowcount
+        if cur.rowcount < batch_size:
+            return removed
+
+
+def deliver_webhooks(config, events):
+    body = json.dumps({'events': events}).encode('utf-8')
+    for url in config['OUTBOX_WEBHOOK_URLS']:
+        req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(req, timeout=config['OUTBOX_WEBHOOK_TIMEOUT']) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"Webhook {url} answered {response.status}")
+
+
+class SseClient:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = False
+
+
+class Broadcaster:
+    """
+    Fans relay batches out to the SSE streams connected to this process
+    """
+
+    def __init__(self):
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    def connect(self, maxsize, max_clients):
+        """
+        Returns a new client, or None when max_clients streams are already open
+        """
+        client = SseClient(maxsize)
+        with self._lock:
+            if len(self._clients) >= max_clients:
+                return None
+            self._clients.add(client)
+        return client
+
+    def disconnect(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def publish(self, events):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            for event in events:
+                try:
+                    client.queue.put_nowait(event)
+                except queue.Full:
+                    # A client that stopped reading is cut off; it reconnects with Last-Event-ID
+                    client.dropped = True
+                    self.disconnect(client)
+                    break
+
+
+broadcaster = Broadcaster()
+
+
+def format_sse(event):
+    return f"id: {event['event_id']}\nevent: {event['event_type']}\ndata: {json.dumps(event)}\n\n"
+
+
+def stream(backlog, client, heartbeat_seconds, matches, max_seconds, more=False):
+    """
+    Yields SSE frames: missed events first, then live ones, with comment heartbeats,
+    for up to max_seconds. When more missed events remain than the backlog holds the
+    stream ends after the backlog, and the client picks up the rest on reconnecting.
+    """
+    try:
+        # Sent straight away so the client gets the response headers without waiting for an event
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        for event in backlog:
+            yield format_sse(event)
+        if more:
+            yield "retry: 0\n\n"
+            return
+        sent = {event['event_id'] for event in backlog}
+        deadline = time.monotonic() + max_seconds
+        while not client.dropped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                event = client.queue.get(timeout=min(heartbeat_seconds, remaining))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            # Live events are in the backlog when they committed while it was read; a late
+            # commit can arrive with an id below ones already sent
+            if event['event_id'] in sent or not matches(event):
+                continue
+            yield format_sse(event)
+    finally:
+        broadcaster.disconnect(client)
@@ -0,0 +1,207 @@
+"""
+Opt-in per-request CPU and memory profiling.
+
+A request is profiled when it carries X-Profile with the PROFILE_TOKEN value,
+or at random with probability PROFILE_SAMPLE_RATE. cProfile runs around the
+view and tracemalloc records what was still allocated at the end; the raw
+profile (.prof, readable with pstats or snakeviz) and a JSON summary with the
+hottest functions and top allocating lines go to PROFILE_DIR, which keeps the
+newest PROFILE_MAX_FILES summaries.
+
+Only one request per process is profiled at a time (the interpreter allows a
+single active profiler), and tracemalloc sees allocations from every thread
+while it runs, so memory figures are approximate under concurrency.
+"""
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+
+from flask import g, request
+
+import structured_log
+
+TOP_FUNCTIONS = 20
+TOP_ALLOCATIONS = 10
+
+# The request id may come from the client's X-Request-ID; keep it to filename-safe characters
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_-]')
+
+log = structured_log.get_logger()
+
+_lock = threading.Lock()
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+    app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    app.config.setdefault('PROFILE_DIR', os.environ.get(
+        'PROFILE_DIR',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'profiles')
+    ))
+    app.config.setdefault('PROFILE_MAX_FILES', 200)
+
+    @app.before_request
+    def _start_profile():
+        if not _wanted(app.config) or not _lock.acquire(blocking=False):
+            return
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        g.profile = {'profiler': profiler, 'started': time.perf_counter(), 'tracing': started_tracing}
+        profiler.enable()
+
+    @app.after_request
+    def _finish_profile(response):
+        state = g.pop('profile', None)
+        if state is None:
+            return response
+        try:
+            state['profiler'].disable()
+            duration_ms = (time.perf_counter() - state['started']) * 1000
+            allocations = _top_allocations(tracemalloc.take_snapshot())
+            if state['tracing']:
+                tracemalloc.stop()
+            profile_id = _write(app.config, state['profiler'], duration_ms, allocations, response.status_code)
+            response.headers['X-Profile-Id'] = profile_id
+        except Exception:
+            log.exception("Could not write request profile")
+        finally:
+            _lock.release()
+        return response
+
+    @app.teardown_request
+    def _abandon_profile(exc):
+        # after_request never ran (unhandled error): stop profiling and free the slot
+        state = g.pop('profile', None)
+        if state is not None:
+            state['profiler'].disable()
+            if state['tracing']:
+                tracemalloc.stop()
+            _lock.release()
+
+
+def _wanted(config):
+    token = config['PROFILE_TOKEN']
+    header = request.headers.get('X-Profile')
+    if token and header and hmac.compare_digest(header, token):
+        return True
+    rate = config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def hot_functions(stats, limit=TOP_FUNCTIONS):
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            'function': f'{os.path.basename(filename)}:{line}({name})',
+            'calls': calls,
+            'self_ms': round(tottime * 1000, 3),
+            'cumulative_ms': round(cumtime * 1000, 3),
+        })
+    rows.sort(key=lambda row: row['self_ms'], reverse=True)
+    return rows[:limit]
+
+
+def _top_allocations(snapshot):
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    return [
+        {'line': str(stat.traceback[0]), 'kib': round(stat.size / 1024, 1), 'blocks': stat.count}
+        for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]
+    ]
+
+
+def _write(config, profiler, duration_ms, allocations, status):
+    directory = config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+
+    endpoint = request.endpoint or 'unknown'
+    request_id = _UNSAFE_CHARS.sub('_', str(g.get('request_id', os.getpid())))
+    profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{endpoint}-{request_id}"
+    stats = pstats.Stats(profiler)
+    stats.dump_stats(os.path.join(directory, profile_id + '.prof'))
+
+    summary = {
+        'id': profile_id,
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'status': status,
+        'duration_ms': round(duration_ms, 2),
+        'sql_count': g.get('sql_count', 0),
+        'sql_ms': round(g.get('sql_ms', 0.0), 2),
+        'created_at': time.time(),
+        'hot_functions': hot_functions(stats),
+        'top_allocations': allocations,
+    }
+    with open(os.path.join(directory, profile_id + '.json'), 'w') as f:
+        json.dump(summary, f)
+
+    _rotate(directory, config['PROFILE_MAX_FILES'])
+    return profile_id
+
+
+def _rotate(directory, max_files):
+    summaries = sorted(name for name in os.listdir(directory) if name.endswith('.json'))
+    for name in summaries[:-max_files] if len(summaries) > max_files else []:
+        base = name[:-len('.json')]
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, base + suffix))
+            except OSError:
+                pass
+
+
+def recent_profiles(directory, endpoint=None, limit=50):
+    """
+    Newest summaries first, optionally only for one endpoint
+    """
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(directory), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if endpoint and summary.get('endpoint') != endpoint:
+            continue
+        profiles.append(summary)
+        if len(profiles) >= limit:
+            break
+    return profiles
+
+
+def route_hotspots(profiles, limit=10):
+    """
+    Per endpoint: how many profiles, their mean duration and the functions with the most self time overall
+    """
+    routes = {}
+    for summary in profiles:
+        route = routes.setdefault(summary['endpoint'], {'profiles': 0, 'total_ms': 0.0, 'functions': {}})
+        route['profiles'] += 1
+        route['total_ms'] += summary['duration_ms']
+        for row in summary['hot_functions']:
+            route['functions'][row['function']] = route['functions'].get(row['function'], 0.0) + row['self_ms']
+
+    return {
+        endpoint: {
+            'profiles': route['profiles'],
+            'mean_duration_ms': round(route['total_ms'] / route['profiles'], 2),
+            'hot_functions': [
+                {'function': name, 'self_ms': round(self_ms, 3)}
+                for name, self_ms in sorted(route['functions'].items(), key=lambda item: item[1], reverse=True)[:limit]
+            ],
+        }
+        for endpoint, route in routes.items()
+    }
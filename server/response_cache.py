@@ -0,0 +1,203 @@
+"""
+In-process cache of rendered JSON responses, kept together with their
+compressed variants so a cacheable payload is serialized and compressed once.
+
+Entries are keyed by endpoint and full path plus either the versions of the
+tables they were built from (the data_versions table, bumped by the endpoints
+that change those tables) or a TTL. Old entries fall out of a byte-capped LRU.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request, Response
+
+import compression
+
+_state = {'mysql': None, 'cache': None}
+
+# Local copy of data_versions, re-read at most once per VERSION_CHECK_SECONDS
+_versions = {'values': {}, 'loaded_at': 0.0}
+_versions_lock = threading.Lock()
+
+
+def create_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name VARCHAR(64) NOT NULL PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def bump(cur, *names):
+    """
+    Marks cached responses built from these tables as stale. Run it as the last
+    statement before the commit so the version row is locked only briefly.
+    """
+    for name in names:
+        cur.execute("""
+            INSERT INTO data_versions (name, version) VALUES (%s, 1)
+            ON DUPLICATE KEY UPDATE version = version + 1
+        """, (name,))
+    invalidate_local()
+
+
+def invalidate_local():
+    """
+    Forces the next lookup to re-read data_versions (called when another worker changed them)
+    """
+    with _versions_lock:
+        _versions['loaded_at'] = 0.0
+
+
+def current_versions(names):
+    interval = current_app.config['VERSION_CHECK_SECONDS']
+    with _versions_lock:
+        fresh = time.monotonic() - _versions['loaded_at'] < interval
+        values = _versions['values']
+        if fresh and all(name in values for name in names):
+            return tuple(values[name] for name in names)
+
+    cur = _state['mysql'].connection.cursor()
+    try:
+        cur.execute("SELECT name, version FROM data_versions")
+        loaded = {row['name']: row['version'] for row in cur.fetchall()}
+    finally:
+        cur.close()
+
+    with _versions_lock:
+        _versions.update(values=loaded, loaded_at=time.monotonic())
+    return tuple(loaded.get(name, 0) for name in names)
+
+
+class ResponseCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] is not None and entry['expires_at'] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry['size']
+            self._evict()
+
+    def add_variant(self, key, entry, encoding, body):
+        with self._lock:
+            if encoding in entry['bodies']:
+                return
+            entry['bodies'][encoding] = body
+            if self._entries.get(key) is entry:
+                entry['size'] += len(body)
+                self.size += len(body)
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry['size']
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+
+def init_app(app, mysql):
+    app.config.setdefault('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+    app.config.setdefault('VERSION_CHECK_SECONDS', 1.0)
+    _state['mysql'] = mysql
+    _state['cache'] = ResponseCache(app.config['RESPONSE_CACHE_MAX_BYTES'])
+
+
+def get_cache():
+    return _state['cache']
+
+
+def _serve(key, entry, cache_status):
+    etag = entry['etag']
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        body = entry['bodies'][None]
+        encoding = None
+        if len(body) >= current_app.config['COMPRESS_MIN_SIZE']:
+            encoding = compression.negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding:
+            if encoding not in entry['bodies']:
+                compressed = compression.compress(
+                    body, encoding,
+                    current_app.config['COMPRESS_LEVEL'],
+                    current_app.config['COMPRESS_BROTLI_QUALITY']
+                )
+                _state['cache'].add_variant(key, entry, encoding, compressed)
+            body = entry['bodies'][encoding]
+        response = Response(body, status=entry['status'], mimetype=entry['mimetype'])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+def cached_response(versions=(), ttl=None):
+    """
+    Caches successful GET responses of a view until one of the named data
+    versions changes or, for aggregates without a version, until ttl seconds pass
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = _state['cache']
+            if cache is None or request.method != 'GET':
+                return view(*args, **kwargs)
+
+            key = (request.endpoint, request.full_path, current_versions(versions) if versions else None)
+            entry = cache.get(key)
+            if entry is not None:
+                return _serve(key, entry, 'HIT')
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed or response.mimetype != 'application/json':
+                return response
+
+            body = response.get_data()
+            entry = {
+                'bodies': {None: body},
+                'status': response.status_code,
+                'mimetype': response.mimetype,
+                'etag': hashlib.sha1(repr(key).encode('utf-8') + body).hexdigest(),
+                'expires_at': time.monotonic() + ttl if ttl else None,
+                'size': len(body),
+            }
+            cache.put(key, entry)
+            return _serve(key, entry, 'MISS')
+        return wrapper
+    return decorator
@@ -0,0 +1,198 @@
+"""
+Daily shipment rollups behind the dashboard charts.
+
+shipment_daily_rollup keeps (day, customer_id, status) -> count and value sum.
+Triggers on shipments maintain it in the same transaction as every insert,
+status/value change and delete; backfill() rebuilds a date range from the
+raw (live and archived) shipments. The boot that creates the table fills it
+from the whole history, since the triggers only see changes from then on.
+"""
+from datetime import date, datetime, timedelta
+
+import archive
+from schema_utils import ensure_trigger, table_exists
+
+GRANULARITIES = ('day', 'week', 'month')
+
+_BUCKETS = {
+    'day': "r.day",
+    'week': "DATE_SUB(r.day, INTERVAL WEEKDAY(r.day) DAY)",
+    'month': "DATE_FORMAT(r.day, '%%Y-%%m-01')",
+}
+
+_LABELS = {
+    'day': '%Y-%m-%d',
+    'week': '%Y-%m-%d',
+    'month': '%b %Y',
+}
+
+
+def create_rollup_objects(cur):
+    """
+    Creates the rollup table and its triggers; returns True when the table is new and needs backfill()
+    """
+    created = not table_exists(cur, 'shipment_daily_rollup')
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS shipment_daily_rollup (
+            day DATE NOT NULL,
+            customer_id INT NOT NULL,
+            status ENUM('pending','picked_up','in_transit','delivered','returned') NOT NULL,
+            shipment_count INT NOT NULL DEFAULT 0,
+            total_value DECIMAL(16,2) NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, customer_id, status),
+            KEY idx_rollup_customer_day (customer_id, day)
+        )
+    """)
+
+    ensure_trigger(cur, 'shipments_rollup_insert', """
+    CREATE TRIGGER shipments_rollup_insert
+    AFTER INSERT ON shipments
+    FOR EACH ROW
+    BEGIN
+        INSERT INTO shipment_daily_rollup (day, customer_id, status, shipment_count, total_value)
+        VALUES (DATE(COALESCE(NEW.created_at, NOW())), NEW.customer_id, COALESCE(NEW.status, 'pending'), 1, NEW.shipment_value)
+        ON DUPLICATE KEY UPDATE
+            shipment_count = shipment_count + 1,
+            total_value = total_value + NEW.shipment_value;
+    END;
+    """)
+
+    ensure_trigger(cur, 'shipments_rollup_update', """
+    CREATE TRIGGER shipments_rollup_update
+    AFTER UPDATE ON shipments
+    FOR EACH ROW
+    BEGIN
+        IF NOT (OLD.status <=> NEW.status)
+           OR NOT (OLD.customer_id <=> NEW.customer_id)
+           OR NOT (OLD.created_at <=> NEW.created_at)
+           OR NOT (OLD.shipment_value <=> NEW.shipment_value) THEN
+            UPDATE shipment_daily_rollup
+            SET shipment_count = shipment_count - 1,
+                total_value = total_value - OLD.shipment_value
+            WHERE day = DATE(COALESCE(OLD.created_at, NOW()))
+              AND customer_id = OLD.customer_id
+              AND status = COALESCE(OLD.status, 'pending');
+
+            INSERT INTO shipment_daily_rollup (day, customer_id, status, shipment_count, total_value)
+            VALUES (DATE(COALESCE(NEW.created_at, NOW())), NEW.customer_id, COALESCE(NEW.status, 'pending'), 1, NEW.shipment_value)
+            ON DUPLICATE KEY UPDATE
+                shipment_count = shipment_count + 1,
+                total_value = total_value + NEW.shipment_value;
+        END IF;
+    END;
+    """)
+
+    # Rows moved to the archive still count towards history, so the archiver sets @archiving
+    ensure_trigger(cur, 'shipments_rollup_delete', """
+    CREATE TRIGGER shipments_rollup_delete
+    AFTER DELETE ON shipments
+    FOR EACH ROW
+    BEGIN
+        IF COALESCE(@archiving, 0) = 0 THEN
+            UPDATE shipment_daily_rollup
+            SET shipment_count = shipment_count - 1,
+                total_value = total_value - OLD.shipment_value
+            WHERE day = DATE(COALESCE(OLD.created_at, NOW()))
+              AND customer_id = OLD.customer_id
+              AND status = COALESCE(OLD.status, 'pending');
+        END IF;
+    END;
+    """)
+
+    return created
+
+def backfill(cur, connection, since=None):
+    """
+    Recomputes rollups from raw shipments one month per transaction
+    """
+    if since is None:
+        cur.execute(f"SELECT MIN(created_at) as oldest FROM {archive.SHIPMENTS_WITH_ARCHIVE} s")
+        oldest = cur.fetchone()['oldest']
+        if not oldest:
+            return {'months': 0, 'rows': 0}
+        since = oldest.date()
+
+    month = date(since.year, since.month, 1)
+    today = date.today()
+    months = 0
+    rows = 0
+    while month <= today:
+        start = max(month, since)
+        end = archive.add_months(month, 1)
+        try:
+            cur.execute("DELETE FROM shipment_daily_rollup WHERE day >= %s AND day < %s", (start, end))
+            cur.execute(f"""
+                INSERT INTO shipment_daily_rollup (day, customer_id, status, shipment_count, total_value)
+                SELECT DATE(s.created_at), s.customer_id, COALESCE(s.status, 'pending'),
+                       COUNT(*), COALESCE(SUM(s.shipment_value), 0)
+                FROM {archive.SHIPMENTS_WITH_ARCHIVE} s
+                WHERE s.created_at >= %s AND s.created_at < %s
+                GROUP BY DATE(s.created_at), s.customer_id, COALESCE(s.status, 'pending')
+            """, (start, end))
+            rows += cur.rowcount
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        months += 1
+        month = end
+
+    return {'months': months, 'rows': rows}
+
+
+def months_ago(today, months):
+    # Same calendar day N months back, clamped to the end of shorter months
+    first = archive.add_months(date(today.year, today.month, 1), -months)
+    next_month = archive.add_months(first, 1)
+    last_day = (next_month - timedelta(days=1)).day
+    return date(first.year, first.month, min(today.day, last_day))
+
+
+def parse_range(args, default_months=6):
+    """
+    Reads start/end/granularity query parameters; raises ValueError on bad input
+    """
+    granularity = args.get('granularity', 'month')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+
+    end = datetime.strptime(args['end'], '%Y-%m-%d').date() if args.get('end') else date.today()
+    if args.get('start'):
+        start = datetime.strptime(args['start'], '%Y-%m-%d').date()
+    else:
+        start = months_ago(end, default_months)
+    if start > end:
+        raise ValueError('start must not be after end')
+    return start, end, granularity
+
+
+def shipment_series(cur, start, end, granularity='month', customer_id=None):
+    bucket = _BUCKETS[granularity]
+    query = f"""
+        SELECT {bucket} as period_start,
+               SUM(r.shipment_count) as shipment_count,
+               SUM(CASE WHEN r.status = 'delivered' THEN r.shipment_count ELSE 0 END) as delivered,
+               SUM(r.total_value) as total_value
+        FROM shipment_daily_rollup r
+        WHERE r.day >= %s AND r.day <= %s
+    """
+    params = [start, end]
+    if customer_id is not None:
+        query += " AND r.customer_id = %s"
+        params.append(customer_id)
+    query += " GROUP BY period_start HAVING SUM(r.shipment_count) > 0 ORDER BY period_start ASC"
+
+    cur.execute(query, params)
+    series = []
+    for row in cur.fetchall():
+        period_start = row['period_start']
+        if isinstance(period_start, str):
+            period_start = datetime.strptime(period_start, '%Y-%m-%d').date()
+        series.append({
+            'period_start': period_start.isoformat(),
+            'label': period_start.strftime(_LABELS[granularity]),
+            'shipment_count': int(row['shipment_count'] or 0),
+            'delivered': int(row['delivered'] or 0),
+            'total_value': row['total_value']
+        })
+    return series
@@ -0,0 +1,475 @@
+"""
+In-process scheduler for recurring maintenance jobs.
+
+Jobs are registered at import time with either an interval (every=seconds)
+or a five-field cron expression (minute hour day-of-month month day-of-week,
+server local time). scheduled_jobs keeps each job's next and last run for all
+workers; every worker polls it, and when a job is due the first worker to
+take the MySQL named lock job:<name> advances next_run_at (plus a random
+jitter, so jobs sharing a schedule do not start together) and runs it on its
+own connection. Each run is logged in job_runs with its duration and result.
+
+A run that outlives its timeout has its connection killed, which aborts the
+statement in progress; the job's Python code is expected to fail on its next
+database call. SCHEDULER_JOB_OVERRIDES can change a job's schedule, jitter
+or timeout, or disable it with {'enabled': False}.
+"""
+import json
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import structured_log
+
+log = structured_log.get_logger()
+
+_state = {'pid': None, 'thread': None, 'stop': None}
+_lock = threading.Lock()
+
+# name -> (func, options), registered by the app
+_registry = {}
+
+# Jobs currently running in this process
+_running = set()
+_running_lock = threading.Lock()
+
+
+def create_scheduler_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            job_name VARCHAR(64) NOT NULL PRIMARY KEY,
+            schedule_spec VARCHAR(100) NOT NULL,
+            next_run_at DATETIME NOT NULL,
+            last_started_at DATETIME NULL,
+            last_finished_at DATETIME NULL,
+            last_status VARCHAR(16) NULL,
+            last_duration_ms INT NULL,
+            last_worker VARCHAR(100) NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS job_runs (
+            run_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            job_name VARCHAR(64) NOT NULL,
+            worker VARCHAR(100) NOT NULL,
+            status ENUM('running','succeeded','failed','timed_out') NOT NULL,
+            started_at DATETIME NOT NULL,
+            finished_at DATETIME NULL,
+            duration_ms INT NULL,
+            result TEXT NULL,
+            error TEXT NULL,
+            KEY idx_job_runs_job_started (job_name, started_at),
+            KEY idx_job_runs_started (started_at)
+        )
+    """)
+
+
+class IntervalSchedule:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def next_after(self, moment):
+        return moment + timedelta(seconds=self.seconds)
+
+    def __str__(self):
+        return f'every {self.seconds}s'
+
+
+class CronSchedule:
+    # (lowest, highest) per field: minute, hour, day of month, month, day of week (0 = Sunday)
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f'Cron expression needs 5 fields: {expression!r}')
+        self.expression = ' '.join(parts)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        # As in cron, a restricted day of month and day of week match either one
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for item in field.split(','):
+            spec, _, step = item.partition('/')
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = (int(value) for value in spec.split('-', 1))
+            else:
+                start = end = int(spec)
+                if step:
+                    end = high
+            # 7 is also Sunday in the day-of-week field
+            if high == 6 and end == 7:
+                values.add(0)
+                end = 6
+                if start == 7:
+                    continue
+            if start < low or end > high or start > end:
+                raise ValueError(f'Cron field {field!r} is outside {low}-{high}')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = candidate + timedelta(days=366 * 4)
+        while candidate < limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f'Cron expression never matches: {self.expression!r}')
+
+    def __str__(self):
+        return self.expression
+
+
+class Job:
+    def __init__(self, name, func, every=None, cron=None, jitter_seconds=0, timeout_seconds=300, enabled=True):
+        if (every is None) == (cron is None):
+            raise ValueError(f'Job {name} needs exactly one of every= or cron=')
+        self.name = name
+        self.func = func
+        self.schedule = IntervalSchedule(every) if every is not None else CronSchedule(cron)
+        self.jitter_seconds = jitter_seconds
+        self.timeout_seconds = timeout_seconds
+        self.enabled = enabled
+
+    def next_run(self, after):
+        return self.schedule.next_after(after) + timedelta(seconds=random.uniform(0, self.jitter_seconds))
+
+    def describe(self):
+        return {
+            'job_name': self.name,
+            'schedule': str(self.schedule),
+            'jitter_seconds': self.jitter_seconds,
+            'timeout_seconds': self.timeout_seconds,
+            'enabled': self.enabled,
+            'running_here': self.name in _running,
+        }
+
+
+def register(name, func, **options):
+    """
+    Adds a job; func(cur, connection) runs on a dedicated connection and may return a JSON-able result
+    """
+    _registry[name] = (func, options)
+
+
+def _options(options, override):
+    if 'every' in override or 'cron' in override:
+        # An overridden schedule replaces the registered one, whichever kind it was
+        options = {key: value for key, value in options.items() if key not in ('every', 'cron')}
+    return dict(options, **override)
+
+
+def jobs(config):
+    overrides = config['SCHEDULER_JOB_OVERRIDES']
+    return {
+        name: Job(name, func, **_options(options, overrides.get(name, {})))
+        for name, (func, options) in _registry.items()
+    }
+
+
+def init_app(app, mysql):
+    app.config.setdefault('SCHEDULER_ENABLED', True)
+    app.config.setdefault('SCHEDULER_POLL_SECONDS', 5)
+    # job name -> register() options to change, e.g. {'archive-shipments': {'enabled': True}}
+    app.config.setdefault('SCHEDULER_JOB_OVERRIDES', {})
+    app.config.setdefault('SCHEDULER_RUNS_KEPT_DAYS', 30)
+
+    register('purge-job-runs', lambda cur, connection: {
+        'removed': purge_runs(cur, connection, app.config['SCHEDULER_RUNS_KEPT_DAYS'])
+    }, cron='40 3 * * *', jitter_seconds=300)
+
+    @app.before_request
+    def _ensure_scheduler():
+        if app.config['SCHEDULER_ENABLED']:
+            start(app, mysql)
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _json_result(result):
+    if result is None:
+        return None
+    return json.dumps(result, default=str)
+
+
+class JobRun(threading.Thread):
+    def __init__(self, app, mysql, job):
+        super().__init__(name=f'job-{job.name}', daemon=True)
+        self.app = app
+        self.mysql = mysql
+        self.job = job
+        self.timed_out = False
+
+    def run(self):
+        with self.app.app_context():
+            try:
+                self._run()
+            except Exception:
+                log.exception("Scheduled job could not run", extra={'job': self.job.name})
+            finally:
+                with _running_lock:
+                    _running.discard(self.job.name)
+
+    def _kill(self, thread_id):
+        self.timed_out = True
+        with self.app.app_context():
+            connection = self.mysql.connect
+            try:
+                connection.cursor().execute("KILL CONNECTION %s", (thread_id,))
+            except Exception:
+                log.exception("Could not stop a scheduled job over its timeout", extra={'job': self.job.name})
+            finally:
+                connection.close()
+
+    def _run(self):
+        job = self.job
+        connection = self.mysql.connect
+        try:
+            cur = connection.cursor()
+            cur.execute("SELECT GET_LOCK(%s, 0) as acquired", (f'job:{job.name}',))
+            if not cur.fetchone()['acquired']:
+                return
+
+            # Holding the lock: check that no other worker ran the job since this one saw it due
+            cur.execute("SELECT next_run_at FROM scheduled_jobs WHERE job_name = %s", (job.name,))
+            row = cur.fetchone()
+            started_at = datetime.now()
+            if row is None or row['next_run_at'] > started_at:
+                return
+
+            worker = worker_name()
+            cur.execute("""
+                UPDATE scheduled_jobs
+                SET next_run_at = %s, last_started_at = %s, last_status = 'running', last_worker = %s
+                WHERE job_name = %s
+            """, (job.next_run(started_at), started_at, worker, job.name))
+            cur.execute("""
+                INSERT INTO job_runs (job_name, worker, status, started_at)
+                VALUES (%s, %s, 'running', %s)
+            """, (job.name, worker, started_at))
+            run_id = cur.lastrowid
+            connection.commit()
+
+            timer = threading.Timer(job.timeout_seconds, self._kill, (connection.thread_id(),))
+            timer.daemon = True
+            timer.start()
+            began = time.perf_counter()
+            result = error = None
+            try:
+                result = job.func(cur, connection)
+                status = 'succeeded'
+            except Exception as e:
+                status = 'timed_out' if self.timed_out else 'failed'
+                error = str(e)
+                log.exception("Scheduled job failed", extra={'job': job.name, 'timed_out': self.timed_out})
+            finally:
+                timer.cancel()
+            duration_ms = int((time.perf_counter() - began) * 1000)
+        finally:
+            # Also releases the named lock
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+        self._finish(run_id, status, duration_ms, result, error)
+
+    def _finish(self, run_id, status, duration_ms, result, error):
+        # On a fresh connection: the job's own may have been killed
+        connection = self.mysql.connect
+        try:
+            cur = connection.cursor()
+            finished_at = datetime.now()
+            cur.execute("""
+                UPDATE job_runs
+                SET status = %s, finished_at = %s, duration_ms = %s, result = %s, error = %s
+                WHERE run_id = %s
+            """, (status, finished_at, duration_ms, _json_result(result), error, run_id))
+            cur.execute("""
+                UPDATE scheduled_jobs
+                SET last_finished_at = %s, last_status = %s, last_duration_ms = %s
+                WHERE job_name = %s
+            """, (finished_at, status, duration_ms, self.job.name))
+            connection.commit()
+        finally:
+            connection.close()
+
+
+class Scheduler(threading.Thread):
+    def __init__(self, app, mysql, stop_event):
+        super().__init__(name='scheduler', daemon=True)
+        self.app = app
+        self.mysql = mysql
+        self.stop_event = stop_event
+        self.jobs = {name: job for name, job in jobs(app.config).items() if job.enabled}
+        self.connection = None
+        self.synced = False
+
+    def run(self):
+        with self.app.app_context():
+            while not self.stop_event.wait(self.app.config['SCHEDULER_POLL_SECONDS']):
+                try:
+                    self.tick()
+                except Exception:
+                    log.exception("Scheduler poll failed")
+                    self._reset_connection()
+            self._reset_connection()
+
+    def _cursor(self):
+        if self.connection is None:
+            self.connection = self.mysql.connect
+            self.connection.autocommit(True)
+        return self.connection.cursor()
+
+    def _reset_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+    def _sync(self, cur):
+        # New jobs are first due at their next scheduled time; a changed schedule resets next_run_at
+        now = datetime.now()
+        for job in self.jobs.values():
+            cur.execute("""
+                INSERT INTO scheduled_jobs (job_name, schedule_spec, next_run_at)
+                VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    next_run_at = IF(schedule_spec <> VALUES(schedule_spec), VALUES(next_run_at), next_run_at),
+                    schedule_spec = VALUES(schedule_spec)
+            """, (job.name, str(job.schedule), job.next_run(now)))
+        self.synced = True
+
+    def tick(self):
+        cur = self._cursor()
+        try:
+            if not self.synced:
+                self._sync(cur)
+            cur.execute("SELECT job_name FROM scheduled_jobs WHERE next_run_at <= %s", (datetime.now(),))
+            due = [row['job_name'] for row in cur.fetchall()]
+        finally:
+            cur.close()
+
+        for name in due:
+            job = self.jobs.get(name)
+            if job is None:
+                continue
+            with _running_lock:
+                if name in _running:
+                    continue
+                _running.add(name)
+            JobRun(self.app, self.mysql, job).start()
+
+
+def start(app, mysql):
+    """
+    Starts this process's scheduler thread (again, in a freshly forked worker)
+    """
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        stop_event = threading.Event()
+        scheduler = Scheduler(app, mysql, stop_event)
+        scheduler.start()
+        _state.update(pid=os.getpid(), thread=scheduler, stop=stop_event)
+        with _running_lock:
+            # Runs belonging to the parent process did not survive the fork
+            _running.clear()
+
+
+def stop(timeout=5):
+    with _lock:
+        if _state['pid'] == os.getpid() and _state['stop'] is not None:
+            _state['stop'].set()
+            _state['thread'].join(timeout)
+        _state.update(pid=None, thread=None, stop=None)
+
+
+def trigger(cur, connection, name):
+    """
+    Makes a job due now; returns False for an unknown job
+    """
+    cur.execute("UPDATE scheduled_jobs SET next_run_at = %s WHERE job_name = %s", (datetime.now(), name))
+    connection.commit()
+    return cur.rowcount > 0
+
+
+def recent_runs(cur, job_name=None, limit=50):
+    query = """
+        SELECT run_id, job_name, worker, status, started_at, finished_at, duration_ms, result, error
+        FROM job_runs
+    """
+    params = []
+    if job_name:
+        query += " WHERE job_name = %s"
+        params.append(job_name)
+    query += " ORDER BY started_at DESC, run_id DESC LIMIT %s"
+    params.append(limit)
+    cur.execute(query, params)
+    runs = cur.fetchall()
+    for run in runs:
+        if run['result']:
+            run['result'] = json.loads(run['result'])
+    return runs
+
+
+def job_states(cur, config, days=7):
+    """
+    Registered jobs with their persisted state and run durations over the last days
+    """
+    cur.execute("SELECT * FROM scheduled_jobs")
+    states = {row['job_name']: row for row in cur.fetchall()}
+    cur.execute("""
+        SELECT job_name, COUNT(*) as runs,
+               SUM(status = 'failed') as failed, SUM(status = 'timed_out') as timed_out,
+               ROUND(AVG(duration_ms)) as avg_duration_ms, MAX(duration_ms) as max_duration_ms
+        FROM job_runs
+        WHERE started_at >= NOW() - INTERVAL %s DAY
+        GROUP BY job_name
+    """, (days,))
+    durations = {row['job_name']: row for row in cur.fetchall()}
+    return [
+        dict(job.describe(), state=states.get(name), recent=durations.get(name))
+        for name, job in jobs(config).items()
+    ]
+
+
+def purge_runs(cur, connection, days, batch_size=1000):
+    removed = 0
+    while True:
+        cur.execute("DELETE FROM job_runs WHERE started_at < NOW() - INTERVAL %s DAY LIMIT %s", (days, batch_size))
+        connection.commit()
+        removed += cur.rowcount
+        if cur.rowcount < batch_size:
+            return removed
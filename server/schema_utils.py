@@ -0,0 +1,75 @@
+"""
+Small helpers for idempotent schema changes run from initialize_stored_procedures.
+"""
+
+
+def table_exists(cur, table):
+    cur.execute("""
+        SELECT 1 FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = %s
+        LIMIT 1
+    """, (table,))
+    return cur.fetchone() is not None
+
+
+def index_exists(cur, table, index_name):
+    cur.execute("""
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+    """, (table, index_name))
+    return cur.fetchone() is not None
+
+
+def ensure_index(cur, table, index_name, columns, kind='INDEX'):
+    # MySQL has no CREATE INDEX IF NOT EXISTS, so check information_schema first
+    if index_exists(cur, table, index_name):
+        return False
+    cur.execute(f"ALTER TABLE {table} ADD {kind} {index_name} ({columns})")
+    return True
+
+
+def trigger_exists(cur, trigger_name):
+    cur.execute("""
+        SELECT 1 FROM information_schema.triggers
+        WHERE trigger_schema = DATABASE() AND trigger_name = %s
+        LIMIT 1
+    """, (trigger_name,))
+    return cur.fetchone() is not None
+
+
+def ensure_trigger(cur, trigger_name, definition):
+    # Dropping and recreating on every boot would lose the writes made in between,
+    # so a trigger is only created when missing; give a changed trigger a new name
+    if trigger_exists(cur, trigger_name):
+        return False
+    cur.execute(definition)
+    return True
+
+
+# Raise when initialize_stored_procedures gains a schema change that this code depends on
+SCHEMA_VERSION = 4
+
+
+def create_schema_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            id TINYINT NOT NULL PRIMARY KEY,
+            version INT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def record_schema_version(cur):
+    # Never move the recorded version backwards while an older worker finishes its rollout
+    cur.execute("""
+        INSERT INTO schema_version (id, version) VALUES (1, %s)
+        ON DUPLICATE KEY UPDATE version = GREATEST(version, VALUES(version))
+    """, (SCHEMA_VERSION,))
+
+
+def schema_version(cur):
+    cur.execute("SELECT version FROM schema_version WHERE id = 1")
+    row = cur.fetchone()
+    return row['version'] if row else 0
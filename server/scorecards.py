@@ -0,0 +1,217 @@
+"""
+Driver scorecards over rolling windows.
+
+driver_scorecards keeps one row per (driver, window) with the on-time
+delivery rate, average lateness of delivered shipments (actual vs estimated
+delivery), deliveries per active day and returns/issues per 100 shipments.
+A shipment belongs to a window when it was delivered in it or, if not yet
+delivered, created in it.
+
+Rows are refreshed for the drivers touched by each outbox batch (a durable
+subscriber, so one worker does it) and in full by refresh_all, which also
+rolls the windows forward for drivers without new activity.
+"""
+from schema_utils import ensure_index
+
+WINDOWS = (7, 30, 90)
+
+LEADERBOARD_SORTS = {
+    'on_time_rate': 'sc.on_time_rate DESC',
+    'avg_lateness_minutes': 'sc.avg_lateness_minutes ASC',
+    'deliveries_per_active_day': 'sc.deliveries_per_active_day DESC',
+    'issues_per_100': 'sc.issues_per_100 ASC',
+    'returns_per_100': 'sc.returns_per_100 ASC',
+    'delivered': 'sc.delivered DESC',
+}
+
+# Drivers refreshed per statement
+CHUNK_SIZE = 200
+
+_METRIC_COLUMNS = (
+    'shipments', 'delivered', 'on_time', 'with_eta', 'on_time_rate', 'avg_lateness_minutes',
+    'active_days', 'deliveries_per_active_day', 'returned', 'returns_per_100', 'issues', 'issues_per_100',
+)
+
+
+def create_scorecard_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS driver_scorecards (
+            driver_id INT NOT NULL,
+            window_days SMALLINT NOT NULL,
+            shipments INT NOT NULL DEFAULT 0,
+            delivered INT NOT NULL DEFAULT 0,
+            on_time INT NOT NULL DEFAULT 0,
+            with_eta INT NOT NULL DEFAULT 0,
+            on_time_rate DECIMAL(5,4) NULL,
+            avg_lateness_minutes DECIMAL(10,1) NULL,
+            active_days INT NOT NULL DEFAULT 0,
+            deliveries_per_active_day DECIMAL(8,2) NULL,
+            returned INT NOT NULL DEFAULT 0,
+            returns_per_100 DECIMAL(8,2) NULL,
+            issues INT NOT NULL DEFAULT 0,
+            issues_per_100 DECIMAL(8,2) NULL,
+            computed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (driver_id, window_days),
+            KEY idx_scorecards_window_rate (window_days, on_time_rate)
+        )
+    """)
+    # Delivery and issue lookups per shipment
+    ensure_index(cur, 'tracking_events', 'idx_tracking_events_shipment_type', 'shipment_id, event_type')
+
+
+def _window_metrics(cur, driver_ids, window_days):
+    placeholders = ', '.join(['%s'] * len(driver_ids))
+    cur.execute(f"""
+        SELECT f.driver_id,
+               COUNT(*) as shipments,
+               SUM(f.status = 'delivered') as delivered,
+               SUM(f.status = 'delivered' AND f.estimated_delivery IS NOT NULL
+                   AND f.delivered_at <= f.estimated_delivery) as on_time,
+               SUM(f.status = 'delivered' AND f.estimated_delivery IS NOT NULL
+                   AND f.delivered_at IS NOT NULL) as with_eta,
+               AVG(CASE WHEN f.status = 'delivered' AND f.estimated_delivery IS NOT NULL
+                        THEN GREATEST(TIMESTAMPDIFF(MINUTE, f.estimated_delivery, f.delivered_at), 0) END)
+                   as avg_lateness_minutes,
+               SUM(f.status = 'returned') as returned,
+               SUM(f.issues) as issues
+        FROM (
+            SELECT s.driver_id, s.status, s.estimated_delivery,
+                   COALESCE(s.actual_delivery, (
+                       SELECT MAX(te.event_timestamp) FROM tracking_events te
+                       WHERE te.shipment_id = s.shipment_id AND te.event_type = 'delivery'
+                   )) as delivered_at,
+                   (
+                       SELECT COUNT(*) FROM tracking_events te
+                       WHERE te.shipment_id = s.shipment_id AND te.event_type IN ('issue', 'delay')
+                   ) as issues
+            FROM shipments s
+            WHERE s.driver_id IN ({placeholders})
+              AND (s.created_at >= NOW() - INTERVAL %s DAY OR s.actual_delivery >= NOW() - INTERVAL %s DAY)
+        ) f
+        GROUP BY f.driver_id
+    """, (*driver_ids, window_days, window_days))
+    metrics = {row['driver_id']: row for row in cur.fetchall()}
+
+    # A day counts as active when any of the driver's shipments had a tracking event
+    cur.execute(f"""
+        SELECT s.driver_id, COUNT(DISTINCT DATE(te.event_timestamp)) as active_days
+        FROM tracking_events te
+        JOIN shipments s ON s.shipment_id = te.shipment_id
+        WHERE s.driver_id IN ({placeholders})
+          AND te.event_timestamp >= NOW() - INTERVAL %s DAY
+        GROUP BY s.driver_id
+    """, (*driver_ids, window_days))
+    active_days = {row['driver_id']: row['active_days'] for row in cur.fetchall()}
+
+    rows = []
+    for driver_id in driver_ids:
+        row = metrics.get(driver_id, {})
+        shipments = int(row.get('shipments') or 0)
+        delivered = int(row.get('delivered') or 0)
+        on_time = int(row.get('on_time') or 0)
+        with_eta = int(row.get('with_eta') or 0)
+        returned = int(row.get('returned') or 0)
+        issues = int(row.get('issues') or 0)
+        days = active_days.get(driver_id, 0)
+        rows.append((
+            driver_id, window_days, shipments, delivered, on_time, with_eta,
+            round(on_time / with_eta, 4) if with_eta else None,
+            row.get('avg_lateness_minutes'),
+            days,
+            round(delivered / days, 2) if days else None,
+            returned,
+            round(returned * 100 / shipments, 2) if shipments else None,
+            issues,
+            round(issues * 100 / shipments, 2) if shipments else None,
+        ))
+    return rows
+
+
+def refresh_drivers(cur, connection, driver_ids, windows=WINDOWS):
+    """
+    Recomputes the scorecards of the given drivers, one transaction per chunk
+    """
+    driver_ids = sorted({int(driver_id) for driver_id in driver_ids if driver_id})
+    columns = ', '.join(('driver_id', 'window_days') + _METRIC_COLUMNS)
+    updates = ', '.join(f'{column} = VALUES({column})' for column in _METRIC_COLUMNS)
+    for start in range(0, len(driver_ids), CHUNK_SIZE):
+        chunk = driver_ids[start:start + CHUNK_SIZE]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        cur.execute(f"SELECT driver_id FROM drivers WHERE driver_id IN ({placeholders})", chunk)
+        existing = {row['driver_id'] for row in cur.fetchall()}
+        gone = [driver_id for driver_id in chunk if driver_id not in existing]
+        if gone:
+            cur.execute(f"DELETE FROM driver_scorecards WHERE driver_id IN ({', '.join(['%s'] * len(gone))})", gone)
+        chunk = [driver_id for driver_id in chunk if driver_id in existing]
+        if not chunk:
+            connection.commit()
+            continue
+
+        rows = []
+        for window_days in windows:
+            rows.extend(_window_metrics(cur, chunk, window_days))
+        cur.executemany(f"""
+            INSERT INTO driver_scorecards ({columns})
+            VALUES ({', '.join(['%s'] * (len(_METRIC_COLUMNS) + 2))})
+            ON DUPLICATE KEY UPDATE {updates}, computed_at = NOW()
+        """, rows)
+        connection.commit()
+    return len(driver_ids)
+
+
+def refresh_all(cur, connection):
+    cur.execute("SELECT driver_id FROM drivers")
+    return refresh_drivers(cur, connection, [row['driver_id'] for row in cur.fetchall()])
+
+
+def affected_drivers(cur, events):
+    """
+    Drivers whose scorecards an outbox batch may have changed
+    """
+    drivers = set()
+    shipment_ids = set()
+    for event in events:
+        if event['aggregate_type'] == 'driver':
+            drivers.add(event['aggregate_id'])
+        elif event['aggregate_type'] == 'shipment':
+            payload = event['payload'] or {}
+            for key in ('driver_id', 'previous_driver_id'):
+                if payload.get(key):
+                    drivers.add(payload[key])
+            if 'driver_id' not in payload:
+                shipment_ids.add(event['aggregate_id'])
+
+    shipment_ids = sorted(shipment_ids)
+    for start in range(0, len(shipment_ids), CHUNK_SIZE):
+        chunk = shipment_ids[start:start + CHUNK_SIZE]
+        cur.execute(
+            f"SELECT DISTINCT driver_id FROM shipments WHERE shipment_id IN ({', '.join(['%s'] * len(chunk))}) "
+            "AND driver_id IS NOT NULL",
+            chunk
+        )
+        drivers.update(row['driver_id'] for row in cur.fetchall())
+    return drivers
+
+
+def driver_scorecards(cur, driver_id):
+    cur.execute("""
+        SELECT * FROM driver_scorecards
+        WHERE driver_id = %s
+        ORDER BY window_days
+    """, (driver_id,))
+    return cur.fetchall()
+
+
+def leaderboard(cur, window_days, sort, limit, min_delivered=0):
+    cur.execute(f"""
+        SELECT sc.*, u.full_name,
+               RANK() OVER (ORDER BY {LEADERBOARD_SORTS[sort]}) as rank_position
+        FROM driver_scorecards sc
+        JOIN drivers d ON sc.driver_id = d.driver_id
+        JOIN users u ON d.user_id = u.user_id
+        WHERE sc.window_days = %s AND sc.delivered >= %s
+          AND sc.{sort} IS NOT NULL
+        ORDER BY {LEADERBOARD_SORTS[sort]}, sc.driver_id
+        LIMIT %s
+    """, (window_days, min_delivered, limit))
+    return cur.fetchall()
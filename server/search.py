@@ -0,0 +1,169 @@
+"""
+Search across shipments, customers, users and locations.
+
+Tracking numbers are matched by prefix on their unique index; free text uses
+InnoDB FULLTEXT indexes in boolean mode with every word required and
+prefix-matched. Each source is queried with its own LIMIT and the hits are
+merged by score.
+"""
+import re
+
+from schema_utils import ensure_index
+
+SEARCH_TYPES = ('shipment', 'customer', 'user', 'location')
+
+# InnoDB ignores shorter words unless innodb_ft_min_token_size is lowered
+MIN_TOKEN_SIZE = 3
+
+# Exact and prefix tracking number hits rank above any full-text relevance
+TRACKING_EXACT_SCORE = 1000.0
+TRACKING_PREFIX_SCORE = 500.0
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_TRACKING = re.compile(r'^[A-Za-z0-9-]{2,20}$')
+
+
+def create_search_indexes(cur):
+    ensure_index(cur, 'shipments', 'ft_shipments_instructions', 'special_instructions', kind='FULLTEXT INDEX')
+    ensure_index(cur, 'customers', 'ft_customers_company', 'company_name', kind='FULLTEXT INDEX')
+    ensure_index(cur, 'users', 'ft_users_full_name', 'full_name', kind='FULLTEXT INDEX')
+    ensure_index(cur, 'locations', 'ft_locations_address', 'address, city', kind='FULLTEXT INDEX')
+
+
+def boolean_query(text):
+    """
+    Turns user input into a boolean-mode query (+word* for every indexable word),
+    dropping operators so input can never change the query's meaning
+    """
+    words = [w for w in _WORD.findall(text) if len(w) >= MIN_TOKEN_SIZE]
+    return ' '.join(f'+{w}*' for w in words)
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _tracking_hits(cur, q, limit):
+    if not _TRACKING.match(q):
+        return []
+    cur.execute("""
+        SELECT shipment_id, tracking_number, status
+        FROM shipments
+        WHERE tracking_number LIKE %s
+        ORDER BY tracking_number
+        LIMIT %s
+    """, (_escape_like(q) + '%', limit))
+    return [{
+        'type': 'shipment',
+        'id': row['shipment_id'],
+        'title': row['tracking_number'],
+        'subtitle': row['status'],
+        'matched': 'tracking_number',
+        'score': TRACKING_EXACT_SCORE if row['tracking_number'].lower() == q.lower() else TRACKING_PREFIX_SCORE,
+    } for row in cur.fetchall()]
+
+
+def _shipment_hits(cur, terms, limit):
+    cur.execute("""
+        SELECT shipment_id, tracking_number, status, special_instructions,
+               MATCH(special_instructions) AGAINST (%s IN BOOLEAN MODE) as score
+        FROM shipments
+        WHERE MATCH(special_instructions) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY score DESC
+        LIMIT %s
+    """, (terms, terms, limit))
+    return [{
+        'type': 'shipment',
+        'id': row['shipment_id'],
+        'title': row['tracking_number'],
+        'subtitle': (row['special_instructions'] or '')[:120],
+        'matched': 'special_instructions',
+        'score': float(row['score']),
+    } for row in cur.fetchall()]
+
+
+def _customer_hits(cur, terms, limit):
+    cur.execute("""
+        SELECT customer_id, company_name,
+               MATCH(company_name) AGAINST (%s IN BOOLEAN MODE) as score
+        FROM customers
+        WHERE MATCH(company_name) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY score DESC
+        LIMIT %s
+    """, (terms, terms, limit))
+    return [{
+        'type': 'customer',
+        'id': row['customer_id'],
+        'title': row['company_name'],
+        'subtitle': None,
+        'matched': 'company_name',
+        'score': float(row['score']),
+    } for row in cur.fetchall()]
+
+
+def _user_hits(cur, terms, limit):
+    cur.execute("""
+        SELECT user_id, full_name, user_type,
+               MATCH(full_name) AGAINST (%s IN BOOLEAN MODE) as score
+        FROM users
+        WHERE MATCH(full_name) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY score DESC
+        LIMIT %s
+    """, (terms, terms, limit))
+    return [{
+        'type': 'user',
+        'id': row['user_id'],
+        'title': row['full_name'],
+        'subtitle': row['user_type'],
+        'matched': 'full_name',
+        'score': float(row['score']),
+    } for row in cur.fetchall()]
+
+
+def _location_hits(cur, terms, limit):
+    cur.execute("""
+        SELECT location_id, address, city, state,
+               MATCH(address, city) AGAINST (%s IN BOOLEAN MODE) as score
+        FROM locations
+        WHERE MATCH(address, city) AGAINST (%s IN BOOLEAN MODE)
+        ORDER BY score DESC
+        LIMIT %s
+    """, (terms, terms, limit))
+    return [{
+        'type': 'location',
+        'id': row['location_id'],
+        'title': f"{row['city']}, {row['state']}",
+        'subtitle': row['address'],
+        'matched': 'address',
+        'score': float(row['score']),
+    } for row in cur.fetchall()]
+
+
+_FULLTEXT_SOURCES = {
+    'shipment': _shipment_hits,
+    'customer': _customer_hits,
+    'user': _user_hits,
+    'location': _location_hits,
+}
+
+
+def search(cur, q, types=SEARCH_TYPES, limit=20):
+    q = q.strip()
+    hits = []
+    if 'shipment' in types:
+        hits.extend(_tracking_hits(cur, q, limit))
+
+    terms = boolean_query(q)
+    if terms:
+        for kind in types:
+            hits.extend(_FULLTEXT_SOURCES[kind](cur, terms, limit))
+
+    # A shipment can match on both tracking number and instructions; keep its best hit
+    best = {}
+    for hit in hits:
+        key = (hit['type'], hit['id'])
+        if key not in best or hit['score'] > best[key]['score']:
+            best[key] = hit
+
+    ranked = sorted(best.values(), key=lambda h: h['score'], reverse=True)
+    return ranked[:limit]
@@ -0,0 +1,183 @@
+"""
+In-process slow query log.
+
+The instrumented cursor reports every statement that takes SLOW_QUERY_MS or
+longer. Statements are grouped by their normalized text (literals and
+placeholders replaced by ?, IN lists collapsed); each group keeps counts and
+timings per route, the latest sample with redacted parameters and the rows
+MySQL examined and sent for it, and one EXPLAIN FORMAT=JSON taken the first
+time the statement was slow. The log is per worker process and bounded.
+"""
+import json
+import re
+import threading
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from MySQLdb.cursors import DictCursor
+
+import structured_log
+
+_HINT = re.compile(r'/\*\+.*?\*/')
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|%\(\w+\)s')
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|UPDATE|DELETE|INSERT|REPLACE)\b', re.IGNORECASE)
+
+log = structured_log.get_logger()
+
+
+def init_app(app):
+    app.config.setdefault('SLOW_QUERY_MS', 200)
+    app.config.setdefault('SLOW_QUERY_EXPLAIN', True)
+    app.config.setdefault('SLOW_QUERY_MAX_STATEMENTS', 500)
+
+
+def normalize(query):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    text = _HINT.sub('', query)
+    text = _STRING.sub('?', text)
+    text = _PLACEHOLDER.sub('?', text)
+    text = _NUMBER.sub('?', text)
+    text = ' '.join(text.split())
+    return _IN_LIST.sub('IN (...)', text)
+
+
+def _redact(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_redact(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _redact(item) for key, item in value.items()}
+    return f'<{type(value).__name__} len={len(str(value))}>'
+
+
+def redact_params(args):
+    """
+    Keeps numbers and NULLs (ids, limits); strings and dates only show their type and length
+    """
+    if args is None:
+        return None
+    return _redact(args)
+
+
+class SlowQueryLog:
+    def __init__(self):
+        self._statements = {}
+        self._lock = threading.Lock()
+
+    def add(self, fingerprint, route, duration_ms, sample, max_statements):
+        """
+        Records one slow execution; returns True the first time this statement is seen
+        """
+        with self._lock:
+            entry = self._statements.get(fingerprint)
+            first = entry is None
+            if first:
+                if len(self._statements) >= max_statements:
+                    # Forget the statement that has cost the least so far
+                    cheapest = min(self._statements, key=lambda key: self._statements[key]['total_ms'])
+                    del self._statements[cheapest]
+                entry = self._statements[fingerprint] = {
+                    'sql': fingerprint, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                    'routes': {}, 'last': None, 'explain': None,
+                }
+            entry['count'] += 1
+            entry['total_ms'] += duration_ms
+            entry['max_ms'] = max(entry['max_ms'], duration_ms)
+            entry['routes'][route] = entry['routes'].get(route, 0) + 1
+            entry['last'] = sample
+            return first
+
+    def set_explain(self, fingerprint, plan):
+        with self._lock:
+            if fingerprint in self._statements:
+                self._statements[fingerprint]['explain'] = plan
+
+    def top(self, limit, sort):
+        with self._lock:
+            entries = [dict(entry, routes=dict(entry['routes'])) for entry in self._statements.values()]
+        entries.sort(key=lambda entry: entry[sort], reverse=True)
+        for entry in entries:
+            entry['total_ms'] = round(entry['total_ms'], 2)
+            entry['max_ms'] = round(entry['max_ms'], 2)
+            entry['mean_ms'] = round(entry['total_ms'] / entry['count'], 2)
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+
+
+slow_log = SlowQueryLog()
+
+
+def _rows_examined(connection):
+    # Statistics of this connection's last finished statement (MySQL 8.0.16+ with performance_schema)
+    cur = connection.cursor(DictCursor)
+    try:
+        cur.execute("""
+            SELECT ROWS_EXAMINED as rows_examined, ROWS_SENT as rows_sent
+            FROM performance_schema.events_statements_history
+            WHERE THREAD_ID = PS_CURRENT_THREAD_ID()
+            ORDER BY EVENT_ID DESC
+            LIMIT 1
+        """)
+        return cur.fetchone() or {}
+    except Exception:
+        return {}
+    finally:
+        cur.close()
+
+
+def _explain(connection, query, args):
+    cur = connection.cursor(DictCursor)
+    try:
+        cur.execute("EXPLAIN FORMAT=JSON " + query, args)
+        row = cur.fetchone()
+        return json.loads(next(iter(row.values()))) if row else None
+    finally:
+        cur.close()
+
+
+def observe(cursor, query, args, elapsed_ms, error=None):
+    """
+    Called by the instrumented cursor after each statement; records it when it was slow
+    """
+    if not has_app_context():
+        return
+    config = current_app.config
+    threshold = config.get('SLOW_QUERY_MS')
+    if threshold is None or elapsed_ms < threshold:
+        return
+
+    try:
+        fingerprint = normalize(query)
+        route = request.endpoint if has_request_context() else None
+        sample = {
+            'at': time.time(),
+            'duration_ms': round(elapsed_ms, 2),
+            'request_id': g.get('request_id'),
+            'params': redact_params(args),
+            'rows_returned': cursor.rowcount if error is None else None,
+            'error': str(error.args[0]) if error is not None and error.args else None,
+        }
+        if error is None:
+            sample.update(_rows_examined(cursor.connection))
+
+        first = slow_log.add(fingerprint, route or 'background', elapsed_ms, sample,
+                             config['SLOW_QUERY_MAX_STATEMENTS'])
+        log.warning('slow query', extra={
+            'sql': fingerprint[:500],
+            'elapsed_ms': round(elapsed_ms, 2),
+            'rows_examined': sample.get('rows_examined'),
+        })
+
+        if first and config['SLOW_QUERY_EXPLAIN'] and isinstance(query, str) and _EXPLAINABLE.match(query):
+            slow_log.set_explain(fingerprint, _explain(cursor.connection, query, args))
+    except Exception:
+        # The slow log must never break the statement it is observing
+        log.exception("Could not record slow query")
@@ -0,0 +1,217 @@
+"""
+Queue-backed JSON-lines logging.
+
+Request threads only put records on a bounded in-memory queue (dropping and
+counting them if it is full); a background QueueListener thread formats and
+writes them. Every record carries the request id, route and, for access
+records, the SQL time spent inside the request.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+from flask import g, has_app_context, has_request_context, request
+
+LOGGER_NAME = 'eztransport'
+
+# Attributes every LogRecord has; anything else was passed through extra=
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_state = {'pid': None, 'listener': None, 'handler': None}
+_lock = threading.Lock()
+
+
+def get_logger(name=LOGGER_NAME):
+    return logging.getLogger(name)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge args now (they may change later) but leave JSON formatting to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # Never wait on a full queue from a request thread; count the loss instead
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Attaches request id and route, then applies per-route level and sampling controls
+    """
+
+    def __init__(self, route_levels=None):
+        super().__init__()
+        self.route_levels = {
+            route: logging.getLevelName(level) if isinstance(level, str) else level
+            for route, level in (route_levels or {}).items()
+        }
+
+    def filter(self, record):
+        if has_app_context():
+            request_id = g.get('request_id')
+            if request_id and not hasattr(record, 'request_id'):
+                record.request_id = request_id
+        if has_request_context() and request.endpoint:
+            if not hasattr(record, 'route'):
+                record.route = request.endpoint
+            min_level = self.route_levels.get(request.endpoint)
+            if min_level is not None and record.levelno < min_level:
+                return False
+            # Sampling only thins out routine records; warnings and errors always go through
+            if record.levelno < logging.WARNING and not g.get('log_sampled', True):
+                return False
+        return True
+
+
+def _start_listener(config):
+    q = queue.Queue(maxsize=config.get('LOG_QUEUE_SIZE', 10000))
+
+    log_file = config.get('LOG_FILE')
+    target = logging.FileHandler(log_file) if log_file else logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+
+    listener = logging.handlers.QueueListener(q, target, respect_handler_level=False)
+    listener.start()
+    return q, listener
+
+
+def start(config):
+    """
+    Starts (or, in a freshly forked worker, restarts) the background writer thread
+    """
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        q, listener = _start_listener(config)
+
+        logger = get_logger()
+        handler = _state['handler']
+        if handler is None:
+            handler = NonBlockingQueueHandler(q)
+            handler.addFilter(RequestContextFilter(config.get('LOG_ROUTE_LEVELS')))
+            logger.addHandler(handler)
+            logger.propagate = False
+        else:
+            # The parent's listener thread did not survive the fork; point at a fresh queue
+            handler.queue = q
+            handler.dropped = 0
+
+        logger.setLevel(config.get('LOG_LEVEL', 'INFO'))
+        _state.update(pid=os.getpid(), listener=listener, handler=handler)
+
+
+def stop():
+    with _lock:
+        listener = _state['listener']
+        if listener is not None and _state['pid'] == os.getpid():
+            listener.stop()
+        _state.update(pid=None, listener=None)
+
+
+atexit.register(stop)
+
+
+def dropped_records():
+    handler = _state['handler']
+    return handler.dropped if handler is not None else 0
+
+
+def init_app(app):
+    app.config.setdefault('LOG_LEVEL', os.environ.get('LOG_LEVEL', 'INFO'))
+    app.config.setdefault('LOG_FILE', os.environ.get('LOG_FILE'))
+    app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+    # endpoint name -> minimum level, e.g. {'get_shipments': 'WARNING'}
+    app.config.setdefault('LOG_ROUTE_LEVELS', {})
+    # endpoint name -> fraction of requests whose INFO/DEBUG records are kept
+    app.config.setdefault('LOG_ROUTE_SAMPLING', {})
+    app.config.setdefault('LOG_DEFAULT_SAMPLING', 1.0)
+
+    start(app.config)
+    logger = get_logger()
+
+    @app.before_request
+    def _assign_request_id():
+        start(app.config)
+        incoming = request.headers.get('X-Request-ID', '')
+        g.request_id = incoming if 0 < len(incoming) <= 64 else uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+        g.sql_count = 0
+        g.sql_ms = 0.0
+        rate = app.config['LOG_ROUTE_SAMPLING'].get(request.endpoint, app.config['LOG_DEFAULT_SAMPLING'])
+        g.log_sampled = rate >= 1.0 or random.random() < rate
+
+    @app.after_request
+    def _log_request(response):
+        request_id = g.get('request_id')
+        if request_id:
+            response.headers['X-Request-ID'] = request_id
+            started = g.get('request_started')
+            logger.info('request', extra={
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 2) if started else None,
+                'sql_count': g.get('sql_count', 0),
+                'sql_ms': round(g.get('sql_ms', 0.0), 2),
+            })
+        return response
+
+
+def record_sql(query, elapsed_ms):
+    """
+    Called by the instrumented cursor after every statement
+    """
+    if has_app_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_ms = g.get('sql_ms', 0.0) + elapsed_ms
+
+    logger = get_logger()
+    if logger.isEnabledFor(logging.DEBUG):
+        statement = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+        logger.debug('sql', extra={
+            'sql': ' '.join(statement.split())[:500],
+            'elapsed_ms': round(elapsed_ms, 2),
+        })
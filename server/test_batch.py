@@ -0,0 +1,42 @@
+"""
+Batch sub-requests and admission: run with python -m pytest from server/
+"""
+import pytest
+from flask import Flask, jsonify, request
+
+import admission
+import batch
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    admission.init_app(app)
+
+    @app.route('/api/in-use')
+    def in_use():
+        return jsonify(admission.stats()['db_in_use'])
+
+    @app.route('/api/batch', methods=['POST'])
+    def batch_route():
+        data = request.get_json()
+        items = batch.parse_requests(data, 10)
+        results = batch.run(app, items, request.headers, parallel=bool(data.get('parallel')),
+                            client=admission.client_key())
+        return jsonify(results)
+
+    return app.test_client()
+
+
+def test_in_order_sub_requests_keep_the_batch_slot(client):
+    response = client.post('/api/batch', json={'requests': [{'path': '/api/in-use'}] * 3})
+
+    assert [r['body'] for r in response.get_json()] == [1, 1, 1]
+    assert admission.stats()['db_in_use'] == 0
+
+
+def test_parallel_sub_requests_take_their_own_slots(client):
+    response = client.post('/api/batch', json={'requests': [{'path': '/api/in-use'}] * 3, 'parallel': True})
+
+    assert all(r['status'] == 200 and r['body'] >= 2 for r in response.get_json())
+    assert admission.stats()['db_in_use'] == 0
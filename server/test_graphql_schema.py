@@ -0,0 +1,53 @@
+"""
+GraphQL query measurement: run with python -m pytest from server/
+"""
+from graphql import parse
+
+from graphql_schema import MAX_PAGE_SIZE, NESTED_SHIPMENTS_LIMIT, measure
+
+
+def test_fields_cost_one_and_lists_multiply_by_their_limit():
+    assert measure(parse('{ shipment(id: 1) { shipment_id status } }')) == (2, 3)
+    assert measure(parse('{ shipments(limit: 5) { shipment_id status } }')) == (2, 11)
+
+
+def test_lists_without_a_limit_use_the_assumed_size():
+    assert measure(parse('{ customers { customer_id } }')) == (2, 21)
+
+
+def test_limit_is_clamped_to_the_page_size():
+    _, complexity = measure(parse('{ shipments(limit: 100000) { shipment_id } }'))
+
+    assert complexity == 1 + MAX_PAGE_SIZE
+
+
+def test_nested_shipments_cost_their_load_limit():
+    _, complexity = measure(parse('{ customer(id: 1) { shipments { shipment_id } } }'))
+
+    assert complexity == 1 + 1 + NESTED_SHIPMENTS_LIMIT
+
+
+def test_variables_and_their_defaults():
+    literal = parse('{ shipments(limit: 100) { items { description } events { notes } } }')
+    with_default = parse('query($n: Int = 100) { shipments(limit: $n) { items { description } events { notes } } }')
+
+    assert measure(with_default) == measure(literal) == (3, 2201)
+    assert measure(with_default, {'n': 2}) == (3, 45)
+
+
+def test_fragments_count_where_they_are_spread():
+    query = parse('''
+        { shipments(limit: 10) { ...Fields } }
+        fragment Fields on Shipment { shipment_id status }
+    ''')
+
+    assert measure(query) == (2, 21)
+
+
+def test_recursive_fragments_stop():
+    query = parse('''
+        { shipment(id: 1) { ...A } }
+        fragment A on Shipment { shipment_id ...A }
+    ''')
+
+    assert measure(query) == (2, 2)
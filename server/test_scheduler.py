@@ -0,0 +1,62 @@
+"""
+Cron schedules: run with python -m pytest from server/
+"""
+from datetime import datetime
+
+import pytest
+
+from scheduler import CronSchedule
+
+
+def test_next_after_skips_to_the_next_matching_minute():
+    schedule = CronSchedule('5 * * * *')
+
+    assert schedule.next_after(datetime(2026, 3, 10, 14, 5, 30)) == datetime(2026, 3, 10, 15, 5)
+    assert schedule.next_after(datetime(2026, 3, 10, 14, 4, 59)) == datetime(2026, 3, 10, 14, 5)
+
+
+def test_restricted_day_of_month_and_day_of_week_match_either():
+    # 13th of the month or any Friday; 2026-03-06 is a Friday
+    schedule = CronSchedule('0 0 13 * 5')
+
+    assert schedule.next_after(datetime(2026, 3, 1)) == datetime(2026, 3, 6)
+    assert schedule.next_after(datetime(2026, 3, 12)) == datetime(2026, 3, 13)
+
+
+def test_wildcard_day_of_month_leaves_only_day_of_week():
+    schedule = CronSchedule('0 6 * * 1')
+
+    # 2026-03-02 and 2026-03-09 are Mondays
+    assert schedule.next_after(datetime(2026, 3, 1)) == datetime(2026, 3, 2, 6)
+    assert schedule.next_after(datetime(2026, 3, 2, 6)) == datetime(2026, 3, 9, 6)
+
+
+def test_wildcard_day_of_week_leaves_only_day_of_month():
+    schedule = CronSchedule('30 2 31 * *')
+
+    assert schedule.next_after(datetime(2026, 4, 1)) == datetime(2026, 5, 31, 2, 30)
+
+
+def test_seven_is_sunday():
+    # 2026-03-08 is a Sunday
+    assert CronSchedule('0 0 * * 7').next_after(datetime(2026, 3, 2)) == datetime(2026, 3, 8)
+    assert CronSchedule('0 0 * * 5-7').weekdays == {0, 5, 6}
+
+
+def test_steps_and_lists():
+    schedule = CronSchedule('*/15 9-17/4 * * *')
+
+    assert schedule.minutes == {0, 15, 30, 45}
+    assert schedule.hours == {9, 13, 17}
+    assert CronSchedule('0 1,3 * * *').hours == {1, 3}
+
+
+@pytest.mark.parametrize('expression', ['* * * *', '60 * * * *', '0 0 0 * *', '0 0 * 13 *', '0 0 * * 8'])
+def test_invalid_expressions_are_rejected(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_expression_that_never_matches():
+    with pytest.raises(ValueError):
+        CronSchedule('0 0 31 2 *').next_after(datetime(2026, 1, 1))
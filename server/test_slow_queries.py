@@ -0,0 +1,40 @@
+"""
+SQL normalization and parameter redaction: run with python -m pytest from server/
+"""
+from datetime import date
+
+import pytest
+
+from slow_queries import normalize, redact_params
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("SELECT * FROM shipments WHERE shipment_id = 42", "SELECT * FROM shipments WHERE shipment_id = ?"),
+    ("SELECT * FROM shipments WHERE shipment_id = %s", "SELECT * FROM shipments WHERE shipment_id = ?"),
+    ("SELECT * FROM t WHERE a = %(name)s AND b = 1.5", "SELECT * FROM t WHERE a = ? AND b = ?"),
+    ("SELECT * FROM t WHERE note = 'it''s 7' OR note = 'a\\'b'", "SELECT * FROM t WHERE note = ? OR note = ?"),
+    ("SELECT * FROM t WHERE id IN (1, 2, 3)", "SELECT * FROM t WHERE id IN (...)"),
+    ("SELECT * FROM t WHERE id in (%s,%s)", "SELECT * FROM t WHERE id IN (...)"),
+    ("SELECT /*+ MAX_EXECUTION_TIME(3000) */ COUNT(*) FROM t", "SELECT COUNT(*) FROM t"),
+    ("SELECT *\n  FROM   t\n\tLIMIT 10", "SELECT * FROM t LIMIT ?"),
+    ("SELECT t1.a FROM t1 JOIN t2 ON t1.id = t2.id", "SELECT t1.a FROM t1 JOIN t2 ON t1.id = t2.id"),
+])
+def test_normalize(query, expected):
+    assert normalize(query) == expected
+
+
+def test_normalize_accepts_bytes():
+    assert normalize(b"SELECT 1") == "SELECT ?"
+
+
+def test_same_statement_with_different_values_groups_together():
+    assert (normalize("UPDATE drivers SET status = 'active' WHERE driver_id IN (1, 2)")
+            == normalize("UPDATE drivers SET status = %s WHERE driver_id IN (%s, %s, %s)"))
+
+
+def test_redact_params_keeps_numbers_and_hides_strings():
+    assert redact_params(None) is None
+    assert redact_params((7, None, 'secret', date(2026, 1, 2), [1, 'x'])) == [
+        7, None, '<str len=6>', '<date len=10>', [1, '<str len=1>'],
+    ]
+    assert redact_params({'id': 3, 'email': 'a@b.c'}) == {'id': 3, 'email': '<str len=5>'}
@@ -0,0 +1,45 @@
+"""
+Tracking number check digits: run with python -m pytest from server/
+"""
+import pytest
+
+import tracking_numbers
+from tracking_numbers import format_number, is_valid, luhn_digit
+
+
+@pytest.mark.parametrize('digits, check', [
+    ('7992739871', '3'),
+    ('000000000000', '0'),
+    ('000000000001', '8'),
+    ('123456789012', '8'),
+])
+def test_luhn_digit(digits, check):
+    assert luhn_digit(digits) == check
+
+
+def test_format_number_pads_and_appends_the_check_digit():
+    number = format_number(42)
+
+    assert number == 'EZ0000000000422'
+    assert len(number) == len(tracking_numbers.PREFIX) + tracking_numbers.DIGITS + 1
+    assert is_valid(number)
+
+
+def test_single_digit_changes_and_adjacent_swaps_are_caught():
+    number = format_number(123456789012)
+    body = number[len(tracking_numbers.PREFIX):]
+
+    for i in range(len(body)):
+        for digit in '0123456789':
+            if digit != body[i]:
+                assert not is_valid(tracking_numbers.PREFIX + body[:i] + digit + body[i + 1:])
+    for i in range(len(body) - 1):
+        swapped = body[:i] + body[i + 1] + body[i] + body[i + 2:]
+        # Luhn cannot see a 0/9 swap
+        if swapped != body and {body[i], body[i + 1]} != {'0', '9'}:
+            assert not is_valid(tracking_numbers.PREFIX + swapped)
+
+
+@pytest.mark.parametrize('number', ['', 'EZ', 'XX0000000000422', 'EZ000000000042', 'EZ00000000004x2'])
+def test_malformed_numbers_are_invalid(number):
+    assert not is_valid(number)
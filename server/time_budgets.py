@@ -0,0 +1,134 @@
+"""
+Per-endpoint time budgets for SQL.
+
+A view decorated with @time_budget(ms) gets a deadline when it starts. Every
+statement it runs through the instrumented cursor is limited to the time left:
+SELECTs carry a MAX_EXECUTION_TIME optimizer hint, anything else (CALL, or a
+statement the hint does not apply to) is watched by a timer that issues
+KILL QUERY from a separate connection. Once the budget is spent the view's
+response is replaced by a 504, whatever the view itself returned.
+"""
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, has_app_context, jsonify, make_response, request
+
+import structured_log
+from db_errors import is_query_timeout
+
+_SELECT = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+
+log = structured_log.get_logger()
+
+_state = {'mysql': None}
+_exceeded = {}
+_exceeded_lock = threading.Lock()
+_budgets = {}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def init_app(app, mysql):
+    app.config.setdefault('TIME_BUDGETS_ENABLED', True)
+    # endpoint name -> milliseconds, overriding the decorator's budget
+    app.config.setdefault('TIME_BUDGET_OVERRIDES', {})
+    _state['mysql'] = mysql
+
+
+def _kill_query(app, thread_id):
+    with app.app_context():
+        connection = _state['mysql'].connect
+        try:
+            connection.cursor().execute("KILL QUERY %s", (thread_id,))
+        except Exception:
+            log.exception("Could not cancel a query over its time budget")
+        finally:
+            connection.close()
+
+
+def before_execute(cursor, query):
+    """
+    Called by the instrumented cursor; returns the statement to run and a timer to cancel afterwards
+    """
+    if not has_app_context():
+        return query, None
+    deadline = g.get('sql_deadline')
+    if deadline is None:
+        return query, None
+
+    remaining_ms = int((deadline - time.perf_counter()) * 1000)
+    if remaining_ms <= 0:
+        g.sql_budget_exceeded = True
+        raise BudgetExceeded(f"SQL time budget of {g.sql_budget_ms} ms exceeded")
+
+    if isinstance(query, str) and _SELECT.match(query) and '/*+' not in query:
+        return _SELECT.sub(f'SELECT /*+ MAX_EXECUTION_TIME({remaining_ms}) */', query, count=1), None
+
+    timer = threading.Timer(
+        remaining_ms / 1000,
+        _kill_query,
+        (current_app._get_current_object(), cursor.connection.thread_id())
+    )
+    timer.daemon = True
+    timer.start()
+    return query, timer
+
+
+def after_execute(error):
+    if error is not None and has_app_context() and g.get('sql_deadline') is not None and is_query_timeout(error):
+        g.sql_budget_exceeded = True
+
+
+def _record_exceeded(endpoint, budget_ms):
+    with _exceeded_lock:
+        _exceeded[endpoint] = _exceeded.get(endpoint, 0) + 1
+    log.warning("SQL time budget exceeded", extra={'metric': 'sql_budget_exceeded', 'budget_ms': budget_ms})
+
+
+def stats():
+    overrides = current_app.config['TIME_BUDGET_OVERRIDES']
+    with _exceeded_lock:
+        exceeded = dict(_exceeded)
+    return [
+        {'endpoint': endpoint, 'budget_ms': overrides.get(endpoint, ms), 'exceeded': exceeded.get(endpoint, 0)}
+        for endpoint, ms in sorted(_budgets.items())
+    ]
+
+
+def time_budget(ms):
+    """
+    Limits the SQL a view runs to ms milliseconds in total, answering 504 past that
+    """
+    def decorator(view):
+        _budgets[view.__name__] = ms
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config['TIME_BUDGETS_ENABLED']:
+                return view(*args, **kwargs)
+
+            budget_ms = current_app.config['TIME_BUDGET_OVERRIDES'].get(request.endpoint, ms)
+            g.sql_budget_ms = budget_ms
+            g.sql_deadline = time.perf_counter() + budget_ms / 1000
+            g.sql_budget_exceeded = False
+            try:
+                try:
+                    response = make_response(view(*args, **kwargs))
+                except BudgetExceeded:
+                    response = None
+                if not g.sql_budget_exceeded:
+                    return response
+            finally:
+                g.pop('sql_deadline', None)
+
+            _record_exceeded(request.endpoint, budget_ms)
+            return jsonify({
+                'success': False,
+                'error': f'The query took longer than its {budget_ms} ms budget; narrow the request and try again'
+            }), 504
+        return wrapper
+    return decorator
@@ -0,0 +1,104 @@
+"""
+Tracking number generator.
+
+Numbers come from the id_sequences table in blocks (hi/lo): a worker reserves
+BLOCK_SIZE values with one UPDATE on its own autocommit connection and hands
+them out from memory. Reserved values that are never used just leave a gap.
+A number is PREFIX + 12 digit sequence value + a Luhn check digit.
+"""
+import os
+import threading
+
+SEQUENCE_NAME = 'tracking_number'
+PREFIX = 'EZ'
+DIGITS = 12
+BLOCK_SIZE = 1000
+MAX_BULK = 1000
+
+_lock = threading.Lock()
+_block = {'pid': None, 'next': 0, 'end': 0}
+
+
+def create_sequence_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS id_sequences (
+            name VARCHAR(64) NOT NULL PRIMARY KEY,
+            next_value BIGINT NOT NULL
+        )
+    """)
+    cur.execute("INSERT IGNORE INTO id_sequences (name, next_value) VALUES (%s, 1)", (SEQUENCE_NAME,))
+
+
+def luhn_digit(digits):
+    total = 0
+    # Double every second digit from the right, counting the check digit as position 0
+    for position, char in enumerate(reversed(digits)):
+        value = int(char)
+        if position % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def format_number(value):
+    digits = str(value).zfill(DIGITS)
+    return f"{PREFIX}{digits}{luhn_digit(digits)}"
+
+
+def is_valid(tracking_number):
+    body = tracking_number[len(PREFIX):]
+    return (tracking_number.startswith(PREFIX) and len(body) == DIGITS + 1 and body.isdigit()
+            and luhn_digit(body[:-1]) == body[-1])
+
+
+def _reserve(mysql, count):
+    """
+    Reserves count values in one statement and returns the first one
+    """
+    connection = mysql.connect
+    try:
+        connection.autocommit(True)
+        cur = connection.cursor()
+        # LAST_INSERT_ID(expr) hands the new value back to this connection without another lock
+        cur.execute(
+            "UPDATE id_sequences SET next_value = LAST_INSERT_ID(next_value + %s) WHERE name = %s",
+            (count, SEQUENCE_NAME)
+        )
+        if cur.rowcount == 0:
+            raise RuntimeError(f"Sequence '{SEQUENCE_NAME}' is missing; initialize the database first")
+        cur.execute("SELECT LAST_INSERT_ID() as end_value")
+        end = cur.fetchone()['end_value']
+        cur.close()
+        return end - count
+    finally:
+        connection.close()
+
+
+def allocate(mysql, count=1):
+    """
+    Returns count new tracking numbers, reserving at most one new block from the database
+    """
+    with _lock:
+        if _block['pid'] != os.getpid():
+            # A forked worker must not hand out its parent's block again
+            _block.update(pid=os.getpid(), next=0, end=0)
+
+        values = []
+        take = min(count, _block['end'] - _block['next'])
+        values.extend(range(_block['next'], _block['next'] + take))
+        _block['next'] += take
+
+        missing = count - take
+        if missing:
+            size = max(BLOCK_SIZE, missing)
+            start = _reserve(mysql, size)
+            values.extend(range(start, start + missing))
+            _block.update(next=start + missing, end=start + size)
+
+    return [format_number(value) for value in values]
+
+
+def next_number(mysql):
+    return allocate(mysql, 1)[0]
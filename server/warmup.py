@@ -0,0 +1,193 @@
+"""
+Per-process warm-up after start and after every fork.
+
+A background thread requests, through the regular view functions, the
+reference data lists, the stats endpoints and the dashboards of the customers
+and drivers with the most tracking events in the last WARMUP_ACTIVITY_DAYS.
+Cached endpoints end up in this process's response cache; the rest leave
+their pages in MySQL's buffer pool. Then it fits the ETA model, which reads
+the whole delivery history and so runs after the worker already counts as
+warm.
+
+/readyz reports a worker not ready until the first warm-up since the app was
+loaded has finished (or failed), so after a deploy the load balancer only
+sends traffic once the cold queries have run once. The app is loaded once in
+the gunicorn master, and the flag saying a warm-up finished is kept in memory
+shared with every worker forked from it. Workers that replace recycled ones
+still warm up, but are ready at once instead of taking the deploy out of
+rotation. A new master (USR2) loads the app again and gates again.
+"""
+import mmap
+import os
+import threading
+import time
+
+import batch
+import eta_model
+import structured_log
+
+log = structured_log.get_logger()
+
+_state = {'pid': None, 'thread': None}
+_lock = threading.Lock()
+_status = {'status': 'pending', 'elapsed_ms': None, 'steps': [], 'error': None}
+
+# Anonymous shared memory created where the app is loaded; byte 0 is set once any process
+# forked from there has finished a warm-up
+_deployment = mmap.mmap(-1, 1)
+
+
+def init_app(app, mysql):
+    app.config.setdefault('WARMUP_ENABLED', True)
+    app.config.setdefault('WARMUP_PATHS', [
+        '/api/locations',
+        '/api/routes',
+        '/api/vehicles',
+        '/api/warehouses',
+        '/api/stats',
+        '/api/admin/stats',
+        '/api/drivers/leaderboard',
+    ])
+    app.config.setdefault('WARMUP_TOP_CUSTOMERS', 20)
+    app.config.setdefault('WARMUP_TOP_DRIVERS', 20)
+    app.config.setdefault('WARMUP_ACTIVITY_DAYS', 7)
+    # Parallel warm-up requests per process
+    app.config.setdefault('WARMUP_CONCURRENCY', 4)
+
+    if not app.config['WARMUP_ENABLED']:
+        _status['status'] = 'disabled'
+
+    @app.before_request
+    def _ensure_warmup():
+        if app.config['WARMUP_ENABLED']:
+            start(app, mysql)
+
+
+def most_active(cur, days, customers, drivers):
+    """
+    (customer_id, user_id) and (driver_id, user_id) pairs with the most recent tracking events
+    """
+    cur.execute("""
+        SELECT c.customer_id, c.user_id, COUNT(*) as events
+        FROM tracking_events te
+        JOIN shipments s ON s.shipment_id = te.shipment_id
+        JOIN customers c ON c.customer_id = s.customer_id
+        WHERE te.event_timestamp >= NOW() - INTERVAL %s DAY
+        GROUP BY c.customer_id, c.user_id
+        ORDER BY events DESC
+        LIMIT %s
+    """, (days, customers))
+    active_customers = [(row['customer_id'], row['user_id']) for row in cur.fetchall()]
+
+    cur.execute("""
+        SELECT d.driver_id, d.user_id, COUNT(*) as events
+        FROM tracking_events te
+        JOIN shipments s ON s.shipment_id = te.shipment_id
+        JOIN drivers d ON d.driver_id = s.driver_id
+        WHERE te.event_timestamp >= NOW() - INTERVAL %s DAY
+        GROUP BY d.driver_id, d.user_id
+        ORDER BY events DESC
+        LIMIT %s
+    """, (days, drivers))
+    active_drivers = [(row['driver_id'], row['user_id']) for row in cur.fetchall()]
+    return active_customers, active_drivers
+
+
+def _step(name, func):
+    started = time.perf_counter()
+    detail = func()
+    step = dict(detail or {}, name=name, elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+    _status['steps'].append(step)
+    return step
+
+
+def _get(app, paths, concurrency):
+    items = [
+        {'id': path, 'method': 'GET', 'path': path, 'body': None, 'headers': {}}
+        for path in paths
+    ]
+    results = batch.run(app, items, {}, parallel=True, max_workers=concurrency)
+    failed = [result['id'] for result in results if result['status'] != 200]
+    return {'requests': len(items), 'failed': failed}
+
+
+def warm(app, mysql):
+    config = app.config
+    concurrency = config['WARMUP_CONCURRENCY']
+    started = time.perf_counter()
+    _status.update(status='running', steps=[], error=None, elapsed_ms=None)
+    try:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            try:
+                active = {}
+
+                def find_active():
+                    active['customers'], active['drivers'] = most_active(
+                        cur, config['WARMUP_ACTIVITY_DAYS'], config['WARMUP_TOP_CUSTOMERS'], config['WARMUP_TOP_DRIVERS']
+                    )
+                    return {'customers': len(active['customers']), 'drivers': len(active['drivers'])}
+
+                _step('reference_and_stats', lambda: _get(app, config['WARMUP_PATHS'], concurrency))
+                _step('active_users', find_active)
+                _step('customer_dashboards', lambda: _get(app, [
+                    path
+                    for customer_id, user_id in active['customers']
+                    for path in (f'/api/customer-dashboard/{user_id}', f'/api/customer/stats/{customer_id}')
+                ], concurrency))
+                _step('driver_dashboards', lambda: _get(app, [
+                    path
+                    for driver_id, user_id in active['drivers']
+                    for path in (f'/api/driver-dashboard/{user_id}', f'/api/driver/stats/{driver_id}')
+                ], concurrency))
+            finally:
+                cur.close()
+        outcome = {'status': 'done'}
+    except Exception as e:
+        # A failed warm-up must not keep the worker out of rotation
+        outcome = {'status': 'failed', 'error': str(e)}
+        log.exception("Warm-up failed")
+    _status.update(outcome, elapsed_ms=round((time.perf_counter() - started) * 1000, 2))
+    _deployment[0] = 1
+    log.info("Warm-up finished", extra={'status': _status['status'], 'elapsed_ms': _status['elapsed_ms']})
+
+    # Serving already; the first ETA request would otherwise pay for the full-history fit
+    try:
+        with app.app_context():
+            cur = mysql.connection.cursor()
+            try:
+                _step('eta_model', lambda: eta_model.refresh(cur, config['ETA_SETTLE_SECONDS']))
+            finally:
+                cur.close()
+    except Exception:
+        log.exception("Warm-up ETA model fit failed")
+
+
+def status():
+    return dict(_status, steps=list(_status['steps']), deployment_warm=bool(_deployment[0]))
+
+
+def finished():
+    return _status['status'] in ('done', 'failed', 'disabled')
+
+
+def ready():
+    """
+    Whether readiness may pass: this process's warm-up is over, or an earlier one since the deploy is
+    """
+    return finished() or bool(_deployment[0])
+
+
+def start(app, mysql):
+    """
+    Starts this process's warm-up (again, in a freshly forked worker)
+    """
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        _status.update(status='pending', elapsed_ms=None, steps=[], error=None)
+        thread = threading.Thread(target=warm, args=(app, mysql), name='warmup', daemon=True)
+        thread.start()
+        _state.update(pid=os.getpid(), thread=thread)